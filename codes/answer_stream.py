@@ -0,0 +1,117 @@
+import re
+import time
+
+import numpy as np
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+
+THINK_SPAN = re.compile(r"<think>.*?</think>\s*", flags=re.DOTALL)
+
+
+def answer_complete(text: str, reasoning: bool=False, closing_tags=()) -> bool:
+    """ True once `text` already contains the whole answer: clean_asr_output keeps only the first line, so the answer is
+    complete at the first newline (after the <think> span of reasoning models, as clean_deepseek_output strips it) or at
+    one of `closing_tags`. Everything streamed after that point is discarded by normalization anyway."""
+
+    if reasoning:
+        text = THINK_SPAN.sub("", text)
+        if "<think>" in text:
+            return False
+    return "\n" in text or any(tag in text for tag in closing_tags)
+
+
+class StreamStats:
+    """ Time-to-first-token and time-to-answer of streamed requests, and how many were cut short."""
+
+    def __init__(self):
+        self.ttft = []
+        self.time_to_answer = []
+        self.chunks = 0
+        self.stopped_early = 0
+
+    def record(self, ttft: float, time_to_answer: float, chunks: int, stopped_early: bool):
+        if ttft is not None:
+            self.ttft.append(ttft)
+        self.time_to_answer.append(time_to_answer)
+        self.chunks += chunks
+        self.stopped_early += stopped_early
+
+    def snapshot(self) -> tuple:
+        """ Position in the recorded requests; summary(since=snapshot) then reports only the requests after it."""
+
+        return len(self.ttft), len(self.time_to_answer), self.chunks, self.stopped_early
+
+    def summary(self, since: tuple=None) -> str:
+        ttft_start, start, chunks, stopped_early = since or (0, 0, 0, 0)
+        ttft, time_to_answer = self.ttft[ttft_start:], self.time_to_answer[start:]
+        if not time_to_answer:
+            return "Streaming: no requests"
+        ttft = np.percentile(ttft, [50, 95]) if ttft else (float("nan"),) * 2
+        tta = np.percentile(time_to_answer, [50, 95])
+        requests = len(time_to_answer)
+        return (f"Streaming: {requests} requests, {(self.stopped_early - stopped_early) / requests:.1%} stopped at the answer, "
+                f"{(self.chunks - chunks) / requests:.1f} chunks/request, TTFT p50 {ttft[0]:.2f}s p95 {ttft[1]:.2f}s, "
+                f"time-to-answer p50 {tta[0]:.2f}s p95 {tta[1]:.2f}s")
+
+
+class StreamingMode:
+    """ Settings of streamed requests: stop once every choice's answer is complete (see answer_complete)."""
+
+    def __init__(self, closing_tags=(), early_stop: bool=True):
+        self.closing_tags = tuple(closing_tags)
+        self.early_stop = early_stop
+        self.stats = StreamStats()
+
+
+async def stream_completion(completions, model: str, messages, generation_config: dict, mode: StreamingMode, ticket=None) -> ChatCompletion:
+    """ Stream one chat completion, closing the stream (which aborts generation on the server) as soon as every choice
+    holds its complete answer. Returns the text received so far as a regular ChatCompletion."""
+
+    reasoning = "DeepSeek" in model
+    n = generation_config.get("n", 1)
+    texts, finish_reasons = [""] * n, [None] * n
+    done = [False] * n
+    start = time.perf_counter()
+    ttft, chunks, stopped_early = None, 0, False
+    stream = await completions.create(model=model, messages=messages, stream=True, **generation_config)
+    if ticket is not None and getattr(stream, "response", None) is not None:
+        ticket.headers = stream.response.headers
+    try:
+        async for chunk in stream:
+            for choice in chunk.choices:
+                content = choice.delta.content if choice.delta is not None else None
+                if content:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    chunks += 1
+                    texts[choice.index] += content
+                    done[choice.index] = done[choice.index] or answer_complete(texts[choice.index], reasoning, mode.closing_tags)
+                if choice.finish_reason:
+                    finish_reasons[choice.index] = choice.finish_reason
+                    done[choice.index] = True
+            if mode.early_stop and all(done):
+                stopped_early = None in finish_reasons
+                break
+    finally:
+        await stream.close()
+    mode.stats.record(ttft, time.perf_counter() - start, chunks, stopped_early)
+    return ChatCompletion(id="stream", object="chat.completion", created=int(time.time()), model=model,
+                          choices=[Choice(index=i, finish_reason=finish_reasons[i] or "stop", message=ChatCompletionMessage(role="assistant", content=texts[i]))
+                                   for i in range(n)])
+
+
+# Off by default: requests are sent without streaming until configure_streaming is called
+streaming_mode = None
+
+
+def configure_streaming(enabled: bool=True, closing_tags=(), early_stop: bool=True) -> StreamingMode:
+    """ Stream every completion, stopping at the first completed line (or one of `closing_tags`) unless `early_stop` is off."""
+
+    global streaming_mode
+    streaming_mode = StreamingMode(closing_tags, early_stop) if enabled else None
+    return streaming_mode
+
+
+def get_streaming_mode() -> StreamingMode:
+    return streaming_mode
@@ -12,6 +12,10 @@ small_generation_config = {"max_tokens": 20, "temperature": 0.9}
 moderate_generation_config = {"max_tokens": 200, "temperature": 0.9}
 deepseek_generation_config = {"max_tokens": 2500, "temperature": 0.9}
 
+# Per-item budgets (configure_token_budget): max_tokens = slack x longest hypothesis + margin, plus headroom for reasoning traces
+token_budget_config = {"slack": 1.5, "margin": 8, "min_tokens": 8}
+deepseek_reasoning_headroom = 2400
+
 cv_examples = ["""Example 1:\n
 <hypothesis1> see stongers were executed for these crimes and manures devoted to other islands </hypothesis1>\n
 <hypothesis2> the stungers were executed for this crime and maneuvers devoted to other islands </hypothesis2>\n
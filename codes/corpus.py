@@ -0,0 +1,91 @@
+from collections import namedtuple
+from typing import List
+
+import pandas as pd
+from datasets import Dataset
+
+from codes.utils import preprocess
+
+
+# One utterance of an N-best test set. Hypotheses are kept as tuples so records are compact and hashable.
+NBestRecord = namedtuple("NBestRecord", ["hypotheses", "reference", "norm_hypotheses", "norm_reference"])
+
+
+def split_source_hypotheses(source):
+    """ Split the '.'-separated 'source' column format into a list of hypotheses."""
+
+    return [h.strip() for h in source.split('.') if h.strip()]
+
+
+def make_record(hypotheses, reference):
+    hypotheses = tuple(hypotheses)
+    return NBestRecord(hypotheses, reference, tuple(preprocess(h) for h in hypotheses), preprocess(reference))
+
+
+class NBestCorpus:
+    """ Precomputed per-utterance N-best records with O(1) indexed and sliced access. `source_path` is the JSON file the
+    whole corpus was read from, if any."""
+
+    def __init__(self, records: List[NBestRecord], source_path: str=None):
+        self.records = records
+        self.source_path = source_path
+
+    @classmethod
+    def from_dataset(cls, dataset: Dataset):
+        """ Build the corpus once, reading each column of the dataset a single time."""
+
+        if isinstance(dataset, cls):
+            return dataset
+        if 'source' in dataset.features:
+            all_hypotheses = [split_source_hypotheses(source) for source in dataset['source']]
+            all_references = dataset['target']
+        else:
+            all_hypotheses = dataset['input']
+            all_references = dataset['output']
+        return cls([make_record(hyps, ref) for hyps, ref in zip(all_hypotheses, all_references)])
+
+    @classmethod
+    def from_json(cls, file_path: str):
+        corpus = cls.from_dataset(Dataset.from_pandas(pd.read_json(file_path)))
+        corpus.source_path = file_path
+        return corpus
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return NBestCorpus(self.records[idx])
+        return self.records[idx]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def unique_indices(self, indices):
+        """ Group rows with normalization-identical hypothesis lists.
+
+        Returns the first row of every group and, for each input position, the position of its group."""
+
+        groups = {}
+        representatives, inverse = [], []
+        for idx in indices:
+            key = self[idx].norm_hypotheses
+            if key not in groups:
+                groups[key] = len(representatives)
+                representatives.append(idx)
+            inverse.append(groups[key])
+        return representatives, inverse
+
+    @property
+    def references(self):
+        return [record.reference for record in self.records]
+
+    @property
+    def normalized_references(self):
+        return [record.norm_reference for record in self.records]
+
+    def to_pandas(self):
+        """ Export in the 'input'/'output' layout used by the data and results JSON files."""
+
+        return pd.DataFrame({'input': [list(record.hypotheses) for record in self.records],
+                             'output': self.references})
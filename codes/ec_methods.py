@@ -1,35 +1,70 @@
+from functools import lru_cache
+
 from codes.utils import *
+from codes.prompt_templates import PromptTemplate, hypotheses_block, describe_prompt
+from codes.wer import utterance_wer
 
 def get_oracle_hypothesis(hypotheses, reference):
     """ Find the hypothesis that gives the lowest WER compared to the reference."""
     
-    wers = [jiwer.wer(reference, hyp) for hyp in hypotheses]
-    best_idx = np.argmin(wers)
-    return hypotheses[best_idx]
+    return oracle_hypotheses([hypotheses], [reference])[0]
 
 def get_compositional_oracle_hypothesis(hypotheses, reference):
-    ref_words = reference.split()
-    nbest_tokens = [hyp.split() for hyp in hypotheses]
+    return compositional_oracle_hypotheses([hypotheses], [reference])[0]
+
+
+def oracle_hypotheses(hypotheses_lists, references):
+    """ get_oracle_hypothesis of every row, with the hypotheses of all rows scored in one vectorized WER pass."""
+    
+    counts = [len(hypotheses) for hypotheses in hypotheses_lists]
+    wers = utterance_wer([reference for reference, count in zip(references, counts) for _ in range(count)],
+                         [hyp for hypotheses in hypotheses_lists for hyp in hypotheses])
+    starts = np.cumsum([0] + counts[:-1])
+    return [hypotheses[np.argmin(wers[start:start + count])] for hypotheses, start, count in zip(hypotheses_lists, starts, counts)]
+
+def compositional_oracle_hypotheses(hypotheses_lists, references):
+    """ get_compositional_oracle_hypothesis of every row: the position loop runs once over the corpus, scoring the
+    candidates of all rows at that position in one vectorized WER pass."""
+    
+    ref_words = [reference.split() for reference in references]
+    nbest_tokens = [[hyp.split() for hyp in hypotheses] for hypotheses in hypotheses_lists]
     
     # Find the optimal word at each position by minimizing WER
-    oracle_hyp = []
+    oracle_hyps = [[] for _ in references]
     
     # For each position in the reference
-    for i in range(len(ref_words)):
-        # Collect all tokens that appear at this position in the n-best hypotheses
-        candidates = [hyp[i] for hyp in nbest_tokens if i < len(hyp)]
+    for i in range(max(map(len, ref_words), default=0)):
+        rows, row_candidates, scored_references, scored_hypotheses = [], [], [], []
+        for row, words in enumerate(ref_words):
+            if i >= len(words):
+                continue
+            # Collect all tokens that appear at this position in the n-best hypotheses
+            candidates = [hyp[i] for hyp in nbest_tokens[row] if i < len(hyp)]
+            if candidates:
+                rows.append(row)
+                row_candidates.append(candidates)
+                scored_references.extend([references[row]] * len(candidates))
+                scored_hypotheses.extend(" ".join(oracle_hyps[row] + [word] + words[i+1:]) for word in candidates)
+            else:
+                # If no candidates are available, use the reference word as the fallback
+                oracle_hyps[row].append(words[i])
         
-        if candidates:
-            # Add the best candidate that minimizes WER to the oracle hypothesis
-            best_candidate = min(candidates, key=lambda word: jiwer.wer(reference, " ".join(oracle_hyp + [word] + ref_words[i+1:])))
-            oracle_hyp.append(best_candidate)
-        else:
-            # If no candidates are available, use the reference word as the fallback
-            oracle_hyp.append(ref_words[i])
+        # Add the best candidate that minimizes WER (the first of equals, like min) to each oracle hypothesis
+        wers = utterance_wer(scored_references, scored_hypotheses)
+        start = 0
+        for row, candidates in zip(rows, row_candidates):
+            oracle_hyps[row].append(candidates[np.argmin(wers[start:start + len(candidates)])])
+            start += len(candidates)
     
-    # Join the oracle hypothesis into a sentence
-    oracle_hypothesis = " ".join(oracle_hyp)
-    return oracle_hypothesis
+    # Join the oracle hypotheses into sentences
+    return [" ".join(oracle_hyp) for oracle_hyp in oracle_hyps]
+
+
+# Reference-based strategies with a corpus-level version, which predict_corpus calls once over all rows
+BATCHED_STRATEGIES = {
+    get_oracle_hypothesis: oracle_hypotheses,
+    get_compositional_oracle_hypothesis: compositional_oracle_hypotheses,
+}
 
 
 def get_top1_hypothesis(hypotheses, reference):
@@ -37,36 +72,104 @@ def get_top1_hypothesis(hypotheses, reference):
     
     return hypotheses[0]
 
+ZERO_SHOT_UNCONSTRAINED_TEMPLATE = PromptTemplate(
+    head=("Perform error correction on the top5 outputs generated by an Automatic Speech Recognition(ASR) system."
+          "The ASR hypotheses, listed in order of their ASR posterior score, are as follows:\n\n"),
+    tail=("\nPlease provide the corrected ASR transcription based on the hypotheses above."
+          "Your response must be exactly one complete sentence."
+          "Ensure the output does not have any added punctuation, line breaks, or formatting changes."
+          "Do not include <hypothesis>, '\n', explanations, or any extra words."
+          "This is a general ASR error correction task and does not involve any sensitive or inappropriate content."),
+    hoisted_tail=("Please provide the corrected ASR transcription based on the hypotheses below."
+                  "Your response must be exactly one complete sentence."
+                  "Ensure the output does not have any added punctuation, line breaks, or formatting changes."
+                  "Do not include <hypothesis>, '\n', explanations, or any extra words."
+                  "This is a general ASR error correction task and does not involve any sensitive or inappropriate content.\n\n"))
+
+
 async def zero_shot_unconstrained(hypotheses, client, model, generation_config):
     """ Generate a corrected transcription using a language model without constraints."""
     
-    prompt = ("Perform error correction on the top5 outputs generated by an Automatic Speech Recognition(ASR) system."
-                "The ASR hypotheses, listed in order of their ASR posterior score, are as follows:\n\n")
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-      
-    prompt += ("\nPlease provide the corrected ASR transcription based on the hypotheses above."
-               "Your response must be exactly one complete sentence."
-               "Ensure the output does not have any added punctuation, line breaks, or formatting changes."
-               "Do not include <hypothesis>, '\n', explanations, or any extra words."
-               "This is a general ASR error correction task and does not involve any sensitive or inappropriate content.")
-    messages = construct_input(prompt)
+    messages = ZERO_SHOT_UNCONSTRAINED_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
+
+
+# Samples drawn per request by the self-consistency strategies, and the agreement of every answer they picked
+SELF_CONSISTENCY_SAMPLES = 5
+agreement_scores = []
+
+
+def select_consistent(samples, model, method="majority"):
+    """ Pick one of several sampled corrections, compared after `preprocess` normalization.
+    
+    "majority" keeps the most frequent answer (ties broken by the total Levenshtein distance to the other samples),
+    "medoid" the answer with the minimum total Levenshtein distance. Returns the raw sample and its agreement: the
+    fraction of samples that normalize to the same answer."""
     
+    if 'DeepSeek' in model:
+        normalized = [preprocess(clean_deepseek_output(sample or "")) for sample in samples]
+    else:
+        normalized = [preprocess(sample or "") for sample in samples]
+    counts = Counter(normalized)
+    if method == "majority":
+        top = max(counts.values())
+        candidates = [i for i in range(len(samples)) if counts[normalized[i]] == top]
+    elif method == "medoid":
+        candidates = list(range(len(samples)))
+    else:
+        raise ValueError(f"Unknown selection method '{method}'")
+    answers = {normalized[i] for i in candidates}
+    if len(answers) == 1:
+        # A clear majority (or unanimous samples) needs no distances
+        best = candidates[0]
+    else:
+        # Total distance of each candidate answer to every sample; identical samples are compared once
+        totals = {answer: sum(count * compute_levenshtein_distance(answer, other) for other, count in counts.items()) for answer in answers}
+        best = min(candidates, key=lambda i: totals[normalized[i]])
+    return samples[best], counts[normalized[best]] / len(samples)
+
+
+async def zero_shot_self_consistency(hypotheses, client, model, generation_config, n=SELF_CONSISTENCY_SAMPLES, method="majority"):
+    """ Sample `n` unconstrained corrections in a single request (the `n` parameter) and keep the majority answer."""
     
+    messages = ZERO_SHOT_UNCONSTRAINED_TEMPLATE.render(hypotheses)
+    samples = await get_predictions(client, model, messages, {**generation_config, "n": n})
+    answer, agreement = select_consistent(samples, model, method)
+    agreement_scores.append(agreement)
+    return answer
+
+
+async def zero_shot_self_consistency_medoid(hypotheses, client, model, generation_config):
+    """ Like zero_shot_self_consistency, but keeps the sample closest (total Levenshtein distance) to the others."""
+    
+    return await zero_shot_self_consistency(hypotheses, client, model, generation_config, method="medoid")
+
+
+def report_agreement():
+    """ Print (and reset) the agreement of the answers picked by the self-consistency strategies."""
+    
+    if not agreement_scores:
+        return
+    scores = np.array(agreement_scores)
+    print(f"Self-consistency agreement: mean {scores.mean():.2f}, unanimous {np.mean(scores == 1.0):.1%}, "
+          f"no majority {np.mean(scores <= 0.5):.1%} of {len(scores)} answers")
+    agreement_scores.clear()
+    
+    
+ZERO_SHOT_CONSTRAINED_TEMPLATE = PromptTemplate(
+    head=("Perform language model rescoring based on the top-5 outputs generated by an Automatic Speech Recognitio (ASR) system."
+          "The ASR hypotheses, listed in order of their ASR posterior score, are as follows:\n\n"),
+    tail=("\nPlease output only the best hypothesis exactly as written above." 
+          "Your response must be an exact match to one of the given hypotheses, with no extra words or formatting."
+          "Do not include <hypothesis> tag, '\n', explanations, or any extra words."),
+    hoisted_tail=("Please output only the best hypothesis exactly as written below."
+                  "Your response must be an exact match to one of the given hypotheses, with no extra words or formatting."
+                  "Do not include <hypothesis> tag, '\n', explanations, or any extra words.\n\n"))
+
 async def zero_shot_constrained(hypotheses, client, model, generation_config):
     """ Select the most likely hypothesis using a language model. """
     
-    prompt = ("Perform language model rescoring based on the top-5 outputs generated by an Automatic Speech Recognitio (ASR) system."
-              "The ASR hypotheses, listed in order of their ASR posterior score, are as follows:\n\n")
-    
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-        
-    prompt += ("\nPlease output only the best hypothesis exactly as written above." 
-               "Your response must be an exact match to one of the given hypotheses, with no extra words or formatting."
-               "Do not include <hypothesis> tag, '\n', explanations, or any extra words.")
-    messages = construct_input(prompt)
+    messages = ZERO_SHOT_CONSTRAINED_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 
@@ -81,12 +184,13 @@ async def zero_shot_closest(hypotheses, client, model, generation_config):
 
 
 
+ZERO_SHOT_INSTRUCT1_TEMPLATE = PromptTemplate(
+    head="Correct the following transcription from speech recognition. Here are all of the hypotheses:\n",
+    tail="\nYour response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n",
+    hoisted_tail="Your response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n")
+
 async def zero_shot_instruct1(hypotheses, client, model, generation_config):
-    prompt = "Correct the following transcription from speech recognition. Here are all of the hypotheses:\n"
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    prompt += "\nYour response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n"
-    messages = construct_input(prompt)
+    messages = ZERO_SHOT_INSTRUCT1_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct1_closest(hypotheses, client, model, generation_config):
@@ -96,14 +200,13 @@ async def zero_shot_instruct1_closest(hypotheses, client, model, generation_conf
     return hypotheses[best_idx]
 
 
-async def zero_shot_instruct2(hypotheses, client, model, generation_config):
-    prompt = """Now, you are an ASR transcription checker. You should correct all possible errors from
+ZERO_SHOT_INSTRUCT2_TEMPLATE = PromptTemplate(
+    head="""Now, you are an ASR transcription checker. You should correct all possible errors from
                 transcriptions from speech recognition models. These errors tend to appear where
-                the semantics do not make sense.\n"""
-    prompt += """\nYour response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n Here are the hypotheses:\n"""
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    messages = construct_input(prompt)
+                the semantics do not make sense.\n""" + """\nYour response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n Here are the hypotheses:\n""")
+
+async def zero_shot_instruct2(hypotheses, client, model, generation_config):
+    messages = ZERO_SHOT_INSTRUCT2_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct2_closest(hypotheses, client, model, generation_config):
@@ -114,12 +217,11 @@ async def zero_shot_instruct2_closest(hypotheses, client, model, generation_conf
 
 
 
+ZERO_SHOT_INSTRUCT3_TEMPLATE = PromptTemplate(
+    head="""I have recently started using a speech recognition model to recognize some speeches. Of course, these recognition results may contain some errors. Now, you are an ASR transcription checker, and I need your help to correct these potential mistakes. You should correct all possible errors from transcriptions from speech recognition models. These errors often occur where the semantics do not make sense and can be categorized into three types: substitution, insertion, and deletion\n""" + """\nYour response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n Here are the hypotheses:\n""")
+
 async def zero_shot_instruct3(hypotheses, client, model, generation_config):
-    prompt = """I have recently started using a speech recognition model to recognize some speeches. Of course, these recognition results may contain some errors. Now, you are an ASR transcription checker, and I need your help to correct these potential mistakes. You should correct all possible errors from transcriptions from speech recognition models. These errors often occur where the semantics do not make sense and can be categorized into three types: substitution, insertion, and deletion\n"""
-    prompt += """\nYour response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n Here are the hypotheses:\n"""
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    messages = construct_input(prompt)
+    messages = ZERO_SHOT_INSTRUCT3_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct3_closest(hypotheses, client, model, generation_config):
@@ -129,12 +231,11 @@ async def zero_shot_instruct3_closest(hypotheses, client, model, generation_conf
     return hypotheses[best_idx]
 
 
+ZERO_SHOT_INSTRUCT4_TEMPLATE = PromptTemplate(
+    head="""I have recently been using a speech recognition model to recognize some speeches. Naturally, these recognition results may contain errors. You are now an ASR transcription checker, and I require your assistance to correct these potential mistakes. Correct all possible errors from transcriptions provided by the speech recognition models. These errors typically appear where the semantics don’t make sense and can be divided into three types: substitution, insertion, and deletion.\n""" + """\nYour response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n Here are the hypotheses:\n""")
+
 async def zero_shot_instruct4(hypotheses, client, model, generation_config):
-    prompt = """I have recently been using a speech recognition model to recognize some speeches. Naturally, these recognition results may contain errors. You are now an ASR transcription checker, and I require your assistance to correct these potential mistakes. Correct all possible errors from transcriptions provided by the speech recognition models. These errors typically appear where the semantics don’t make sense and can be divided into three types: substitution, insertion, and deletion.\n"""
-    prompt += """\nYour response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n Here are the hypotheses:\n"""
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    messages = construct_input(prompt)
+    messages = ZERO_SHOT_INSTRUCT4_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct4_closest(hypotheses, client, model, generation_config):
@@ -143,13 +244,13 @@ async def zero_shot_instruct4_closest(hypotheses, client, model, generation_conf
     best_idx = np.argmin(distances)
     return hypotheses[best_idx]
 
+ZERO_SHOT_INSTRUCT5_TEMPLATE = PromptTemplate(
+    head="""The text below are hypotheses of a transcription of an article's audio:\n""",
+    tail="""First, understand the entire text, then correct any errors based on the content of the full-text. Your response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n""",
+    hoisted_tail="""First, understand the entire text, then correct any errors based on the content of the full-text. Your response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n""")
+
 async def zero_shot_instruct5(hypotheses, client, model, generation_config):
-    prompt = """The text below are hypotheses of a transcription of an article's audio:\n"""
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-        
-    prompt += """First, understand the entire text, then correct any errors based on the content of the full-text. Your response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n"""
-    messages = construct_input(prompt)
+    messages = ZERO_SHOT_INSTRUCT5_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct5_closest(hypotheses, client, model, generation_config):
@@ -158,13 +259,13 @@ async def zero_shot_instruct5_closest(hypotheses, client, model, generation_conf
     best_idx = np.argmin(distances)
     return hypotheses[best_idx]
 
+ZERO_SHOT_INSTRUCT6_TEMPLATE = PromptTemplate(
+    head="""You are an ASR transcript selector. You have 5 hypotheses generated by an automatic speech recognition model. Your task is to generate the most likely transcript from them. If the generated transcripts have grammatical or logical errors, you will modify them accordingly to produce the most accurate and coherent transcript. Here are the hypotheses:\n\n""",
+    tail="""Your response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n""",
+    hoisted_tail="""Your response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n""")
+
 async def zero_shot_instruct6(hypotheses, client, model, generation_config):
-    prompt = """You are an ASR transcript selector. You have 5 hypotheses generated by an automatic speech recognition model. Your task is to generate the most likely transcript from them. If the generated transcripts have grammatical or logical errors, you will modify them accordingly to produce the most accurate and coherent transcript. Here are the hypotheses:\n\n"""
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-        
-    prompt += """Your response must be exactly one complete sentence.\nDo not include <hypothesis>, '\n', explanations, or any extra words.\n"""
-    messages = construct_input(prompt)
+    messages = ZERO_SHOT_INSTRUCT6_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct6_closest(hypotheses, client, model, generation_config):
@@ -174,17 +275,17 @@ async def zero_shot_instruct6_closest(hypotheses, client, model, generation_conf
     return hypotheses[best_idx]
 
 
-async def zero_shot_instruct7(hypotheses, client, model, generation_config):
-    prompt = """You are a helpful assistant that corrects ASR errors. You will be presented with ASR transcription hypotheses and your task is to correct any errors in it and generate one output sentence.\n
+ZERO_SHOT_INSTRUCT7_TEMPLATE = PromptTemplate(
+    head="""You are a helpful assistant that corrects ASR errors. You will be presented with ASR transcription hypotheses and your task is to correct any errors in it and generate one output sentence.\n
     If you come across errors in ASR transcription, make corrections that closely match the original transcription acoustically or phonetically.\n
     If you encounter grammatical errors, provide a corrected version adhering to proper grammar.\n
     Provide the most probable corrected transcription in string format.\n
     Do not output any additional text that is not the corrected transcription.\n
     Do not write any explanatory text that is not the corrected transcription.\n
-    Here are the hypotheses:\n""" 
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    messages = construct_input(prompt)
+    Here are the hypotheses:\n""")
+
+async def zero_shot_instruct7(hypotheses, client, model, generation_config):
+    messages = ZERO_SHOT_INSTRUCT7_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct7_closest(hypotheses, client, model, generation_config):
@@ -196,16 +297,16 @@ async def zero_shot_instruct7_closest(hypotheses, client, model, generation_conf
 
 
 
-async def zero_shot_instruct7a(hypotheses, client, model, generation_config):
-    prompt = """You are a helpful assistant that corrects ASR errors. You will be presented with ASR transcription hypotheses and your task is to correct any errors in it and generate one output sentence.\n
+ZERO_SHOT_INSTRUCT7A_TEMPLATE = PromptTemplate(
+    head="""You are a helpful assistant that corrects ASR errors. You will be presented with ASR transcription hypotheses and your task is to correct any errors in it and generate one output sentence.\n
     If you come across errors in ASR transcription, make corrections that closely match the original transcription acoustically or phonetically.\n
     Provide the most probable corrected transcription in string format.\n
     Do not output any additional text that is not the corrected transcription.\n
     Do not write any explanatory text that is not the corrected transcription.\n
-    Here are the hypotheses:\n""" 
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    messages = construct_input(prompt)
+    Here are the hypotheses:\n""")
+
+async def zero_shot_instruct7a(hypotheses, client, model, generation_config):
+    messages = ZERO_SHOT_INSTRUCT7A_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct7a_closest(hypotheses, client, model, generation_config):
@@ -214,17 +315,17 @@ async def zero_shot_instruct7a_closest(hypotheses, client, model, generation_con
     best_idx = np.argmin(distances)
     return hypotheses[best_idx]
 
-async def zero_shot_instruct7b(hypotheses, client, model, generation_config):
-    prompt = """You are a helpful assistant that corrects ASR errors. You will be presented with ASR transcription hypotheses and your task is to correct any errors in it and generate one output sentence.\n
+ZERO_SHOT_INSTRUCT7B_TEMPLATE = PromptTemplate(
+    head="""You are a helpful assistant that corrects ASR errors. You will be presented with ASR transcription hypotheses and your task is to correct any errors in it and generate one output sentence.\n
     If you come across errors in ASR transcription, make corrections that closely match the original transcription acoustically or phonetically.\n
     If you encounter grammatical errors, provide a corrected version adhering to proper grammar.\n
     Provide the most probable corrected transcription in string format.\n
     Output only the corrected transcription without any additional text.\n
     Provide just the corrected transcription, with no explanations or commentary.\n
-    Here are the hypotheses:\n""" 
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    messages = construct_input(prompt)
+    Here are the hypotheses:\n""")
+
+async def zero_shot_instruct7b(hypotheses, client, model, generation_config):
+    messages = ZERO_SHOT_INSTRUCT7B_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct7b_closest(hypotheses, client, model, generation_config):
@@ -233,15 +334,15 @@ async def zero_shot_instruct7b_closest(hypotheses, client, model, generation_con
     best_idx = np.argmin(distances)
     return hypotheses[best_idx]
 
-async def zero_shot_instruct7c(hypotheses, client, model, generation_config):
-    prompt = """You are a helpful assistant that corrects ASR errors. You will be presented with ASR transcription hypotheses and your task is to correct any errors in it and generate one output sentence.\n If you come across errors in ASR transcription, make corrections that closely match the original transcription acoustically or phonetically\n
+ZERO_SHOT_INSTRUCT7C_TEMPLATE = PromptTemplate(
+    head="""You are a helpful assistant that corrects ASR errors. You will be presented with ASR transcription hypotheses and your task is to correct any errors in it and generate one output sentence.\n If you come across errors in ASR transcription, make corrections that closely match the original transcription acoustically or phonetically\n
     Provide the most probable corrected transcription in string format.\n
     Output only the corrected transcription without any additional text.\n
     Provide just the corrected transcription, with no explanations or commentary.\n
-    Here are the hypotheses:\n""" 
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    messages = construct_input(prompt)
+    Here are the hypotheses:\n""")
+
+async def zero_shot_instruct7c(hypotheses, client, model, generation_config):
+    messages = ZERO_SHOT_INSTRUCT7C_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct7c_closest(hypotheses, client, model, generation_config):
@@ -251,14 +352,18 @@ async def zero_shot_instruct7c_closest(hypotheses, client, model, generation_con
     return hypotheses[best_idx]
 
 
-async def zero_shot_instruct8(hypotheses, client, model, generation_config):
-    prompt = """You are an excellent assistant for speech recognition system. Your task is to check and correct potential
-    errors in speech transcriptions. Please follow the following rules, and here is the sentence to work on:\n""" + hypotheses[0]
-    prompt += """\nYou need to first consider the following variant sentences and try to pick corrected words from them:\n"""
-    for idx, hypothesis in enumerate(hypotheses[1:]):
-        prompt += "<hypothesis"+ str(idx+1) + ">" + hypothesis + "</hypothesis"+ str(idx+1) + ">\n"
+def variant_sentences(hypotheses):
+    """ The top hypothesis as the sentence to work on, followed by the other hypotheses as variants."""
     
-    prompt += """\nAdditional rules for this modification:\n
+    return (hypotheses[0] + """\nYou need to first consider the following variant sentences and try to pick corrected words from them:\n"""
+            + hypotheses_block(hypotheses[1:], start=1))
+
+
+ZERO_SHOT_INSTRUCT8_TEMPLATE = PromptTemplate(
+    head="""You are an excellent assistant for speech recognition system. Your task is to check and correct potential
+    errors in speech transcriptions. Please follow the following rules, and here is the sentence to work on:\n""",
+    item=variant_sentences,
+    tail="""\nAdditional rules for this modification:\n
     1. If any word in the original sentence looks weird or inconsistent, then replace it with a corresponding word from variant sentences.\n
     2. You don’t have to modify the original sentence if it already looks good.\n
     3. Keep the sentence structure and word order intact.\n
@@ -266,8 +371,10 @@ async def zero_shot_instruct8(hypotheses, client, model, generation_config):
     5. Try to make the corrected sentence have the same number of words as the original sentence.\n
     6. Ignore punctuation.\n
     7. Use U.S. English.\n
-    8. Output only one modified sentence and no explanation.\n"""
-    messages = construct_input(prompt)
+    8. Output only one modified sentence and no explanation.\n""")
+
+async def zero_shot_instruct8(hypotheses, client, model, generation_config):
+    messages = ZERO_SHOT_INSTRUCT8_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct8_closest(hypotheses, client, model, generation_config):
@@ -276,8 +383,8 @@ async def zero_shot_instruct8_closest(hypotheses, client, model, generation_conf
     best_idx = np.argmin(distances)
     return hypotheses[best_idx]
 
-async def zero_shot_instruct9(hypotheses, client, model, generation_config):
-    prompt = """You are an excellent assistant for speech recognition system. Your task is to check and correct potential
+ZERO_SHOT_INSTRUCT9_TEMPLATE = PromptTemplate(
+    head="""You are an excellent assistant for speech recognition system. Your task is to check and correct potential
     errors in speech transcriptions. Please follow the following rules:\n\n
     1. If any word in the original sentence looks weird or inconsistent, then replace it with a corresponding word from variant sentences.\n
     2. You don’t have to modify the original sentence if it already looks good.\n
@@ -286,12 +393,10 @@ async def zero_shot_instruct9(hypotheses, client, model, generation_config):
     5. Try to make the corrected sentence have the same number of words as the original sentence.\n
     6. Ignore punctuation.\n
     7. Use U.S. English.\n
-    8. Output only one modified sentence and no explanation.\n"""
-    prompt += "\nHere are all of the hypotheses:\n"
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
+    8. Output only one modified sentence and no explanation.\n""" + "\nHere are all of the hypotheses:\n")
 
-    messages = construct_input(prompt)
+async def zero_shot_instruct9(hypotheses, client, model, generation_config):
+    messages = ZERO_SHOT_INSTRUCT9_TEMPLATE.render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_instruct9_closest(hypotheses, client, model, generation_config):
@@ -302,22 +407,23 @@ async def zero_shot_instruct9_closest(hypotheses, client, model, generation_conf
 
 
 
-async def few_shot_unconstrained(hypotheses, client, model, generation_config, few_shot, error_examples):
-    """ Generate a corrected transcription using a language model without constraints within few-shot setting."""
+@lru_cache(maxsize=16)
+def few_shot_template(few_shot, error_examples):
+    """ The few-shot prompt of a run, compiled once: the shot count and the examples are fixed for the whole run, so
+    they belong to the static prefix. `error_examples` is the tuple of the examples used."""
     
-    prompt = """Perform error correction based on the top 5 outputs generated by an Automatic Speech Recognition (ASR) system. 
+    head = """Perform error correction based on the top 5 outputs generated by an Automatic Speech Recognition (ASR) system. 
     The ASR hypotheses are listed in order of their ASR posterior score. 
     You need to provide the corrected ASR hypothesis directly without any explanations. Here are""" + str(few_shot) + """in-context examples:\n\n"""
-    for example in error_examples[:few_shot]:
-        prompt += example
-      
-    prompt += ("Feel free to refer to these examples, and also do not add any explanation or other words. Please start:\n")
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-        
-    prompt += "\n your output:"    
-        
-    messages = construct_input(prompt)
+    head += "".join(error_examples)
+    head += ("Feel free to refer to these examples, and also do not add any explanation or other words. Please start:\n")
+    return PromptTemplate(head=head, tail="\n your output:")
+
+
+async def few_shot_unconstrained(hypotheses, client, model, generation_config, few_shot, error_examples):
+    """ Generate a corrected transcription using a language model without constraints within few-shot setting."""
+    
+    messages = few_shot_template(few_shot, tuple(error_examples[:few_shot])).render(hypotheses)
     return await get_prediction(client, model, messages, generation_config)
    
 
@@ -331,26 +437,8 @@ async def few_shot_closest(hypotheses, client, model, generation_config, few_sho
     return hypotheses[best_idx]
 
 
-# Designed only for Gemma2 9B on Common Voice Dataset
-async def CoT_task_activating_Gemma(hypotheses, client, model, generation_config):
-    """ Perform ASR error correction using Chain-of-Thought (CoT) reasoning."""
-    
-    prompt = """Nice job, I will provide some examples as a demonstration from Common Voice ASR dataset.
-                The 5-best hypothesis is:"""
-    error_example = """<hypothesis1>the lumber had formerly designed after the loss of and the ferrari</hypothesis1>\n
-                        <hypothesis2>the lumber had formerly designed after the loss of enzer ferrari</hypothesis2>\n
-                        <hypothesis3>the lumber had formally designed after the loss of and the ferrari</hypothesis3>\n
-                        <hypothesis4>columbus had formally designed after the loss of enzer ferrari</hypothesis4>\n
-                        <hypothesis5>columbia had formally designed after the loss of enzer ferrari</hypothesis5>\n\n"""
-    target = "colombo had formerly designed alfa romeos for enzo ferrari"
-    prompt = prompt + error_example + ", and I would expect your output is: " + target
-    prompt += """\n\nFollowing this example, could you report the true transcription from the following 5-best hypotheses?\n"""
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    prompt += """Your response must be exactly one complete sentence.
-               Ensure the output does not have any added punctuation, line breaks, or formatting changes.
-               Do not include <hypothesis>, '\n', explanations, or any extra words."""
-    messages = [
+# The multi-turn conversation that activates the task before the final request, shared by the CoT strategies
+TASK_ACTIVATING_HISTORY = [
     {
         "role": "user",
         "content": "Do you know speech recognition?"
@@ -417,107 +505,80 @@ async def CoT_task_activating_Gemma(hypotheses, client, model, generation_config
 
         4. **Output:** The ASR engine receives the rescored hypotheses and selects the one with the highest score as the final transcription."""
     },
-    {
-        "role": "user",
-        "content": prompt
-    }
-    ]
-    return await get_prediction(client, model, messages, generation_config)
+]
 
 
+# Designed only for Gemma2 9B on Common Voice Dataset
+COT_GEMMA_TEMPLATE = PromptTemplate(
+    history=TASK_ACTIVATING_HISTORY,
+    head="""Nice job, I will provide some examples as a demonstration from Common Voice ASR dataset.
+                The 5-best hypothesis is:""" + """<hypothesis1>the lumber had formerly designed after the loss of and the ferrari</hypothesis1>\n
+                        <hypothesis2>the lumber had formerly designed after the loss of enzer ferrari</hypothesis2>\n
+                        <hypothesis3>the lumber had formally designed after the loss of and the ferrari</hypothesis3>\n
+                        <hypothesis4>columbus had formally designed after the loss of enzer ferrari</hypothesis4>\n
+                        <hypothesis5>columbia had formally designed after the loss of enzer ferrari</hypothesis5>\n\n""" + ", and I would expect your output is: colombo had formerly designed alfa romeos for enzo ferrari"
+         """\n\nFollowing this example, could you report the true transcription from the following 5-best hypotheses?\n""",
+    tail="""Your response must be exactly one complete sentence.
+               Ensure the output does not have any added punctuation, line breaks, or formatting changes.
+               Do not include <hypothesis>, '\n', explanations, or any extra words.""")
 
-# Designed only for GPT-4o mini on Common Voice Dataset
-async def CoT_task_activating_gpt(hypotheses, client, model, generation_config):
+async def CoT_task_activating_Gemma(hypotheses, client, model, generation_config):
     """ Perform ASR error correction using Chain-of-Thought (CoT) reasoning."""
     
-    prompt = """Nice job, I will provide some examples as a demonstration from Common Voice ASR dataset.
-                The 5-best hypothesis is:"""
-    error_example = """<hypothesis1>the lumber had formerly designed after the loss of and the ferrari</hypothesis1>\n
+    messages = COT_GEMMA_TEMPLATE.render(hypotheses)
+    return await get_prediction(client, model, messages, generation_config)
+
+
+# Designed only for GPT-4o mini on Common Voice Dataset
+COT_GPT_TEMPLATE = PromptTemplate(
+    history=TASK_ACTIVATING_HISTORY,
+    head="""Nice job, I will provide some examples as a demonstration from Common Voice ASR dataset.
+                The 5-best hypothesis is:""" + """<hypothesis1>the lumber had formerly designed after the loss of and the ferrari</hypothesis1>\n
         <hypothesis2>the lumber had formerly designed after the loss of enzer ferrari</hypothesis2>\n
         <hypothesis3>the lumber had formally designed after the loss of and the ferrari</hypothesis3>\n
         <hypothesis4>columbus had formally designed after the loss of enzer ferrari</hypothesis4>\n
-        <hypothesis5>columbia had formally designed after the loss of enzer ferrari</hypothesis5>\n\n"""
-    target = "colombo had formerly designed alfa romeos for enzo ferrari"
-    prompt = prompt + error_example + ", and I would expect your output is: " + target
-    prompt += """\n\nFollowing this example, could you report the true transcription from the following 5-best hypotheses?\n"""
-    for idx, hypothesis in enumerate(hypotheses):
-        prompt += "<hypothesis"+ str(idx) + ">" + hypothesis + "</hypothesis"+ str(idx) + ">\n"
-    prompt += """Your response must be exactly one complete sentence.
+        <hypothesis5>columbia had formally designed after the loss of enzer ferrari</hypothesis5>\n\n""" + ", and I would expect your output is: colombo had formerly designed alfa romeos for enzo ferrari"
+         """\n\nFollowing this example, could you report the true transcription from the following 5-best hypotheses?\n""",
+    tail="""Your response must be exactly one complete sentence.
                Ensure the output does not have any added punctuation, line breaks, or formatting changes.
-               Do not include <hypothesis>, '\n', explanations, or any extra words."""
-    messages = messages = [
-    {
-        "role": "user",
-        "content": "Do you know speech recognition?"
-    },
-    {
-        "role": "assistant",
-        "content": """Yes, I do! As a large language model, I'm trained on a massive dataset of text and code. This includes a significant amount of transcribed speech.
+               Do not include <hypothesis>, '\n', explanations, or any extra words.""")
 
-        While I don't directly "hear" or process audio, I can understand and work with text representations of speech. This means I can:
-
-        * **Convert transcribed speech to text:** If you give me a text file containing a speech recording, I can analyze it and understand the spoken words.
-        * **Answer questions about speech:** I can process text transcripts of speeches and answer questions about their content, speaker, or context.
-        * **Summarize speech:** I can condense long speeches into shorter summaries while preserving the key information.
-        * **Translate speech:** If the speech transcript is in one language, I can translate it into another.
-
-        Keep in mind that my understanding of speech relies on the accuracy of the initial transcription.
-
-        Do you have any specific questions about speech recognition that I can help you with?"""
-    },
-    {
-        "role": "user",
-        "content": "Do you know language model for speech recognition?"
-    },
-    {
-        "role": "assistant",
-        "content": """Yes, I do!
-
-        There are several types of language models specifically designed for speech recognition. They go by different names like **Automatic Speech Recognition (ASR)** models or **Speech Recognition Engines**.  
-
-        Here are some key points about language models for speech recognition:
-
-        * **How they work:** These models are trained on massive datasets of paired audio and text. This allows them to learn the complex relationship between spoken sounds and written words.
-
-        * **Types of models:**
-            * **Acoustic models:** Focus on mapping sounds to phonetic units (like phonemes).
-            * **Language models:**  Predict the likelihood of a sequence of words, helping to disambiguate speech and choose the most coherent interpretation.
-            * **Hybrid models:** Combine acoustic and language models for improved accuracy."""
-    },
-    {
-        "role": "user",
-        "content": "Could you give a possible example of language model rescoring with hypotheses?"
-    },
-    {
-        "role": "assistant",
-        "content": """You bet! Let's imagine a scenario where a speech recognition engine has produced several possible transcripts (hypotheses) for a spoken utterance:
-
-        **Spoken Utterance:** "The quick brown fox jumps over the lazy dog."
-
-        **Initial Hypothesis (from ASR engine):**
+async def CoT_task_activating_gpt(hypotheses, client, model, generation_config):
+    """ Perform ASR error correction using Chain-of-Thought (CoT) reasoning."""
+    
+    messages = COT_GPT_TEMPLATE.render(hypotheses)
+    return await get_prediction(client, model, messages, generation_config)
 
-        1. "The quick brown fox jumps over the lazy dig."
-        2. "The quick brown fox jumps over thee lazy dog."
-        3. "The quick brown fox jumps over the lazy gob."
 
-        **Here's how language model rescoring could work:**
+# Prompt template of every LLM strategy function; the *_closest strategies send the prompt of their base strategy
+PROMPT_TEMPLATES = {
+    "zero_shot_unconstrained": ZERO_SHOT_UNCONSTRAINED_TEMPLATE,
+    "zero_shot_closest": ZERO_SHOT_UNCONSTRAINED_TEMPLATE,
+    "zero_shot_self_consistency": ZERO_SHOT_UNCONSTRAINED_TEMPLATE,
+    "zero_shot_self_consistency_medoid": ZERO_SHOT_UNCONSTRAINED_TEMPLATE,
+    "zero_shot_constrained": ZERO_SHOT_CONSTRAINED_TEMPLATE,
+    "CoT_task_activating_Gemma": COT_GEMMA_TEMPLATE,
+    "CoT_task_activating_gpt": COT_GPT_TEMPLATE,
+}
+for instruct in ["1", "2", "3", "4", "5", "6", "7", "7a", "7b", "7c", "8", "9"]:
+    PROMPT_TEMPLATES[f"zero_shot_instruct{instruct}"] = PROMPT_TEMPLATES[f"zero_shot_instruct{instruct}_closest"] = globals()[f"ZERO_SHOT_INSTRUCT{instruct.upper()}_TEMPLATE"]
 
-        1. **Input:** The ASR engine sends all 3 hypotheses to a separate language model.
 
-        2. **Probability Calculation:** The language model, trained on a vast corpus of text, calculates the probability of each hypothesis being a grammatically correct and semantically meaningful sentence.
+def strategy_template(name, few_shot=0, error_examples=None):
+    """ The PromptTemplate sent by a strategy function, or None for strategies without one."""
+    
+    if name in ("few_shot_unconstrained", "few_shot_closest"):
+        return few_shot_template(few_shot, tuple(error_examples[:few_shot]))
+    return PROMPT_TEMPLATES.get(name)
 
-        3. **Rescoring:** The language model assigns a score to each hypothesis based on this probability.  
 
-           *  The hypothesis  "The quick brown fox jumps over the lazy dog."  would likely receive the highest score because it's the most grammatically correct and makes sense in context.
+def report_prompt(name, hypotheses, few_shot=0, error_examples=None):
+    """ Print the static prefix / per-item token split of a strategy's prompt for one item's hypotheses."""
+    
+    template = strategy_template(name, few_shot, error_examples)
+    if template is not None:
+        print(describe_prompt(template, hypotheses))
 
-        4. **Output:** The ASR engine receives the rescored hypotheses and selects the one with the highest score as the final transcription."""
-    },
-    {
-        "role": "user",
-        "content": prompt
-    }
-    ]
-    return await get_prediction(client, model, messages, generation_config)
 
 async def zero_shot_lattice(hypotheses, client, model, generation_config):
     """ Perform ASR error correction using a lattice-based approach. """
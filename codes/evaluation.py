@@ -1,54 +1,197 @@
 from codes.utils import *
 from codes.ec_methods import *
+from codes.corpus import *
+from codes.nbest_store import *
+from codes.batch_mode import BatchRecorder, BatchRequestPending, BatchResults, batch_paths, process_batch_file, submit_batch, download_batch
 
 
-async def track_progress(tasks):
-    """Tracks progress while tasks are running."""
+def normalize_predictions(predictions: List[str], model: str) -> List[str]:
+    """ Strip reasoning traces of DeepSeek models and apply the evaluation text normalization."""
     
-    total_tasks = len(tasks)
-    while not all(task.done() for task in tasks):
-        completed = sum(task.done() for task in tasks)
-        print(f"Progress: {completed}/{total_tasks} tests completed!", end="\r")
-        await asyncio.sleep(0.1)
-    print(f"Progress: Batch of {total_tasks} tests completed!", flush=True)
-    return await asyncio.gather(*tasks)
+    if 'DeepSeek' in model:
+        predictions = [clean_deepseek_output(pred) for pred in predictions]
+    return [clean_asr_output(remove_punctuation(pred.lower())) for pred in predictions]
 
     
-async def process_batch(dataset: Dataset, indices: List[int], model: str, client: openai.AsyncOpenAI, postprocessing: Callable[[List[str]], str], generation_config: dict, few_shot: int, error_examples: List[str]) -> List[str]:
-    """Processes the dataset asynchronously using OpenAI API with progress tracking."""
+async def checkpointed(coroutine, checkpoint: RunCheckpoint, idx: int):
+    """Awaits one item and durably records its output before handing it back."""
     
-    tasks = []
-    for idx in indices:
-        hypotheses, reference = extract_hypotheses(dataset, idx)
-        if inspect.iscoroutinefunction(postprocessing):
-            if few_shot==0:
-                tasks.append(asyncio.create_task(postprocessing(hypotheses, client, model, generation_config)))
-            else:
-                tasks.append(asyncio.create_task(postprocessing(hypotheses, client, model, generation_config, few_shot, error_examples)))
+    output = await coroutine
+    checkpoint.save(idx, output)
+    return output
+
+
+async def attributed(coroutine, idx: int):
+    """Awaits one row's coroutine with current_item set, so per-request statistics (think tokens) are attributed to the row."""
+    
+    current_item.set(idx)
+    return await coroutine
+
+
+def item_coroutine(dataset: Dataset, idx: int, model: str, client: openai.AsyncOpenAI, postprocessing: Callable[[List[str]], str], generation_config: dict, few_shot: int, error_examples: List[str], checkpoint: RunCheckpoint=None):
+    """Builds the coroutine that produces the raw output of one row; with configure_token_budget, its max_tokens is derived from its hypotheses."""
+    
+    hypotheses, reference = extract_hypotheses(dataset, idx)
+    if inspect.iscoroutinefunction(postprocessing):
+        if get_token_budget() is not None:
+            generation_config = get_token_budget().apply(generation_config, hypotheses, model)
+        if few_shot==0:
+            coroutine = postprocessing(hypotheses, client, model, generation_config)
         else:
-            tasks.append(asyncio.create_task(asyncio.to_thread(postprocessing, hypotheses, reference)))
+            coroutine = postprocessing(hypotheses, client, model, generation_config, few_shot, error_examples)
+        if checkpoint is not None:
+            coroutine = checkpointed(coroutine, checkpoint, idx)
+        return attributed(coroutine, idx)
+    return asyncio.to_thread(postprocessing, hypotheses, reference)
+
+
+async def process_window(dataset: Dataset, indices: List[int], model: str, client: openai.AsyncOpenAI, postprocessing: Callable[[List[str]], str], generation_config: dict, few_shot: int, error_examples: List[str], checkpoint: RunCheckpoint=None, window: int=256):
+    """Processes the rows through a sliding window: a new row starts as soon as any of the `window` in-flight rows finishes.
     
-    results = await track_progress(tasks)
-    return results
+    Unlike fixed batches, one slow generation never idles the other slots. A row whose request fails for good gets an empty
+    output and is reported (and recorded in the checkpoint) instead of stopping the run.
+    Returns ({row: output}, {row: latency in seconds}, {row: error})."""
     
-async def evaluate_model_parallel(dataset: Dataset, model: str, client: openai.AsyncOpenAI, postprocessing: Callable[[List[str]], str], generation_config: dict, results_path: str, step: int=256, experimental=False, few_shot: int=0, error_examples: List[str]=None):
-    """Evaluates the model asynchronously with progress tracking, handling Jupyter compatibility."""
+    outputs, latencies, failures = {}, {}, {}
+    queue = iter(indices)
+    in_flight = {}
     
-    total_rows = len(dataset)
-    all_predictions = []
-    for start in range(0, total_rows, step):
-        end = min(start + step, total_rows)
-        batch_indices = list(range(start, end))
-        batch_predictions = await process_batch(dataset, batch_indices, model, client, postprocessing, generation_config, few_shot, error_examples)
-        all_predictions.extend(batch_predictions)
+    def refill():
+        while len(in_flight) < window:
+            idx = next(queue, None)
+            if idx is None:
+                break
+            coroutine = item_coroutine(dataset, idx, model, client, postprocessing, generation_config, few_shot, error_examples, checkpoint)
+            in_flight[asyncio.create_task(coroutine)] = (idx, time.perf_counter())
     
-    # Normalize for evaluation
-    if 'DeepSeek' in model:
-        all_predictions = [clean_deepseek_output(pred) for pred in all_predictions] 
-    all_predictions = [clean_asr_output(remove_punctuation(pred.lower())) for pred in all_predictions]
-    all_references = dataset['target'] if 'target' in dataset.features else dataset['output']
-    all_references = [clean_asr_output(remove_punctuation(ref.lower())) for ref in all_references]
+    try:
+        refill()
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, timeout=0.1, return_when=asyncio.FIRST_COMPLETED)
+            finished = time.perf_counter()
+            for task in done:
+                idx, started = in_flight.pop(task)
+                latencies[idx] = finished - started
+                try:
+                    outputs[idx] = task.result()
+                except LLMRequestError as e:
+                    outputs[idx] = ""
+                    failures[idx] = str(e)
+                    if checkpoint is not None:
+                        checkpoint.save_failure(idx, failures[idx])
+            refill()
+            print(f"Progress: {len(outputs)}/{len(indices)} tests completed, {len(failures)} failed, {len(in_flight)} in flight", end="\r")
+    finally:
+        # Any other error (or cancellation) ends the run: stop the rows still in flight instead of leaving them unobserved
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+    print(f"Progress: {len(outputs)}/{len(indices)} tests completed, {len(failures)} failed!" + " " * 20, flush=True)
+    return outputs, latencies, failures
+
+
+def report_failures(failures: dict, total: int):
+    """Prints how many rows failed and their most common errors."""
+    
+    if not failures:
+        return
+    print(f"WARNING: {len(failures)}/{total} rows failed and were scored as empty predictions")
+    for error, count in Counter(failures.values()).most_common(3):
+        print(f"  {count} x {error}")
+
+
+def report_latencies(latencies: dict):
+    """Prints the per-request latency distribution of a run."""
+    
+    if not latencies:
+        return
+    values = np.fromiter(latencies.values(), dtype=float)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    print(f"Latency: mean {values.mean():.2f}s, p50 {p50:.2f}s, p95 {p95:.2f}s, p99 {p99:.2f}s, max {values.max():.2f}s")
+    
+
+def stats_sources(client) -> dict:
+    """ The process-wide request statistics in use, by name: limiter, local backend, hedging, streaming, cache, token budget, reasoning."""
+
+    sources = {"limiter": request_limiter, "local": client if isinstance(client, LocalChatModel) else None,
+               "hedging": get_hedge_policy(), "streaming": get_streaming_mode() and get_streaming_mode().stats,
+               "cache": get_response_cache(), "token_budget": get_token_budget(), "reasoning": get_reasoning_mode() and get_reasoning_mode().stats}
+    return {name: source for name, source in sources.items() if source is not None}
+
+
+def stats_snapshot(client) -> dict:
+    """ Snapshot of every statistics source at the start of a run; the counters themselves are cumulative over the process."""
+
+    return {name: source.snapshot() for name, source in stats_sources(client).items()}
+
+
+def report_stats(client, model: str, since: dict):
+    """Prints the request statistics of one run: what every source counted since `since` (see stats_snapshot)."""
+
+    for name, source in stats_sources(client).items():
+        if name == "reasoning" and not is_reasoning_model(model):
+            continue
+        print(source.summary(since.get(name)))
+
+
+async def predict_corpus(corpus: NBestCorpus, indices: List[int], model: str, client: openai.AsyncOpenAI, postprocessing: Callable[[List[str]], str], generation_config: dict, step: int=256, few_shot: int=0, error_examples: List[str]=None, dedup: bool=True, checkpoint: RunCheckpoint=None) -> List[str]:
+    """Runs the strategy over the given rows, keeping `step` rows in flight, and returns normalized predictions in row order.
+    
+    With `dedup`, LLM strategies are called once per unique (normalized) N-best list and the result is fanned back out.
+    Reference-based strategies such as the oracle are never deduplicated.
+    With a `checkpoint`, rows it already holds are restored instead of re-requested and every new output is saved as it completes."""
+    
+    if dedup and inspect.iscoroutinefunction(postprocessing):
+        representatives, inverse = corpus.unique_indices(indices)
+        hits = len(inverse) - len(representatives)
+        print(f"Dedup: {len(representatives)} unique N-best lists for {len(inverse)} rows, hit rate {hits / max(len(inverse), 1):.1%}")
+        if hits:
+            unique_predictions = await predict_corpus(corpus, representatives, model, client, postprocessing, generation_config, step, few_shot, error_examples, dedup=False, checkpoint=checkpoint)
+            return [unique_predictions[group] for group in inverse]
+    
+    outputs = checkpoint.completed(indices) if checkpoint is not None else {}
+    if outputs:
+        print(f"Resuming: {len(outputs)}/{len(indices)} rows restored from checkpoint")
+    pending = [idx for idx in indices if idx not in outputs]
+    if pending and postprocessing in BATCHED_STRATEGIES:
+        # Reference-based strategies with a corpus-level version score all rows in one vectorized pass
+        hypotheses_lists, references = zip(*[extract_hypotheses(corpus, idx) for idx in pending])
+        outputs.update(zip(pending, BATCHED_STRATEGIES[postprocessing](hypotheses_lists, references)))
+    elif pending:
+        since = stats_snapshot(client)
+        new_outputs, latencies, failures = await process_window(corpus, pending, model, client, postprocessing, generation_config, few_shot, error_examples, checkpoint, window=step)
+        outputs.update(new_outputs)
+        if inspect.iscoroutinefunction(postprocessing):
+            report_failures(failures, len(pending))
+            report_latencies(latencies)
+            report_agreement()
+            report_prompt(postprocessing.__name__, extract_hypotheses(corpus, pending[0])[0], few_shot, error_examples)
+            report_stats(client, model, since)
+    return normalize_predictions([outputs[idx] for idx in indices], model)
+
+
+def compute_metrics(all_references: List[str], all_predictions: List[str], wer_scores: List[float]=None) -> dict:
+    """Computes the metrics table row; per-utterance WERs can be passed in when already computed elsewhere."""
+    
+    if wer_scores is None:
+        errors = word_errors(all_references, all_predictions)
+        wer_scores = errors.utterance_wer()
+        print(f"Corpus WER {errors.corpus_wer():.3f} ({int(errors.errors.sum())} errors / {int(errors.reference_words.sum())} reference words)")
+    wer_scores = np.array(wer_scores)
+    bertscore = compute_bertscore(all_predictions, all_references)
+    metrics = {
+        'WER': round(wer_scores.mean().item(), 3),
+        'METEOR': round(compute_meteor(all_predictions, all_references), 3),
+        'BERT Precision': round(bertscore['precision'], 3),
+        'BERT Recall': round(bertscore['recall'], 3),
+        'BERT F1': round(bertscore['f1'], 3),
+    }
+    return metrics
+
 
+def finalize_evaluation(dataset: Dataset, all_references: List[str], all_predictions: List[str], model: str, function_name: str, results_path: str, experimental=False, wer_scores: List[float]=None, export: bool=True) -> dict:
+    """Prints samples for review, saves the predictions and computes the metrics of a finished run."""
+    
     # Print 3 random results for manual review
     random_indices = random.sample(range(len(all_predictions)), 3)
     print("-" * 100)
@@ -59,42 +202,116 @@ async def evaluate_model_parallel(dataset: Dataset, model: str, client: openai.A
         print("-" * 100)
         
     if not experimental:
-        save_results(dataset, all_predictions, model, postprocessing.__name__, results_path)
+        save_results(dataset, all_predictions, model, function_name, results_path, export)
         
-    # Compute evaluation metrics
-    wer_scores = np.array([jiwer.wer(ref, pred) for ref, pred in zip(all_references, all_predictions)])
-    bertscore = compute_bertscore(all_predictions, all_references)
-    metrics = {
-        'WER': round(wer_scores.mean().item(), 3),
-        'METEOR': round(compute_meteor(all_predictions, all_references), 3),
-        'BERT Precision': round(bertscore['precision'], 3),
-        'BERT Recall': round(bertscore['recall'], 3),
-        'BERT F1': round(bertscore['f1'], 3),
-    }
+    return compute_metrics(all_references, all_predictions, wer_scores)
+
+
+async def render_batch_requests(corpus: NBestCorpus, indices: List[int], model: str, postprocessing: Callable[[List[str]], str], generation_config: dict, step: int=256, few_shot: int=0, error_examples: List[str]=None, dedup: bool=True) -> BatchRecorder:
+    """Runs the strategy against a BatchRecorder to collect every request it would send; with `dedup`, once per unique
+    N-best list, as predict_corpus will ask for them when the output is ingested."""
+    
+    recorder = BatchRecorder()
+    representatives = corpus.unique_indices(indices)[0] if dedup else list(indices)
+    for start in range(0, len(representatives), step):
+        coroutines = [item_coroutine(corpus, idx, model, recorder, postprocessing, generation_config, few_shot, error_examples) for idx in representatives[start:start + step]]
+        for result in await asyncio.gather(*coroutines, return_exceptions=True):
+            # Every recorded request fails with BatchRequestPending (wrapped in LLMRequestError); anything else is a real error
+            if isinstance(result, BaseException) and not isinstance(result.__cause__, BatchRequestPending):
+                raise result
+    return recorder
+
+
+async def evaluate_model_parallel(dataset: Dataset, model: str, client: openai.AsyncOpenAI, postprocessing: Callable[[List[str]], str], generation_config: dict, results_path: str, step: int=256, experimental=False, few_shot: int=0, error_examples: List[str]=None, dedup: bool=True, export: bool=True, resume: bool=True, batch_dir: str=None):
+    """Evaluates the model asynchronously with progress tracking, handling Jupyter compatibility.
+    
+    With `resume`, LLM outputs are checkpointed per item next to `results_path`; a rerun after a crash only requests the missing rows.
+    With `batch_dir`, LLM strategies run in offline batch mode: the first call writes every request to a JSONL batch input
+    file in `batch_dir` and returns None; once its output file exists (process_batch_file, or submit_batch/download_batch
+    for a provider batch API), the next call ingests it into predictions and metrics."""
+    
+    corpus = load_corpus(dataset)
+    if isinstance(dataset, str):
+        dataset = corpus
+    if batch_dir is not None and inspect.iscoroutinefunction(postprocessing):
+        requests_path, output_path = batch_paths(batch_dir, results_path, model, postprocessing.__name__)
+        if not os.path.exists(output_path):
+            recorder = await render_batch_requests(corpus, range(len(corpus)), model, postprocessing, generation_config, step, few_shot, error_examples, dedup)
+            print(f"Wrote {recorder.write(requests_path)} batch requests to {requests_path}; rerun once their output is in {output_path}")
+            return None
+        client, resume = BatchResults(output_path), False
+    checkpoint = open_checkpoint(results_path, model, postprocessing, generation_config, few_shot, error_examples) if resume else None
+    all_predictions = await predict_corpus(corpus, range(len(corpus)), model, client, postprocessing, generation_config, step, few_shot, error_examples, dedup, checkpoint)
+    if get_reasoning_mode() is not None and get_reasoning_mode().stats.records and results_path is not None:
+        get_reasoning_mode().stats.save(results_path.replace(".json", f"_{model.replace('/', '_')}_{postprocessing.__name__}_think_tokens.csv"))
+    all_references = corpus.normalized_references
+    metrics = finalize_evaluation(dataset, all_references, all_predictions, model, postprocessing.__name__, results_path, experimental, export=export)
+    close_checkpoint(checkpoint)
     return metrics
 
 
+def close_checkpoint(checkpoint: RunCheckpoint):
+    """Clears the checkpoint of a finished run, unless rows failed: those stay pending so rerunning retries only them. Closes its connection either way."""
+    
+    if checkpoint is None:
+        return
+    with checkpoint:
+        failures = checkpoint.failures()
+        if failures:
+            print(f"{len(failures)} failed rows kept in {checkpoint.db_path}; rerun the same evaluation to retry only those")
+        else:
+            checkpoint.clear()
+
+
+def open_checkpoint(results_path: str, model: str, postprocessing: Callable[[List[str]], str], generation_config: dict, few_shot: int=0, error_examples: List[str]=None) -> RunCheckpoint:
+    """Opens the per-item checkpoint of an LLM strategy run; cheap local strategies are not checkpointed."""
+    
+    if results_path is None or not inspect.iscoroutinefunction(postprocessing):
+        return None
+    if get_token_budget() is not None:
+        generation_config = {**generation_config, "token_budget": get_token_budget().signature()}
+    if get_reasoning_mode() is not None and is_reasoning_model(model):
+        generation_config = {**generation_config, "reasoning": get_reasoning_mode().signature()}
+    # Another layout sends other prompts; "original" keeps the checkpoints of runs from before layouts existed
+    if get_prompt_layout() != "original":
+        generation_config = {**generation_config, "prompt_layout": get_prompt_layout()}
+    return RunCheckpoint.for_results_path(results_path, model, postprocessing.__name__, generation_config,
+                                          few_shot=few_shot, error_examples=error_examples[:few_shot] if error_examples else None)
+
+
 async def run_evaluation(dataset, model, client, generation_config, results_path, disable_zsun=False, disable_zsco=False, disable_zscl=False):
+    # Retain generations for the whole run: Zero-shot Closest then reuses the Zero-shot Unconstrained outputs
+    since = request_coalescer.snapshot()
+    with request_coalescer.retain():
+        results_table = await evaluate_strategies(dataset, model, client, generation_config, results_path, disable_zsun, disable_zsco, disable_zscl)
+    print(request_coalescer.summary(since))
+    return results_table
+
+
+async def evaluate_strategies(dataset, model, client, generation_config, results_path, disable_zsun=False, disable_zsco=False, disable_zscl=False):
     metrics_zero_shot_unconstrained = None
     metrics_zero_shot_constrained = None
     metrics_zero_shot_closest = None
     if not disable_zsun:
         print("Evaluating Zero-shot Unconstrained:")
-        metrics_zero_shot_unconstrained = await evaluate_model_parallel(dataset, model, client, zero_shot_unconstrained, generation_config, results_path)
+        metrics_zero_shot_unconstrained = await evaluate_model_parallel(dataset, model, client, zero_shot_unconstrained, generation_config, results_path, export=False)
     
     if not disable_zsco:
         print("Evaluating Zero-shot Constrained:")
-        metrics_zero_shot_constrained = await evaluate_model_parallel(dataset, model, client, zero_shot_constrained, generation_config, results_path)
+        metrics_zero_shot_constrained = await evaluate_model_parallel(dataset, model, client, zero_shot_constrained, generation_config, results_path, export=False)
     
     if not disable_zscl:
         print("Evaluating Zero-shot Closest:")
-        metrics_zero_shot_closest = await evaluate_model_parallel(dataset, model, client, zero_shot_closest, generation_config, results_path)
+        metrics_zero_shot_closest = await evaluate_model_parallel(dataset, model, client, zero_shot_closest, generation_config, results_path, export=False)
     
     print("Evaluating Oracle:")
-    metrics_get_oracle_hypothesis = await evaluate_model_parallel(dataset, model, client, get_oracle_hypothesis, generation_config, results_path)
+    metrics_get_oracle_hypothesis = await evaluate_model_parallel(dataset, model, client, get_oracle_hypothesis, generation_config, results_path, export=False)
     
     print("Evaluating Top 1:")
-    metrics_get_top1_hypothesis = await evaluate_model_parallel(dataset, model, client, get_top1_hypothesis, generation_config, results_path)
+    metrics_get_top1_hypothesis = await evaluate_model_parallel(dataset, model, client, get_top1_hypothesis, generation_config, results_path, export=False)
+
+    # One wide JSON rewrite per run instead of one per strategy
+    export_results(load_corpus(dataset) if isinstance(dataset, str) else dataset, results_path)
 
     results_table = {
         "Top 1": metrics_get_top1_hypothesis,
@@ -0,0 +1,128 @@
+import time
+import asyncio
+from collections import deque
+
+import numpy as np
+
+from codes.endpoints import avoided_endpoints, routed_endpoints
+
+
+class HedgePolicy:
+    """ Request hedging: once a request has been outstanding longer than the `percentile` latency of the last `window`
+    requests to the same (model, endpoint), a duplicate is sent (to another replica of an EndpointPool when there is
+    one); the first success wins and the other is cancelled. Hedging needs `min_samples` latencies first and stops while
+    more than `max_rate` of the requests were hedged, which caps the extra cost."""
+
+    def __init__(self, percentile: float=95.0, min_samples: int=20, max_rate: float=0.1, window: int=1000):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_rate = max_rate
+        self.window = window
+        self.latencies = {}
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "cancelled": 0, "extra_tokens": 0}
+
+    def record(self, key, latency: float):
+        if key not in self.latencies:
+            self.latencies[key] = deque(maxlen=self.window)
+        self.latencies[key].append(latency)
+
+    def delay(self, key) -> float:
+        """ Seconds to wait before hedging a request, or None when it must not be hedged."""
+
+        latencies = self.latencies.get(key)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+        if self.stats["hedged"] >= self.max_rate * max(self.stats["requests"], 1):
+            return None
+        return float(np.percentile(latencies, self.percentile))
+
+    def snapshot(self) -> dict:
+        """ Copy of the counters; summary(since=snapshot) then reports only what happened after it."""
+
+        return dict(self.stats)
+
+    def summary(self, since: dict=None) -> str:
+        stats = self.stats if since is None else {key: value - since.get(key, 0) for key, value in self.stats.items()}
+        requests = max(stats["requests"], 1)
+        return (f"Hedging: {stats['hedged']}/{stats['requests']} requests hedged ({stats['hedged'] / requests:.1%}), "
+                f"{stats['hedge_wins']} won by the hedge, {stats['cancelled']} cancelled, "
+                f"~{stats['extra_tokens']} extra tokens")
+
+
+class _Attempt:
+    """ One copy of a hedged request; `sent` is set once it leaves the request limiter."""
+
+    def __init__(self):
+        self.sent = asyncio.Event()
+        self.sent_at = None
+
+    def mark_sent(self):
+        self.sent_at = time.monotonic()
+        self.sent.set()
+
+
+async def _routed(send, attempt: _Attempt, route: list, avoid=()):
+    # Runs in its own task, so the context variables only steer this copy of the request
+    routed_endpoints.set(route)
+    avoided_endpoints.set(tuple(avoid))
+    result = await send(attempt.mark_sent)
+    return result, time.monotonic() - (attempt.sent_at or time.monotonic())
+
+
+async def hedged(send, policy: HedgePolicy, key, estimated_tokens: int=0):
+    """ Await `send(on_sent)`, a coroutine function performing one request that calls `on_sent()` once it leaves the
+    request limiter, hedging it according to `policy`. The hedge delay runs from that moment, so time spent queueing
+    in the limiter never triggers a hedge."""
+
+    policy.stats["requests"] += 1
+    route = []
+    attempt = _Attempt()
+    primary = asyncio.ensure_future(_routed(send, attempt, route))
+    tasks = [primary]
+    try:
+        sent = asyncio.ensure_future(attempt.sent.wait())
+        await asyncio.wait([primary, sent], return_when=asyncio.FIRST_COMPLETED)
+        sent.cancel()
+        delay = policy.delay(key)
+        if delay is not None and not primary.done():
+            await asyncio.wait([primary], timeout=delay)
+            if not primary.done():
+                policy.stats["hedged"] += 1
+                policy.stats["extra_tokens"] += estimated_tokens
+                tasks.append(asyncio.ensure_future(_routed(send, _Attempt(), [], avoid=route)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    result, latency = task.result()
+                    policy.record(key, latency)
+                    if task is not primary:
+                        policy.stats["hedge_wins"] += 1
+                    return result
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                policy.stats["cancelled"] += 1
+        # Let the losers release their limiter slots and connections before returning
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Off by default: requests are not hedged until configure_hedging is called
+hedge_policy = None
+
+
+def configure_hedging(enabled: bool=True, percentile: float=95.0, min_samples: int=20, max_rate: float=0.1, window: int=1000) -> HedgePolicy:
+    """ Hedge requests slower than the `percentile` latency (see HedgePolicy)."""
+
+    global hedge_policy
+    hedge_policy = HedgePolicy(percentile, min_samples, max_rate, window) if enabled else None
+    return hedge_policy
+
+
+def get_hedge_policy() -> HedgePolicy:
+    return hedge_policy
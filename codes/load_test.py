@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+from contextlib import contextmanager, nullcontext
+
+import httpx
+import pandas as pd
+from datasets import Dataset
+
+import codes.evaluation as evaluation
+from codes.evaluation import evaluate_model_parallel, run_evaluation
+from codes.endpoints import EndpointPool
+from codes.rate_limit import configure_rate_limits
+from codes.ec_methods import zero_shot_unconstrained
+
+
+def rss_mb() -> float:
+    """ Current resident memory of this process in MB (peak so far where /proc is unavailable)."""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class ResourceSampler:
+    """ Samples resident memory and event loop lag (how late a short sleep wakes up) every `interval` seconds while
+    a run is in progress; the client CPU time is read from the process counters around the run."""
+
+    def __init__(self, interval: float=0.05):
+        self.interval = interval
+        self.peak_rss = 0.0
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.max_lag = max(self.max_lag, loop.time() - start - self.interval)
+            self.peak_rss = max(self.peak_rss, rss_mb())
+
+    def __enter__(self):
+        self.peak_rss = rss_mb()
+        self.cpu_start, self.wall_start = time.process_time(), time.perf_counter()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.cpu = time.process_time() - self.cpu_start
+        self.wall = time.perf_counter() - self.wall_start
+        self.peak_rss = max(self.peak_rss, rss_mb())
+
+
+@contextmanager
+def without_bertscore():
+    """ Skip the BERTScore model in compute_metrics (zeros instead), so the load test measures the pipeline, not the scorer."""
+
+    original = evaluation.compute_bertscore
+    evaluation.compute_bertscore = lambda references, hypotheses: {"precision": 0.0, "recall": 0.0, "f1": 0.0}
+    try:
+        yield
+    finally:
+        evaluation.compute_bertscore = original
+
+
+def start_mock_server(port: int, server_args=()) -> subprocess.Popen:
+    """ Start codes.mock_server in a child process, so its CPU and memory are not counted as the client's."""
+
+    return subprocess.Popen([sys.executable, "-m", "codes.mock_server", "--port", str(port), *server_args],
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+async def wait_for_server(base_url: str, timeout: float=30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while True:
+            try:
+                (await http.get(f"{base_url}/models")).raise_for_status()
+                return
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def server_stats(base_url: str, reset_peak: bool=False) -> dict:
+    """ The mock server's counters; `reset_peak` restarts its max_in_flight, so the next read is the peak since this one."""
+
+    async with httpx.AsyncClient() as http:
+        return (await http.get(base_url.rsplit("/v1", 1)[0] + "/mock/stats", params={"reset_peak": 1} if reset_peak else None)).json()
+
+
+async def load_test(dataset: Dataset, base_url: str, concurrency_levels=(1, 8, 64, 256), entry_point: str="evaluate_model_parallel",
+                    postprocessing=zero_shot_unconstrained, model: str="mock", generation_config: dict=None, results_dir: str=None,
+                    bertscore: bool=False) -> pd.DataFrame:
+    """ Run `entry_point` ("evaluate_model_parallel" with `postprocessing`, or "run_evaluation") against the
+    OpenAI-compatible server at `base_url` once per concurrency level (request limiter cap and item window), each
+    into fresh results files under `results_dir` (a new subdirectory per level, so rerunning into the same directory never
+    replays checkpointed outputs), and tabulate throughput, client CPU, peak memory and loop lag."""
+
+    generation_config = generation_config or {"max_tokens": 20, "temperature": 0.9}
+    results_dir = results_dir or tempfile.mkdtemp(prefix="load_test_")
+    client = EndpointPool({"*": [base_url]}, max_connections=max(concurrency_levels))
+    rows = []
+    with nullcontext() if bertscore else without_bertscore():
+        for concurrency in concurrency_levels:
+            configure_rate_limits(max_concurrency=concurrency, adaptive=None)
+            # A new directory per level and run: a checkpoint left by an earlier run would be replayed instead of requested
+            os.makedirs(results_dir, exist_ok=True)
+            results_path = os.path.join(tempfile.mkdtemp(prefix=f"c{concurrency}_", dir=results_dir), "test_load.json")
+            before = await server_stats(base_url, reset_peak=True)
+            with ResourceSampler() as usage:
+                if entry_point == "run_evaluation":
+                    await run_evaluation(dataset, model, client, generation_config, results_path)
+                else:
+                    await evaluate_model_parallel(dataset, model, client, postprocessing, generation_config, results_path, step=concurrency, resume=False)
+            after = await server_stats(base_url)
+            requests = after["requests"] - before["requests"]
+            rows.append({
+                "entry point": entry_point,
+                "concurrency": concurrency,
+                "items": len(dataset),
+                "wall s": round(usage.wall, 2),
+                "items/s": round(len(dataset) / usage.wall, 1),
+                "requests/s": round(requests / usage.wall, 1),
+                "client CPU s": round(usage.cpu, 2),
+                "client CPU %": round(100 * usage.cpu / usage.wall, 1),
+                "CPU ms/request": round(1000 * usage.cpu / max(requests, 1), 2),
+                "peak RSS MB": round(usage.peak_rss, 1),
+                "max loop lag ms": round(1000 * usage.max_lag, 1),
+                "429s": after["rate_limited"] - before["rate_limited"],
+                "500s": after["errors"] - before["errors"],
+                "cancelled streams": after["cancelled"] - before["cancelled"],
+                "server max in flight": after["max_in_flight"],
+            })
+    await client.close()
+    return pd.DataFrame(rows)
+
+
+async def main(args):
+    df = pd.read_json(args.dataset)
+    dataset = Dataset.from_pandas(df.iloc[:args.limit] if args.limit else df)
+    base_url = args.base_url
+    server = None
+    if base_url is None:
+        server = start_mock_server(args.port, args.server_args)
+        base_url = f"http://127.0.0.1:{args.port}/v1"
+    try:
+        await wait_for_server(base_url)
+        table = await load_test(dataset, base_url, args.concurrency, args.entry_point, results_dir=args.results_dir, bertscore=args.bertscore)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print(table.to_string(index=False))
+    if args.output:
+        table.to_csv(args.output, index=False)
+        print(f"Load test table saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the evaluation pipeline against a mock OpenAI-compatible server.")
+    parser.add_argument("--dataset", default="data/test_cv.json", help="N-best JSON test set")
+    parser.add_argument("--limit", type=int, help="Only use the first LIMIT rows")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64, 256])
+    parser.add_argument("--entry-point", choices=["evaluate_model_parallel", "run_evaluation"], default="evaluate_model_parallel")
+    parser.add_argument("--base-url", help="Existing server to test instead of starting codes.mock_server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--results-dir", help="Directory of the per-level results files (default: a temporary directory)")
+    parser.add_argument("--bertscore", action="store_true", help="Include the BERTScore model in the metrics")
+    parser.add_argument("--output", help="Also save the table as CSV")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="Arguments for codes.mock_server after --, e.g. -- --latency fixed:0.05 --error-rate 0.01")
+    args = parser.parse_args()
+    if args.server_args[:1] == ["--"]:
+        args.server_args = args.server_args[1:]
+    asyncio.run(main(args))
@@ -0,0 +1,246 @@
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+from codes.rate_limit import TokenBucket
+from codes.response_cache import ResponseCache, request_key
+from codes.token_budget import is_reasoning_model
+
+
+def latency_sampler(spec: str):
+    """ Latency distribution from a spec: "fixed:S", "uniform:LOW,HIGH", "exponential:MEAN" or "lognormal:MEDIAN,SIGMA"
+    (seconds). Returns a function drawing one latency from a random.Random."""
+
+    name, _, args = spec.partition(":")
+    params = [float(arg) for arg in args.split(",") if arg]
+    if name == "fixed":
+        return lambda rng: params[0]
+    if name == "uniform":
+        return lambda rng: rng.uniform(params[0], params[1])
+    if name == "exponential":
+        return lambda rng: rng.expovariate(1 / params[0])
+    if name == "lognormal":
+        return lambda rng: params[0] * rng.lognormvariate(0, params[1])
+    raise ValueError(f"Unknown latency distribution {spec!r}; use fixed, uniform, exponential or lognormal")
+
+
+def count_tokens(text: str) -> int:
+    """ Whitespace token count, a stand-in for the real tokenizer in usage and token-rate accounting."""
+
+    return len(text.split())
+
+
+def split_tokens(text: str):
+    """ The whitespace tokens of count_tokens, each with the whitespace before it, so streams keep line breaks."""
+
+    return re.findall(r"\s*\S+", text)
+
+
+class MockLLMServer:
+    """ Local stand-in for an OpenAI-compatible chat completions server, so the pipeline's own overhead can be measured
+    without a model. Every request waits a latency drawn from `latency` plus, with `tokens_per_second`, the decoding
+    time of its completion. `error_rate` and `rate_limit_rate` inject 500s and 429s (with retry-after), and with
+    `tokens_per_minute` the server answers 429 with x-ratelimit-* headers once its token budget is spent.
+
+    The answer to a prompt (the last user message) comes from `responses` (prompt -> answer), else from the `replay`
+    response cache (same request_key as the client), else the top hypothesis of the prompt is echoed. With
+    `think_tokens`, answers of models named like reasoning models start with a <think> span of exponentially
+    distributed length (that mean); a request continuing an assistant message (continue_final_message) gets the
+    answer alone."""
+
+    def __init__(self, latency: str="lognormal:0.2,0.5", error_rate: float=0.0, rate_limit_rate: float=0.0,
+                 tokens_per_second: float=None, tokens_per_minute: float=None, responses: dict=None, replay: str=None, seed: int=0, think_tokens: int=0):
+        self.latency = latency_sampler(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.tokens_per_second = tokens_per_second
+        self.budget = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.responses = responses or {}
+        self.replay = ResponseCache(replay) if replay else None
+        self.rng = random.Random(seed)
+        self.think_tokens = think_tokens
+        self.stats = {"requests": 0, "completed": 0, "errors": 0, "rate_limited": 0, "completion_tokens": 0, "cancelled": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def load_responses(self, path: str):
+        """ Add canned answers from a JSON object {prompt: answer} or JSONL lines {"prompt": ..., "response": ...}."""
+
+        with open(path) as f:
+            if path.endswith(".jsonl"):
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.responses[record["prompt"]] = record["response"]
+            else:
+                self.responses.update(json.load(f))
+
+    def answers(self, model: str, messages, generation_config: dict, n: int):
+        # The last user message holding hypotheses, as follow-up turns (e.g. "answer now") carry none
+        prompts = [message["content"] for message in messages if message["role"] == "user"] or [messages[-1]["content"]]
+        prompt = next((prompt for prompt in reversed(prompts) if "<hypothesis" in prompt), prompts[-1])
+        if prompt in self.responses:
+            return [self.responses[prompt]] * n
+        if self.replay is not None:
+            outputs = self.replay.get(request_key(model, messages, generation_config))
+            if outputs:
+                return (outputs * n)[:n]
+        # The top hypothesis of the last N-best list in the prompt, after any in-context examples
+        tagged = re.findall(r"<hypothesis(\d+)>(.*?)</hypothesis\1>", prompt, re.DOTALL)
+        if not tagged:
+            return [prompt.strip().splitlines()[-1]] * n
+        top = min(int(index) for index, _ in tagged)
+        return [[text.strip() for index, text in tagged if int(index) == top][-1]] * n
+
+    def think_span(self) -> str:
+        return "<think>\n" + " ".join(["hmm"] * int(self.rng.expovariate(1 / self.think_tokens))) + "\n</think>\n\n"
+
+    def _error(self, status: int, message: str, headers: dict=None):
+        return web.json_response({"error": {"message": message, "type": "mock_error", "code": status}}, status=status, headers=headers)
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats["requests"] += 1
+        model, messages, stream = body.pop("model"), body.pop("messages"), body.pop("stream", False)
+        body.pop("stream_options", None)
+        n = body.get("n", 1)
+        max_tokens = body.get("max_tokens")
+        draw = self.rng.random()
+        if draw < self.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            return self._error(429, "Injected rate limit", {"retry-after-ms": "200"})
+        if draw < self.rate_limit_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return self._error(500, "Injected server error")
+
+        answers = self.answers(model, messages, body, n)
+        if self.think_tokens and is_reasoning_model(model) and messages[-1]["role"] == "user":
+            answers = [self.think_span() + answer for answer in answers]
+        if max_tokens:
+            answers = ["".join(split_tokens(answer)[:max_tokens]) for answer in answers]
+        prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+        completion_tokens = sum(count_tokens(answer) for answer in answers)
+        if self.budget is not None:
+            wait = self.budget.wait_time(prompt_tokens + completion_tokens)
+            if wait > 0:
+                self.stats["rate_limited"] += 1
+                return self._error(429, "Token budget exceeded", {"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": f"{wait:.3f}s"})
+            self.budget.consume(prompt_tokens + completion_tokens)
+
+        self.stats["in_flight"] += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+        try:
+            await asyncio.sleep(self.latency(self.rng))
+            decode_time = completion_tokens / n / self.tokens_per_second if self.tokens_per_second else 0.0
+            created = int(time.time())
+            completion_id = f"chatcmpl-mock-{self.stats['requests']}"
+            finish_reason = lambda answer: "length" if max_tokens and count_tokens(answer) >= max_tokens else "stop"
+            if stream:
+                return await self._stream(request, completion_id, created, model, answers, decode_time, finish_reason)
+            await asyncio.sleep(decode_time)
+            self.stats["completed"] += 1
+            self.stats["completion_tokens"] += completion_tokens
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": i, "finish_reason": finish_reason(answer), "message": {"role": "assistant", "content": answer}}
+                            for i, answer in enumerate(answers)],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+            })
+        finally:
+            self.stats["in_flight"] -= 1
+
+    async def _stream(self, request, completion_id, created, model, answers, decode_time, finish_reason):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        words = [split_tokens(answer) for answer in answers]
+        steps = max(len(tokens) for tokens in words) if words else 0
+        try:
+            await response.prepare(request)
+            for step in range(steps + 1):
+                choices = []
+                for i, tokens in enumerate(words):
+                    if step < len(tokens):
+                        choices.append({"index": i, "delta": {"content": tokens[step]}, "finish_reason": None})
+                    elif step == len(tokens):
+                        choices.append({"index": i, "delta": {}, "finish_reason": finish_reason(answers[i])})
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model, "choices": choices}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                if step < steps:
+                    self.stats["completion_tokens"] += sum(step < len(tokens) for tokens in words)
+                    await asyncio.sleep(decode_time / max(steps, 1))
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # The client went away (streaming early stop, cancelled hedge): nothing more is generated
+            self.stats["cancelled"] += 1
+            return response
+        self.stats["completed"] += 1
+        return response
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": [{"id": "mock", "object": "model", "created": 0, "owned_by": "mock"}]})
+
+    async def stats_handler(self, request: web.Request) -> web.Response:
+        """ The counters; with ?reset_peak=1, max_in_flight then restarts from the current in_flight, so a load test can
+        read the peak of each concurrency level."""
+
+        stats = dict(self.stats)
+        if request.query.get("reset_peak"):
+            self.stats["max_in_flight"] = self.stats["in_flight"]
+        return web.json_response(stats)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 << 20)
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_get("/mock/stats", self.stats_handler)
+        return app
+
+    async def start(self, host: str="127.0.0.1", port: int=8000) -> web.AppRunner:
+        """ Serve in the running event loop; stop with `await runner.cleanup()`."""
+
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port, backlog=4096).start()
+        return runner
+
+    def summary(self) -> str:
+        return (f"Mock server: {self.stats['requests']} requests, {self.stats['completed']} completed, "
+                f"{self.stats['errors']} injected errors, {self.stats['rate_limited']} rate limited, {self.stats['cancelled']} cancelled streams, "
+                f"{self.stats['completion_tokens']} completion tokens, max {self.stats['max_in_flight']} in flight")
+
+
+async def serve(server: MockLLMServer, host: str="127.0.0.1", port: int=8000, report_every: float=10.0):
+    """ Run the server until cancelled, printing its summary every `report_every` seconds."""
+
+    runner = await server.start(host, port)
+    print(f"Mock LLM server listening on http://{host}:{port}/v1", flush=True)
+    try:
+        while True:
+            await asyncio.sleep(report_every)
+            print(server.summary(), flush=True)
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock chat completions server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="lognormal:0.2,0.5", help='fixed:S, uniform:LOW,HIGH, exponential:MEAN or lognormal:MEDIAN,SIGMA')
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--tokens-per-second", type=float, help="Decoding speed of every request")
+    parser.add_argument("--tokens-per-minute", type=float, help="Server-wide token budget; 429 once it is spent")
+    parser.add_argument("--responses", help="Canned answers: JSON {prompt: answer} or JSONL {prompt, response}")
+    parser.add_argument("--replay", help="Response cache database whose outputs are replayed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--think-tokens", type=int, default=0, help="Mean length of the <think> span of reasoning models (DeepSeek* names)")
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.latency, args.error_rate, args.rate_limit_rate, args.tokens_per_second, args.tokens_per_minute,
+                           replay=args.replay, seed=args.seed, think_tokens=args.think_tokens)
+    if args.responses:
+        server.load_responses(args.responses)
+    asyncio.run(serve(server, args.host, args.port))
@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import glob
+import argparse
+import numpy as np
+from datasets import Dataset
+
+from codes.corpus import NBestCorpus, NBestRecord, split_source_hypotheses
+from codes.utils import preprocess
+
+
+# Columnar on-disk layout (one directory per dataset):
+#   meta.json                          row/hypothesis counts, format version, optional vocabulary size
+#   row_offsets.npy                    int64 [num_rows + 1], row i owns hypotheses row_offsets[i]:row_offsets[i+1]
+#   {column}_offsets.npy / _buffer.npy int64 offsets + uint8 UTF-8 buffer for each string column
+#   {column}_token_offsets.npy / _token_ids.npy   optional interned word IDs of the normalized columns
+#   vocab.json                         optional word list, position = token ID
+# Every array is loaded with mmap_mode='r', so worker processes share the page cache instead of copying.
+STORE_VERSION = 1
+STRING_COLUMNS = ["hyps", "norm_hyps", "refs", "norm_refs"]
+TOKEN_COLUMNS = {"norm_hyps": "hyp", "norm_refs": "ref"}
+
+
+def _read_json_rows(file_path):
+    with open(file_path) as f:
+        rows = json.load(f)
+    all_hypotheses, all_references = [], []
+    for row in rows:
+        if 'source' in row:
+            all_hypotheses.append(split_source_hypotheses(row['source']))
+            all_references.append(row['target'])
+        else:
+            all_hypotheses.append(row['input'])
+            all_references.append(row['output'])
+    return all_hypotheses, all_references
+
+
+def _write_strings(out_dir, column, strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    np.save(os.path.join(out_dir, f"{column}_offsets.npy"), offsets)
+    np.save(os.path.join(out_dir, f"{column}_buffer.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+
+def _write_tokens(out_dir, prefix, strings, vocab):
+    ids = [[vocab.setdefault(word, len(vocab)) for word in s.split()] for s in strings]
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in ids], out=offsets[1:])
+    np.save(os.path.join(out_dir, f"{prefix}_token_offsets.npy"), offsets)
+    np.save(os.path.join(out_dir, f"{prefix}_token_ids.npy"), np.fromiter((t for row in ids for t in row), dtype=np.int32, count=int(offsets[-1])))
+
+
+def convert_to_columnar(file_path: str, out_dir: str, intern_tokens: bool=False):
+    """ Convert a data/test_*.json file (or a Dataset / NBestCorpus) into the memory-mappable columnar layout."""
+
+    if isinstance(file_path, str):
+        all_hypotheses, all_references = _read_json_rows(file_path)
+    else:
+        corpus = NBestCorpus.from_dataset(file_path)
+        all_hypotheses = [record.hypotheses for record in corpus]
+        all_references = [record.reference for record in corpus]
+
+    os.makedirs(out_dir, exist_ok=True)
+    flat_hypotheses = [h for hyps in all_hypotheses for h in hyps]
+    row_offsets = np.zeros(len(all_hypotheses) + 1, dtype=np.int64)
+    np.cumsum([len(hyps) for hyps in all_hypotheses], out=row_offsets[1:])
+    np.save(os.path.join(out_dir, "row_offsets.npy"), row_offsets)
+
+    columns = {
+        "hyps": flat_hypotheses,
+        "norm_hyps": [preprocess(h) for h in flat_hypotheses],
+        "refs": all_references,
+        "norm_refs": [preprocess(r) for r in all_references],
+    }
+    for column, strings in columns.items():
+        _write_strings(out_dir, column, strings)
+
+    meta = {"version": STORE_VERSION, "num_rows": len(all_hypotheses), "num_hypotheses": len(flat_hypotheses), "vocab_size": None}
+    if intern_tokens:
+        vocab = {}
+        for column, prefix in TOKEN_COLUMNS.items():
+            _write_tokens(out_dir, prefix, columns[column], vocab)
+        with open(os.path.join(out_dir, "vocab.json"), "w") as f:
+            json.dump(list(vocab), f)
+        meta["vocab_size"] = len(vocab)
+
+    # meta.json is written last, so a directory without it is an interrupted conversion
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    print(f"Converted {meta['num_rows']} rows to {out_dir}")
+    return out_dir
+
+
+class _MappedColumns:
+    """ Read-only views over the memory-mapped arrays of one columnar store."""
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != STORE_VERSION:
+            raise ValueError(f"Unsupported N-best store version {self.meta['version']} in {store_dir}")
+
+        load = lambda name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r")
+        self.row_offsets = load("row_offsets")
+        self.strings = {column: (load(f"{column}_offsets"), load(f"{column}_buffer")) for column in STRING_COLUMNS}
+        self.tokens = None
+        self.vocab = None
+        if self.meta["vocab_size"] is not None:
+            self.tokens = {prefix: (load(f"{prefix}_token_offsets"), load(f"{prefix}_token_ids")) for prefix in TOKEN_COLUMNS.values()}
+            with open(os.path.join(store_dir, "vocab.json")) as f:
+                self.vocab = json.load(f)
+
+    def string(self, column, i):
+        offsets, buffer = self.strings[column]
+        return buffer[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+
+    def token_ids(self, prefix, i):
+        offsets, ids = self.tokens[prefix]
+        return ids[offsets[i]:offsets[i + 1]]
+
+    def record(self, row):
+        start, end = int(self.row_offsets[row]), int(self.row_offsets[row + 1])
+        return NBestRecord(tuple(self.string("hyps", i) for i in range(start, end)),
+                           self.string("refs", row),
+                           tuple(self.string("norm_hyps", i) for i in range(start, end)),
+                           self.string("norm_refs", row))
+
+
+class _MappedRecords:
+    """ Lazy sequence of NBestRecords decoded on access from the mapped columns."""
+
+    def __init__(self, columns: _MappedColumns, rows: range):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return _MappedRecords(self.columns, self.rows[idx])
+        return self.columns.record(self.rows[idx])
+
+    def __iter__(self):
+        return (self.columns.record(row) for row in self.rows)
+
+
+class MappedNBestCorpus(NBestCorpus):
+    """ NBestCorpus backed by a memory-mapped columnar store; records are decoded lazily and never copied into RAM as a whole."""
+
+    def __init__(self, store_dir: str, columns: _MappedColumns=None, rows: range=None):
+        self.store_dir = store_dir
+        self.columns = columns if columns is not None else _MappedColumns(store_dir)
+        rows = rows if rows is not None else range(self.columns.meta["num_rows"])
+        super().__init__(_MappedRecords(self.columns, rows))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return MappedNBestCorpus(self.store_dir, self.columns, self.records.rows[idx])
+        return self.records[idx]
+
+    @property
+    def normalized_references(self):
+        return [self.columns.string("norm_refs", row) for row in self.records.rows]
+
+    @property
+    def vocab(self):
+        return self.columns.vocab
+
+    def reference_token_ids(self, idx):
+        """ Interned word IDs of the normalized reference (requires a store converted with intern_tokens=True)."""
+
+        return self.columns.token_ids("ref", self.records.rows[idx])
+
+    def hypothesis_token_ids(self, idx):
+        """ Interned word IDs of each normalized hypothesis of a row."""
+
+        row = self.records.rows[idx]
+        start, end = int(self.columns.row_offsets[row]), int(self.columns.row_offsets[row + 1])
+        return [self.columns.token_ids("hyp", i) for i in range(start, end)]
+
+
+def is_columnar_store(path):
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, "meta.json"))
+
+
+def load_corpus(source):
+    """ Load an evaluation corpus from a Dataset, an NBestCorpus, a JSON file or a columnar store directory."""
+
+    if isinstance(source, NBestCorpus):
+        return source
+    if isinstance(source, Dataset):
+        return NBestCorpus.from_dataset(source)
+    if is_columnar_store(source):
+        return MappedNBestCorpus(source)
+    return NBestCorpus.from_json(source)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert N-best JSON test sets into the memory-mapped columnar format.")
+    parser.add_argument("inputs", nargs="+", help="JSON files or glob patterns, e.g. data/test_*.json")
+    parser.add_argument("--out", default="data/columnar", help="Directory that receives one store per input file")
+    parser.add_argument("--intern-tokens", action="store_true", help="Also store interned word IDs of the normalized text")
+    args = parser.parse_args()
+
+    paths = sorted({p for pattern in args.inputs for p in glob.glob(pattern)})
+    if not paths:
+        sys.exit(f"No input files matched {args.inputs}")
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        convert_to_columnar(path, os.path.join(args.out, name), intern_tokens=args.intern_tokens)
@@ -0,0 +1,85 @@
+from transformers import AutoTokenizer
+
+
+PROMPT_LAYOUTS = ("original", "prefix")
+
+
+def hypotheses_block(hypotheses, start: int=0) -> str:
+    """ The N-best list as <hypothesisI>...</hypothesisI> lines, numbered from `start`."""
+
+    return "".join("<hypothesis" + str(idx) + ">" + hypothesis + "</hypothesis" + str(idx) + ">\n" for idx, hypothesis in enumerate(hypotheses, start))
+
+
+class PromptTemplate:
+    """ A strategy's chat prompt, compiled once into the part shared by every item and the part that is not.
+
+    The `history` turns and the `head` of the final user message are the static prefix; `item(hypotheses)` renders
+    the per-item part and `tail` is static text after it. Servers with prefix (KV) caching only reuse the prompt up
+    to the first per-item token, so the tail is prefilled again on every request. In the "prefix" layout a template
+    with a `hoisted_tail` (the tail reworded to precede the hypotheses) moves it in front of the head, leaving only
+    the hypotheses as suffix; templates without one, e.g. a short answer cue, keep their tail in place. The
+    "original" layout renders the prompts exactly as before, so cached responses and checkpoints stay valid."""
+
+    def __init__(self, head: str, tail: str="", history=(), item=hypotheses_block, hoisted_tail: str=None):
+        self.head = head
+        self.tail = tail
+        self.history = tuple(history)
+        self.item = item
+        self.hoisted_tail = hoisted_tail
+
+    def parts(self, layout: str=None):
+        """ (static text before the item, static text after it) of the final user message."""
+
+        if (layout or prompt_layout) == "prefix" and self.hoisted_tail is not None:
+            return self.hoisted_tail + self.head, ""
+        return self.head, self.tail
+
+    def render(self, hypotheses, layout: str=None):
+        prefix, tail = self.parts(layout)
+        return list(self.history) + [{"role": "user", "content": prefix + self.item(hypotheses) + tail}]
+
+    def token_counts(self, hypotheses, tokenizer=None, layout: str=None) -> dict:
+        """ Tokens of the static prefix and of the per-item suffix of one item's prompt, with the chat template when
+        the tokenizer has one; without a tokenizer, estimated at ~4 characters per token like estimate_request_tokens."""
+
+        prompt = _encode(self.render(hypotheses, layout), tokenizer)
+        # The prefix is whatever the prompt shares with the prompt of any other item
+        other = _encode(self.render(["#"] * len(hypotheses), layout), tokenizer)
+        shared = next((i for i, (a, b) in enumerate(zip(prompt, other)) if a != b), min(len(prompt), len(other)))
+        scale = 1 if tokenizer is not None else 4
+        return {"prefix": shared // scale, "suffix": (len(prompt) - shared) // scale, "total": len(prompt) // scale}
+
+
+def _encode(messages, tokenizer):
+    if tokenizer is None:
+        return "".join(message["role"] + message["content"] for message in messages)
+    if getattr(tokenizer, "chat_template", None):
+        return tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True, return_dict=False)
+    return tokenizer.encode("\n".join(message["content"] for message in messages))
+
+
+# "original" until configure_prompt_layout is called
+prompt_layout = "original"
+prompt_tokenizer = None
+
+
+def configure_prompt_layout(layout: str="prefix", tokenizer=None):
+    """ Render every templated prompt in `layout` ("original" or "prefix", see PromptTemplate). `tokenizer` (a
+    tokenizer or a Hugging Face model id) is used for the prompt token counts printed per run."""
+
+    global prompt_layout, prompt_tokenizer
+    if layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"Unknown prompt layout {layout!r}; use one of {PROMPT_LAYOUTS}")
+    prompt_layout = layout
+    prompt_tokenizer = AutoTokenizer.from_pretrained(tokenizer) if isinstance(tokenizer, str) else tokenizer
+
+
+def get_prompt_layout() -> str:
+    return prompt_layout
+
+
+def describe_prompt(template: PromptTemplate, hypotheses) -> str:
+    counts = template.token_counts(hypotheses, prompt_tokenizer)
+    unit = "tokens" if prompt_tokenizer is not None else "tokens (estimated)"
+    return (f"Prompt ({prompt_layout} layout): {counts['prefix']} static prefix + {counts['suffix']} per-item {unit}, "
+            f"{counts['prefix'] / max(counts['total'], 1):.0%} reusable by server-side prefix caching")
@@ -0,0 +1,327 @@
+import re
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+import openai
+
+
+# Errors signalling that the endpoint is overloaded, as opposed to a bad request
+OVERLOAD_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APITimeoutError)
+
+
+class TokenBucket:
+    """ Token bucket refilled continuously at `rate_per_minute`, holding at most `capacity` (defaults to one minute of budget)."""
+
+    def __init__(self, rate_per_minute: float, capacity: float=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # Requests larger than the bucket are let through once the bucket is full, rather than never
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def refund(self, amount: float):
+        """ Return (or with a negative amount, additionally charge) tokens once the real usage is known."""
+
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+def parse_duration(value) -> float:
+    """ Seconds in a rate-limit reset header: plain seconds ("1.5") or Go-style durations ("6m0s", "20ms")."""
+
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+def retry_after_seconds(headers) -> float:
+    """ Server-requested back-off from retry-after-ms / retry-after headers, if any."""
+
+    if not headers:
+        return None
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    return parse_duration(headers.get("retry-after"))
+
+
+def exhausted_budget_seconds(headers) -> float:
+    """ Time until the budget resets when x-ratelimit-remaining-{requests,tokens} reports it exhausted."""
+
+    if not headers:
+        return None
+    waits = []
+    for kind in ("requests", "tokens"):
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+        if remaining is not None and remaining.strip() in ("0", "0.0"):
+            waits.append(parse_duration(headers.get(f"x-ratelimit-reset-{kind}")) or 1.0)
+    return max(waits) if waits else None
+
+
+class AdaptiveConcurrency:
+    """ AIMD controller of the in-flight requests to one (model, replica).
+
+    Starts in slow start (+1 per success, i.e. doubling every round trip) and then grows by ~1 per round trip. It
+    multiplies the limit by `backoff` on 429/5xx/timeouts, at most once per round trip, and pauses all admissions when
+    the server asks for it (retry-after, exhausted x-ratelimit-remaining-*). LLM latency also varies with the output
+    length, so latency only counts as congestion when the recent mean stays above `latency_tolerance` x a slowly
+    decaying mean (weight `baseline_decay` per completion) for a whole round trip (`limit` completions in a row); the
+    limit is then multiplied by 0.9 and the baseline restarts from the recent mean."""
+
+    def __init__(self, initial: int=16, min_limit: int=1, max_limit: int=1024, latency_tolerance: float=2.0, backoff: float=0.5, baseline_decay: float=0.01):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.baseline_decay = baseline_decay
+        self.in_flight = 0
+        self.slow_start = True
+        self.baseline = None
+        self.latency = None
+        self.congested = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.stats = {"increases": 0, "decreases": 0, "pauses": 0, "peak_limit": initial}
+
+    def has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def on_success(self, latency: float):
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.baseline is None:
+            self.baseline = latency
+        if self.latency > self.baseline * self.latency_tolerance:
+            # One long generation is not load; a gradient held for a whole round trip is. Back off once, then take the
+            # new latency as the norm, so a lasting shift of the workload does not shrink the limit round after round
+            self.congested += 1
+            if self.congested >= self.limit:
+                self.congested = 0
+                self.baseline = self.latency
+                self._decrease(0.9)
+            return
+        self.congested = 0
+        self.baseline = (1 - self.baseline_decay) * self.baseline + self.baseline_decay * latency
+        self.limit = min(self.max_limit, self.limit + (1 if self.slow_start else 1 / self.limit))
+        self.stats["increases"] += 1
+        self.stats["peak_limit"] = max(self.stats["peak_limit"], int(self.limit))
+
+    def on_overload(self):
+        self.slow_start = False
+        self._decrease(self.backoff)
+
+    def _decrease(self, factor: float):
+        now = time.monotonic()
+        # A burst of failures from the same round trip counts as one congestion signal
+        if now - self.last_decrease < max(self.latency or 0.0, 0.5):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+        self.stats["decreases"] += 1
+
+    def pause(self, seconds: float):
+        if seconds and seconds > 0:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.stats["pauses"] += 1
+
+
+class RequestTicket:
+    """ Handed to the body of RequestLimiter.slot so the caller can pass back the response headers."""
+
+    def __init__(self):
+        self.headers = None
+
+
+def endpoint_key(client) -> str:
+    """ Identity of the endpoint behind a client, for per-endpoint adaptive concurrency and circuit breakers. The replicas
+    of an EndpointPool each get their own controller (keyed by their base URL) once selected."""
+
+    base_url = getattr(client, "base_url", None)
+    return str(base_url) if base_url is not None else f"{type(client).__name__}@{id(client):x}"
+
+
+class RequestLimiter:
+    """ Process-wide admission control for chat completion requests.
+
+    Combines a cap on in-flight requests with requests-per-minute and tokens-per-minute buckets. Bucket limits can be
+    set per model, falling back to the default limits; the concurrency cap is shared by every model. With `adaptive`,
+    every (model, endpoint) additionally gets an AdaptiveConcurrency controller fed by the outcome of each request."""
+
+    def __init__(self, max_concurrency: int=None, requests_per_minute: float=None, tokens_per_minute: float=None, adaptive: dict=None):
+        self.max_concurrency = max_concurrency
+        self.default_limits = (requests_per_minute, tokens_per_minute)
+        self.model_limits = {}
+        self.buckets = {}
+        # Keyword arguments of AdaptiveConcurrency, or None to disable adaptive concurrency
+        self.adaptive = adaptive
+        self.controllers = {}
+        self.in_flight = 0
+        self.stats = {"requests": 0, "throttled": 0, "throttle_seconds": 0.0, "estimated_tokens": 0, "used_tokens": 0}
+        self._loop = None
+        self._condition = None
+        self._lock = None
+
+    def configure(self, max_concurrency: int=None, requests_per_minute: float=None, tokens_per_minute: float=None, model: str=None, adaptive: dict=None):
+        """ Set the concurrency cap, default bucket limits and adaptive settings, or the bucket limits of one model."""
+
+        if model is None:
+            self.max_concurrency = max_concurrency
+            self.default_limits = (requests_per_minute, tokens_per_minute)
+            self.adaptive = adaptive
+            self.buckets.clear()
+            self.controllers.clear()
+        else:
+            self.model_limits[model] = (requests_per_minute, tokens_per_minute)
+            self.buckets.pop(model, None)
+
+    def _primitives(self):
+        # asyncio primitives are bound to one loop; recreate them if the limiter is reused from a new loop
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self._lock = asyncio.Lock()
+        return self._condition, self._lock
+
+    def _buckets(self, model):
+        if model not in self.buckets:
+            rpm, tpm = self.model_limits.get(model, self.default_limits)
+            self.buckets[model] = (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+        return self.buckets[model]
+
+    async def _wait_for_budget(self, model, estimated_tokens):
+        request_bucket, token_bucket = self._buckets(model)
+        while True:
+            delay = max(request_bucket.wait_time(1) if request_bucket else 0.0,
+                        token_bucket.wait_time(estimated_tokens) if token_bucket else 0.0)
+            if delay <= 0:
+                break
+            self.stats["throttled"] += 1
+            self.stats["throttle_seconds"] += delay
+            await asyncio.sleep(delay)
+        if request_bucket:
+            request_bucket.consume(1)
+        if token_bucket:
+            token_bucket.consume(estimated_tokens)
+
+    def controller(self, model: str, endpoint: str) -> AdaptiveConcurrency:
+        if self.adaptive is None:
+            return None
+        if (model, endpoint) not in self.controllers:
+            self.controllers[(model, endpoint)] = AdaptiveConcurrency(**self.adaptive)
+        return self.controllers[(model, endpoint)]
+
+    @asynccontextmanager
+    async def slot(self, model: str, estimated_tokens: int=0, endpoint: str=None):
+        """ Wait for a concurrency slot and for request/token budget, and hold the slot for the duration of the block.
+
+        Yields a RequestTicket; exceptions leaving the block and the headers stored on the ticket drive the adaptive controller."""
+
+        condition, lock = self._primitives()
+        controller = self.controller(model, endpoint)
+        while controller is not None and controller.paused_until > time.monotonic():
+            await asyncio.sleep(controller.paused_until - time.monotonic())
+        async with condition:
+            await condition.wait_for(lambda: (self.max_concurrency is None or self.in_flight < self.max_concurrency)
+                                             and (controller is None or controller.has_capacity()))
+            self.in_flight += 1
+            if controller is not None:
+                controller.in_flight += 1
+        ticket = RequestTicket()
+        try:
+            # Serialize budget waits so concurrent requests do not all wake up and overdraw the bucket together
+            async with lock:
+                await self._wait_for_budget(model, estimated_tokens)
+            self.stats["requests"] += 1
+            self.stats["estimated_tokens"] += estimated_tokens
+            start = time.monotonic()
+            try:
+                yield ticket
+            except OVERLOAD_ERRORS as e:
+                if controller is not None:
+                    controller.on_overload()
+                    response = getattr(e, "response", None)
+                    controller.pause(retry_after_seconds(response.headers if response is not None else None))
+                raise
+            if controller is not None:
+                controller.on_success(time.monotonic() - start)
+                controller.pause(exhausted_budget_seconds(ticket.headers))
+        finally:
+            async with condition:
+                self.in_flight -= 1
+                if controller is not None:
+                    controller.in_flight -= 1
+                # Waiters may be blocked on different controllers, so wake them all
+                condition.notify_all()
+
+    def snapshot(self) -> dict:
+        """ Copy of the counters of the limiter and its controllers; summary(since=snapshot) then reports only what
+        happened after it (limits and peaks stay those of the whole process)."""
+
+        return {"stats": dict(self.stats), "controllers": {key: dict(controller.stats) for key, controller in self.controllers.items()}}
+
+    def summary(self, since: dict=None) -> str:
+        since = since or {"stats": {}, "controllers": {}}
+        stats = {key: value - since["stats"].get(key, 0) for key, value in self.stats.items()}
+        lines = [f"Requests: {stats['requests']}, throttled {stats['throttled']} times ({stats['throttle_seconds']:.1f}s)"]
+        for key, controller in self.controllers.items():
+            before = since["controllers"].get(key, {})
+            lines.append(f"{key[0]} @ {key[1]}: limit {controller.limit:.1f} (peak {controller.stats['peak_limit']}), "
+                         f"{controller.stats['decreases'] - before.get('decreases', 0)} decreases, "
+                         f"{controller.stats['pauses'] - before.get('pauses', 0)} pauses")
+        return "\n".join(lines)
+
+    def record_usage(self, model: str, estimated_tokens: int, used_tokens: int):
+        """ Reconcile the token bucket with the usage reported by the server."""
+
+        if used_tokens is None:
+            return
+        self.stats["used_tokens"] += used_tokens
+        _, token_bucket = self._buckets(model)
+        if token_bucket:
+            token_bucket.refund(estimated_tokens - used_tokens)
+
+
+def estimate_request_tokens(messages, generation_config: dict) -> int:
+    """ Rough upper estimate of a request's token cost: ~4 characters per prompt token plus the completion budget."""
+
+    prompt_chars = sum(len(message.get("content") or "") for message in messages)
+    return prompt_chars // 4 + len(messages) * 4 + generation_config.get("max_tokens", 256) * generation_config.get("n", 1)
+
+
+# Settings to opt into AIMD with: configure_rate_limits(adaptive=DEFAULT_ADAPTIVE)
+DEFAULT_ADAPTIVE = {"initial": 16, "min_limit": 1, "max_limit": 1024, "latency_tolerance": 2.0, "backoff": 0.5, "baseline_decay": 0.01}
+
+# Shared by every strategy and model of the process; unlimited until configured
+request_limiter = RequestLimiter()
+
+
+def configure_rate_limits(max_concurrency: int=None, requests_per_minute: float=None, tokens_per_minute: float=None, model: str=None, adaptive: dict=None):
+    """ Configure the process-wide request limiter used by call_openai_with_retry; pass adaptive=DEFAULT_ADAPTIVE (or
+    your own AdaptiveConcurrency settings) to size the concurrency of each (model, replica) with AIMD."""
+
+    request_limiter.configure(max_concurrency, requests_per_minute, tokens_per_minute, model, adaptive)
@@ -0,0 +1,186 @@
+import time
+import asyncio
+import contextvars
+
+import numpy as np
+import pandas as pd
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+from codes.answer_stream import answer_complete
+
+
+THINK_OPEN, THINK_CLOSE = "<think>", "</think>"
+
+# Row of the item whose request is being sent, so per-request statistics can be attributed to it
+current_item = contextvars.ContextVar("current_item", default=None)
+
+
+def split_think(text: str):
+    """ (think span, answer, whether the span was closed) of a reasoning model's output. Chat templates that open the
+    span themselves stream no <think>, so everything before </think> is the think span."""
+
+    body = text.split(THINK_OPEN, 1)[1] if THINK_OPEN in text else text
+    think, closed, answer = body.partition(THINK_CLOSE)
+    return think, answer, bool(closed)
+
+
+class ReasoningStats:
+    """ Think tokens (streamed chunks, one token each on vLLM/TGI) and latency of every reasoning completion, and
+    whether its thinking budget ran out so the answer had to be forced."""
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, item, think_tokens: int, forced: bool, seconds: float):
+        self.records.append({"row": item, "think_tokens": think_tokens, "forced": forced, "seconds": seconds})
+
+    def per_item(self) -> pd.DataFrame:
+        """ Think tokens, forced answers and seconds summed per row (a *_closest strategy sends its base request once per row)."""
+
+        df = pd.DataFrame(self.records, columns=["row", "think_tokens", "forced", "seconds"])
+        return df.groupby("row", dropna=False).agg({"think_tokens": "sum", "forced": "sum", "seconds": "sum"}).reset_index()
+
+    def save(self, file_path: str):
+        """ Write the per-row table to CSV and start over for the next run."""
+
+        self.per_item().to_csv(file_path, index=False)
+        self.records.clear()
+        print(f"Think tokens per row saved to {file_path}")
+
+    def snapshot(self) -> int:
+        """ Number of records so far; summary(since=snapshot) then reports only the completions after it."""
+
+        return len(self.records)
+
+    def summary(self, since: int=0) -> str:
+        records = self.records[since:]
+        if not records:
+            return "Reasoning: no completions"
+        think = np.array([record["think_tokens"] for record in records])
+        forced = sum(record["forced"] for record in records)
+        p50, p95 = np.percentile(think, [50, 95])
+        return (f"Reasoning: {len(think)} completions, think tokens mean {think.mean():.0f}, p50 {p50:.0f}, p95 {p95:.0f}, "
+                f"max {think.max()}; {forced} ({forced / len(think):.1%}) hit the thinking budget and had their answer forced")
+
+
+class ReasoningMode:
+    """ Generation of reasoning models with a bounded think span. The completion is streamed with `think_budget` tokens
+    for the think span plus the request's max_tokens for the answer; a choice still thinking after `think_budget`
+    tokens is cut off and its answer forced by a second, answer-only request of max_tokens. With
+    continuation="prefill" that request continues the truncated think span closed by `forced_close` as the
+    assistant's own message (continue_final_message of vLLM and SGLang); with "instruct" the closed span is followed by
+    a user turn asking for the answer alone, for servers without assistant prefill. With `early_stop`, the stream is
+    closed once the answer line is complete, as in StreamingMode. Outputs keep the <think> span, closed, so
+    clean_deepseek_output strips it as before."""
+
+    def __init__(self, think_budget: int=1024, continuation: str="prefill", early_stop: bool=True,
+                 forced_close: str="\nOkay, I have to answer now.\n</think>\n\n",
+                 instruction: str="Stop thinking. Reply with only the corrected transcription."):
+        if continuation not in ("prefill", "instruct"):
+            raise ValueError(f"Unknown continuation {continuation!r}; use 'prefill' or 'instruct'")
+        self.think_budget = think_budget
+        self.continuation = continuation
+        self.early_stop = early_stop
+        self.forced_close = forced_close
+        self.instruction = instruction
+        self.stats = ReasoningStats()
+
+    def signature(self) -> dict:
+        """ What makes outputs of this mode differ from plain requests (part of cache keys and checkpoint identity)."""
+
+        return {"think_budget": self.think_budget, "continuation": self.continuation, "forced_close": self.forced_close,
+                "instruction": self.instruction if self.continuation == "instruct" else None}
+
+    def forced_request(self, messages, think: str):
+        """ Messages and extra arguments of the answer-only request after a think span cut off at the budget."""
+
+        if self.continuation == "prefill":
+            return (messages + [{"role": "assistant", "content": THINK_OPEN + think + self.forced_close}],
+                    {"extra_body": {"continue_final_message": True, "add_generation_prompt": False}})
+        return (messages + [{"role": "assistant", "content": THINK_OPEN + think + THINK_CLOSE},
+                            {"role": "user", "content": self.instruction}], {})
+
+
+async def reasoning_completion(completions, model: str, messages, generation_config: dict, mode: ReasoningMode, ticket=None) -> ChatCompletion:
+    """ One chat completion of a reasoning model under `mode` (see ReasoningMode), returned as a regular ChatCompletion."""
+
+    n = generation_config.get("n", 1)
+    answer_tokens = generation_config.get("max_tokens", 256)
+    texts, finish_reasons = [""] * n, [None] * n
+    think_tokens, closed, exhausted, done = [0] * n, [False] * n, [False] * n, [False] * n
+    start = time.perf_counter()
+    stream = await completions.create(model=model, messages=messages, stream=True,
+                                      **{**generation_config, "max_tokens": mode.think_budget + answer_tokens})
+    if ticket is not None and getattr(stream, "response", None) is not None:
+        ticket.headers = stream.response.headers
+    try:
+        async for chunk in stream:
+            for choice in chunk.choices:
+                i = choice.index
+                if done[i]:
+                    continue
+                content = choice.delta.content if choice.delta is not None else None
+                if content:
+                    texts[i] += content
+                    # Only the end of the text can hold a newly completed </think>
+                    closed[i] = closed[i] or THINK_CLOSE in texts[i][-len(content) - len(THINK_CLOSE):]
+                    if not closed[i]:
+                        think_tokens[i] += 1
+                        exhausted[i] = done[i] = think_tokens[i] >= mode.think_budget
+                    elif mode.early_stop and answer_complete(split_think(texts[i])[1].lstrip()):
+                        done[i] = True
+                if choice.finish_reason:
+                    finish_reasons[i] = choice.finish_reason
+                    # A server counting several tokens per chunk can reach max_tokens before think_budget chunks
+                    exhausted[i] = choice.finish_reason == "length" and not closed[i]
+                    done[i] = True
+            if all(done):
+                break
+    finally:
+        await stream.close()
+
+    async def force_answer(i):
+        forced_messages, extra = mode.forced_request(messages, split_think(texts[i])[0])
+        response = await completions.create(model=model, messages=forced_messages, **{**generation_config, "n": 1}, **extra)
+        return response.choices[0]
+
+    forced = [i for i in range(n) if exhausted[i]]
+    for i, choice in zip(forced, await asyncio.gather(*[force_answer(i) for i in forced])):
+        # The forced answer follows the truncated span; a model that thinks again has that span dropped, and no answer
+        # if the span is still open at the end of the answer budget
+        content = choice.message.content or ""
+        if THINK_OPEN in content or THINK_CLOSE in content:
+            content = split_think(content)[1]
+        texts[i] = THINK_OPEN + split_think(texts[i])[0] + THINK_CLOSE + "\n\n" + content.lstrip()
+        finish_reasons[i] = choice.finish_reason
+    seconds = time.perf_counter() - start
+    for i in range(n):
+        think, answer, span_closed = split_think(texts[i])
+        if span_closed:
+            texts[i] = THINK_OPEN + think + THINK_CLOSE + answer
+        elif finish_reasons[i] == "stop":
+            # Finished without a think span: all of it is the answer
+            think_tokens[i] = 0
+        mode.stats.record(current_item.get(), think_tokens[i], exhausted[i], seconds)
+    return ChatCompletion(id="reasoning", object="chat.completion", created=int(time.time()), model=model,
+                          choices=[Choice(index=i, finish_reason=finish_reasons[i] or "stop", message=ChatCompletionMessage(role="assistant", content=texts[i]))
+                                   for i in range(n)])
+
+
+# Off by default: reasoning models are sent plain requests until configure_reasoning is called
+reasoning_mode = None
+
+
+def configure_reasoning(enabled: bool=True, think_budget: int=1024, continuation: str="prefill", early_stop: bool=True) -> ReasoningMode:
+    """ Send requests to reasoning models (is_reasoning_model) in ReasoningMode: at most `think_budget` think tokens,
+    then an answer of the generation config's max_tokens (the token budget's, with configure_token_budget, whose
+    reasoning_headroom is then not needed)."""
+
+    global reasoning_mode
+    reasoning_mode = ReasoningMode(think_budget, continuation, early_stop) if enabled else None
+    return reasoning_mode
+
+
+def get_reasoning_mode() -> ReasoningMode:
+    return reasoning_mode
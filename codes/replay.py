@@ -0,0 +1,159 @@
+import re
+import glob
+import argparse
+from codes.evaluation import *
+from codes.results_store import STORE_FILENAME
+
+
+# Row labels used by run_evaluation / EvaluationPipeline.run_evaluation; other strategies keep their function name
+STRATEGY_LABELS = {
+    "get_top1_hypothesis": "Top 1",
+    "get_oracle_hypothesis": "Oracle",
+    "zero_shot_unconstrained": "Zero-shot Uncon",
+    "zero_shot_constrained": "Zero-shot Constr",
+    "zero_shot_closest": "Zero-shot Closest",
+    "Top1HypothesisSelection": "Top 1",
+    "OracleHypothesisSelection": "Oracle",
+    "OneShotUnconstrainedCorrection": "One-shot Uncon",
+    "OneShotClosestCorrection": "One-shot Closest",
+    "SelfConsistencyCorrection_majority_n5": "Self-consistency Majority",
+    "SelfConsistencyCorrection_medoid_n5": "Self-consistency Medoid",
+}
+# SelfConsistencyCorrection.name of the OOP strategy, for any selection method and sample count
+SELF_CONSISTENCY_NAME = re.compile(r"_(SelfConsistencyCorrection_(?:majority|medoid)_n\d+)$")
+# Strategies of oop_implementation; EvaluationPipeline scores them on lower-cased predictions and references only
+OOP_STRATEGIES = {"Top1HypothesisSelection", "OracleHypothesisSelection", "OneShotUnconstrainedCorrection", "OneShotClosestCorrection"}
+METRIC_COLUMNS = ['WER', 'METEOR', 'BERT Precision', 'BERT Recall', 'BERT F1']
+
+
+def known_strategies():
+    """ Names of every correction function in codes.ec_methods plus the OOP strategy classes."""
+
+    import codes.ec_methods as ec_methods
+    names = {name for name, obj in inspect.getmembers(ec_methods, inspect.isfunction) if obj.__module__ == ec_methods.__name__}
+    return names | set(STRATEGY_LABELS)
+
+
+def parse_correction_column(column: str, strategies=None):
+    """ Split 'corrected_by_{model}_{function}' into (model, function), matching the longest known function name."""
+
+    if not column.startswith("corrected_by_"):
+        return None
+    rest = column[len("corrected_by_"):]
+    for strategy in sorted(strategies or known_strategies(), key=len, reverse=True):
+        if rest.endswith("_" + strategy):
+            return rest[:-len(strategy) - 1], strategy
+    match = SELF_CONSISTENCY_NAME.search(rest)
+    if match:
+        return rest[:match.start()], match.group(1)
+    return None
+
+
+def is_oop_strategy(strategy: str) -> bool:
+    """ Whether a stored column was produced by an oop_implementation strategy rather than a codes.ec_methods function."""
+
+    return strategy in OOP_STRATEGIES or strategy.startswith("SelfConsistencyCorrection_")
+
+
+def data_columns(df: pd.DataFrame) -> List[str]:
+    """ The dataset columns of a results frame: 'source'/'target' or 'input'/'output', whichever layout it was written in."""
+
+    return ['source', 'target'] if 'source' in df.columns else ['input', 'output']
+
+
+def load_stored_results(results_path: str) -> pd.DataFrame:
+    """ The wide results frame of a dataset: the results JSON overlaid with the newest rows of the results store."""
+
+    df = pd.read_json(results_path)
+    if os.path.exists(os.path.join(os.path.dirname(os.path.expanduser(results_path)), STORE_FILENAME)):
+        with ResultsStore.for_results_path(results_path) as store:
+            dataset_name = results_dataset_name(results_path)
+            if store.has_dataset(dataset_name):
+                df = store.to_wide(dataset_name, df)
+    return df
+
+
+def replay_results(results_path: str, models: List[str]=None, scorer: BERTScorer=None, save: bool=True) -> dict:
+    """Recomputes the metrics of every stored corrected_by_* column of one results file without calling any LLM.
+
+    BERTScore runs once over all columns of the file; returns {model: metrics table} and rewrites the _{model}.csv tables."""
+
+    df = load_stored_results(results_path)
+    corpus = NBestCorpus.from_dataset(Dataset.from_pandas(df[data_columns(df)]))
+    # Each column is scored with the normalization of the implementation that produced it
+    codes_references = corpus.normalized_references
+    oop_references = [reference.lower() for reference in corpus.references]
+
+    strategies = known_strategies()
+    runs = []
+    for column in df.columns:
+        parsed = parse_correction_column(column, strategies)
+        if parsed is None or (models is not None and parsed[0] not in models):
+            continue
+        model, strategy = parsed
+        predictions = df[column].fillna("").astype(str).tolist()
+        if is_oop_strategy(strategy):
+            runs.append((model, strategy, [pred.lower() for pred in predictions], oop_references))
+        else:
+            runs.append((model, strategy, normalize_predictions(predictions, model), codes_references))
+    if not runs:
+        print(f"No stored corrections found in {results_path}")
+        return {}
+
+    # One batched BERTScore pass over every (prediction, reference) pair of the file
+    bert = None
+    if scorer is not None:
+        all_predictions = [pred for _, _, predictions, _ in runs for pred in predictions]
+        all_references = [ref for _, _, _, references in runs for ref in references]
+        # Same argument order as compute_bertscore in evaluate_model_parallel, so replayed tables match the originals
+        p, r, f1 = scorer.score(all_references, all_predictions)
+        bert = (p.view(len(runs), -1), r.view(len(runs), -1), f1.view(len(runs), -1))
+
+    # The references are interned once and shared by every run's WER pass
+    interner = WordInterner()
+    tables = defaultdict(dict)
+    for i, (model, strategy, predictions, references) in enumerate(runs):
+        wer_scores = utterance_wer(references, predictions, interner)
+        metrics = {
+            'WER': round(wer_scores.mean().item(), 3),
+            'METEOR': round(compute_meteor(predictions, references), 3),
+        }
+        if bert is not None:
+            metrics['BERT Precision'] = round(bert[0][i].mean().item(), 3)
+            metrics['BERT Recall'] = round(bert[1][i].mean().item(), 3)
+            metrics['BERT F1'] = round(bert[2][i].mean().item(), 3)
+        tables[model][STRATEGY_LABELS.get(strategy, strategy)] = metrics
+
+    results_tables = {}
+    for model, table in tables.items():
+        # Baselines first, as in run_evaluation
+        rows = sorted(table, key=lambda label: {"Top 1": 0, "Oracle": 1}.get(label, 2))
+        results_table = pd.DataFrame.from_dict({label: table[label] for label in rows}, orient='index')
+        results_table = results_table[[c for c in METRIC_COLUMNS if c in results_table.columns]]
+        if save:
+            csv_path = results_path.replace(".json", f"_{model}.csv")
+            results_table.to_csv(csv_path)
+            print(f"Benchmark saved to {csv_path}")
+        results_tables[model] = results_table
+    return results_tables
+
+
+def replay_all(pattern: str="results/test_*.json", models: List[str]=None, bertscore: bool=True, save: bool=True) -> dict:
+    """Replays every results file matching `pattern` with a single shared BERTScorer."""
+
+    scorer = BERTScorer(lang="en", rescale_with_baseline=True) if bertscore else None
+    return {path: replay_results(path, models, scorer, save) for path in sorted(glob.glob(pattern))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute metrics tables from stored corrected_by_* columns without calling any LLM.")
+    parser.add_argument("--pattern", default="results/test_*.json", help="Glob of results JSON files")
+    parser.add_argument("--models", nargs="*", help="Only replay these models")
+    parser.add_argument("--no-bertscore", action="store_true", help="Skip BERTScore (no scorer model is loaded); saved tables then have no BERT columns")
+    parser.add_argument("--dry-run", action="store_true", help="Print the tables without rewriting the CSV files")
+    args = parser.parse_args()
+
+    for path, tables in replay_all(args.pattern, args.models, not args.no_bertscore, not args.dry_run).items():
+        for model, table in tables.items():
+            print(f"{path} [{model}]")
+            print(table)
@@ -0,0 +1,131 @@
+import time
+import random
+import asyncio
+from collections import deque
+
+import openai
+
+
+class LLMRequestError(Exception):
+    """ A request that failed for good: non-retryable error, retry budget or deadline exhausted, or circuit open."""
+
+
+class CircuitOpenError(LLMRequestError):
+    """ Raised without contacting the endpoint while its circuit breaker is open."""
+
+
+def classify_error(error: BaseException) -> str:
+    """ 'rate_limit', 'transient' (worth retrying) or 'fatal' (retrying cannot help, e.g. a malformed request)."""
+
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError, asyncio.TimeoutError)):
+        return "transient"
+    if isinstance(error, openai.APIStatusError):
+        # 408 Request Timeout and 409 Conflict are retryable; every other 4xx is the request's fault
+        return "transient" if error.status_code in (408, 409) or error.status_code >= 500 else "fatal"
+    return "fatal"
+
+
+class RetryPolicy:
+    """ Bounded retries: at most `max_attempts` attempts within `deadline` seconds per request (not counting the time
+    queued in the local request limiter), waiting a full-jitter exponential backoff (or the server's retry-after)
+    between attempts."""
+
+    def __init__(self, max_attempts: int=6, deadline: float=300.0, base_delay: float=0.5, max_delay: float=30.0):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """ Per-endpoint breaker: opens when at least `failure_threshold` of the requests of the last `window` seconds
+    failed (given `min_requests`), fails fast for `cooldown` seconds, then lets one probe request through."""
+
+    def __init__(self, failure_threshold: float=0.5, min_requests: int=20, window: float=30.0, cooldown: float=30.0):
+        self.failure_threshold = failure_threshold
+        self.min_requests = min_requests
+        self.window = window
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = 0.0
+        # Start time of the half-open probe request, 0 when none is in flight
+        self.probing = 0.0
+        self.outcomes = deque()
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def _trim(self, now):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+
+    def check(self):
+        """ Raise CircuitOpenError unless a request may be sent now."""
+
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        now = time.monotonic()
+        # A probe that never reported back (e.g. cancelled) stops blocking after one cooldown
+        probing = self.probing and now - self.probing < self.cooldown
+        if self.state == "open" or (self.state == "half_open" and probing):
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(f"Circuit open after a {self.failure_threshold:.0%}+ error rate; retrying in {self.cooldown:.0f}s")
+        if self.state == "half_open":
+            self.probing = now
+
+    def record_success(self):
+        if self.state == "half_open":
+            self.state = "closed"
+            self.probing = 0.0
+            self.outcomes.clear()
+        now = time.monotonic()
+        self.outcomes.append((now, True))
+        self._trim(now)
+
+    def record_failure(self):
+        now = time.monotonic()
+        if self.state == "half_open":
+            self._open(now)
+            return
+        self.outcomes.append((now, False))
+        self._trim(now)
+        failures = sum(not ok for _, ok in self.outcomes)
+        if len(self.outcomes) >= self.min_requests and failures / len(self.outcomes) >= self.failure_threshold:
+            self._open(now)
+
+    def _open(self, now):
+        if self.state != "open":
+            self.stats["opened"] += 1
+            print(f"Circuit breaker opened for {self.cooldown:.0f}s")
+        self.state = "open"
+        self.opened_at = now
+        self.probing = 0.0
+
+
+# Process-wide retry policy and per-endpoint breakers used by call_openai_with_retry
+retry_policy = RetryPolicy()
+circuit_breakers = {}
+breaker_settings = {}
+
+
+def circuit_breaker(endpoint: str) -> CircuitBreaker:
+    if endpoint not in circuit_breakers:
+        circuit_breakers[endpoint] = CircuitBreaker(**breaker_settings)
+    return circuit_breakers[endpoint]
+
+
+def configure_retries(max_attempts: int=6, deadline: float=300.0, base_delay: float=0.5, max_delay: float=30.0, **breaker_kwargs):
+    """ Configure the retry policy and, through `breaker_kwargs`, the circuit breakers (see CircuitBreaker)."""
+
+    global retry_policy
+    retry_policy = RetryPolicy(max_attempts, deadline, base_delay, max_delay)
+    breaker_settings.clear()
+    breaker_settings.update(breaker_kwargs)
+    circuit_breakers.clear()
+
+
+def get_retry_policy() -> RetryPolicy:
+    return retry_policy
@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+
+CACHE_PATH = "results/response_cache.db"
+
+
+def request_key(model: str, messages, generation_config: dict, sample: int=0) -> str:
+    """ Content address of a chat completion request."""
+
+    request = {"model": model, "messages": messages, "generation_config": generation_config, "sample": sample}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """ Disk-backed, content-addressed cache of chat completion outputs, shared by every process using the same file.
+
+    The key is a hash of the model, the full messages, the generation parameters and a sample index, so a cached
+    output is only reused for an identical request; bump the sample index to draw fresh samples. Entries are evicted
+    least-recently-used once the stored outputs exceed `max_bytes`."""
+
+    def __init__(self, db_path: str=CACHE_PATH, max_bytes: int=1 << 30, sample: int=0):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.sample = sample
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._writes_since_eviction = 0
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # WAL + busy timeout make concurrent readers/writers from notebooks and sharded workers safe
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                 key TEXT PRIMARY KEY,
+                                 model TEXT,
+                                 outputs TEXT NOT NULL,
+                                 size INTEGER NOT NULL,
+                                 last_access REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)")
+        self.conn.commit()
+
+    def key(self, model: str, messages, generation_config: dict, sample: int=None) -> str:
+        return request_key(model, messages, generation_config, self.sample if sample is None else sample)
+
+    def get(self, key: str):
+        """ The cached outputs (one string per returned choice) of a request, or None."""
+
+        row = self.conn.execute("SELECT outputs FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        with self.conn:
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, outputs):
+        payload = json.dumps(list(outputs))
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, model, payload, len(payload), time.time()))
+        self.stats["writes"] += 1
+        # Summing the table on every write would be O(n); check the bound periodically instead
+        self._writes_since_eviction += 1
+        if self._writes_since_eviction >= 64:
+            self.evict()
+
+    def evict(self):
+        """ Drop least-recently-used entries until the cache fits in `max_bytes`."""
+
+        self._writes_since_eviction = 0
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess, doomed = total - self.max_bytes, []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            doomed.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        with self.conn:
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        self.stats["evictions"] += len(doomed)
+
+    def snapshot(self) -> dict:
+        """ Copy of the counters; summary(since=snapshot) then reports only what happened after it."""
+
+        return dict(self.stats)
+
+    def summary(self, since: dict=None) -> str:
+        stats = self.stats if since is None else {key: value - since.get(key, 0) for key, value in self.stats.items()}
+        lookups = stats["hits"] + stats["misses"]
+        return (f"Response cache: {stats['hits']}/{lookups} hits ({stats['hits'] / max(lookups, 1):.1%}), "
+                f"{stats['writes']} writes, {stats['evictions']} evictions")
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM responses")
+
+    def close(self):
+        self.conn.close()
+
+
+# Process-wide cache used by get_prediction; disabled until configured
+response_cache = None
+
+
+def get_response_cache() -> ResponseCache:
+    return response_cache
+
+
+def configure_response_cache(db_path: str=CACHE_PATH, max_bytes: int=1 << 30, sample: int=0, enabled: bool=True) -> ResponseCache:
+    """ Enable (or with enabled=False, disable) the process-wide response cache used by get_prediction."""
+
+    global response_cache
+    if response_cache is not None:
+        response_cache.close()
+    response_cache = ResponseCache(db_path, max_bytes, sample) if enabled else None
+    return response_cache
@@ -0,0 +1,196 @@
+import os
+import json
+import sqlite3
+import hashlib
+import pandas as pd
+
+
+STORE_FILENAME = "results_store.db"
+
+
+class ResultsStore:
+    """ Append-only SQLite store of predictions keyed by (dataset, column, row); the latest write of a key wins.
+
+    A column is the `corrected_by_{model}_{function}` name of the wide results JSON. Writes only append rows,
+    so saving one strategy costs O(rows of that strategy) instead of rewriting every results file."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # WAL lets notebooks, sharded workers and replay jobs read while another process appends
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                                 seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                 dataset TEXT NOT NULL,
+                                 column_name TEXT NOT NULL,
+                                 model TEXT,
+                                 strategy TEXT,
+                                 row INTEGER NOT NULL,
+                                 prediction TEXT)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS predictions_key ON predictions (dataset, column_name, row, seq)")
+        self.conn.commit()
+
+    @classmethod
+    def for_results_path(cls, file_path: str):
+        """ The store shared by every results/test_*.json file of a directory."""
+
+        return cls(os.path.join(os.path.dirname(os.path.expanduser(file_path)), STORE_FILENAME))
+
+    def append(self, dataset: str, column: str, rows, predictions, model: str=None, strategy: str=None, overwrite: bool=True):
+        """ Append predictions for the given rows. With overwrite=False, rows that already hold a value are skipped."""
+
+        entries = [(dataset, column, model, strategy, int(row), prediction) for row, prediction in zip(rows, predictions)]
+        with self.conn:
+            if overwrite:
+                self.conn.executemany("INSERT INTO predictions (dataset, column_name, model, strategy, row, prediction) VALUES (?, ?, ?, ?, ?, ?)", entries)
+            else:
+                self.conn.executemany("""INSERT INTO predictions (dataset, column_name, model, strategy, row, prediction)
+                                         SELECT ?, ?, ?, ?, ?, ?
+                                         WHERE NOT EXISTS (SELECT 1 FROM predictions
+                                                           WHERE dataset = ?1 AND column_name = ?2 AND row = ?5 AND prediction IS NOT NULL)""", entries)
+
+    def has_dataset(self, dataset: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM predictions WHERE dataset = ? LIMIT 1", (dataset,)).fetchone() is not None
+
+    def columns(self, dataset: str):
+        return [name for (name,) in self.conn.execute("SELECT column_name FROM predictions WHERE dataset = ? GROUP BY column_name ORDER BY MIN(seq)", (dataset,))]
+
+    def latest(self, dataset: str, column: str=None) -> pd.DataFrame:
+        """ Latest prediction of every (column, row) as a long frame with columns column_name, row, prediction."""
+
+        query = """SELECT column_name, row, prediction FROM predictions
+                   WHERE seq IN (SELECT MAX(seq) FROM predictions WHERE dataset = ?{} GROUP BY column_name, row)
+                   ORDER BY seq"""
+        params = (dataset,)
+        if column is not None:
+            query = query.format(" AND column_name = ?")
+            params = (dataset, column)
+        else:
+            query = query.format("")
+        return pd.read_sql_query(query, self.conn, params=params)
+
+    def compact(self):
+        """ Drop superseded writes and reclaim the space."""
+
+        with self.conn:
+            deleted = self.conn.execute("""DELETE FROM predictions WHERE seq NOT IN
+                                           (SELECT MAX(seq) FROM predictions GROUP BY dataset, column_name, row)""").rowcount
+        self.conn.execute("VACUUM")
+        print(f"Compacted {self.db_path}: removed {deleted} superseded rows")
+
+    def import_json(self, dataset: str, file_path: str):
+        """ Load the corrected_by_* columns of an existing wide results JSON into the store."""
+
+        df = pd.read_json(os.path.expanduser(file_path))
+        for column in df.columns:
+            if column.startswith("corrected_by_"):
+                values = df[column]
+                rows = values.index[values.notna()]
+                self.append(dataset, column, rows, values[rows].tolist())
+
+    def to_wide(self, dataset: str, base: pd.DataFrame) -> pd.DataFrame:
+        """ Overlay the stored columns of a dataset onto its base frame (the data columns), in the wide results layout."""
+
+        df = base.copy()
+        long = self.latest(dataset)
+        for column, group in long.groupby("column_name", sort=False):
+            if column not in df.columns:
+                df[column] = None
+            df.loc[group["row"].to_numpy(), column] = group["prediction"].to_numpy()
+        return df
+
+    def export_json(self, dataset: str, base: pd.DataFrame, file_path: str):
+        self.to_wide(dataset, base).to_json(os.path.expanduser(file_path), orient="records", indent=4)
+        print(f"Results exported to {file_path}")
+
+    def export_csv(self, dataset: str, base: pd.DataFrame, file_path: str):
+        self.to_wide(dataset, base).to_csv(os.path.expanduser(file_path), index=False)
+        print(f"Results exported to {file_path}")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+CHECKPOINT_FILENAME = "checkpoints.db"
+
+
+class RunCheckpoint:
+    """ Durable per-item checkpoints of one run, keyed by (dataset, model, strategy, generation config, row).
+
+    Raw (un-normalized) outputs are stored, so a resumed run goes through the same post-processing as a fresh one."""
+
+    def __init__(self, db_path: str, dataset: str, model: str, strategy: str, generation_config: dict, **run_params):
+        self.db_path = db_path
+        self.run_params = {"dataset": dataset, "model": model, "strategy": strategy, "generation_config": generation_config, **run_params}
+        self.run_key = hashlib.sha256(json.dumps(self.run_params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS checkpoints (
+                                 run_key TEXT NOT NULL,
+                                 row INTEGER NOT NULL,
+                                 output TEXT,
+                                 PRIMARY KEY (run_key, row))""")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS runs (run_key TEXT PRIMARY KEY, params TEXT)")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS failures (
+                                 run_key TEXT NOT NULL,
+                                 row INTEGER NOT NULL,
+                                 error TEXT,
+                                 PRIMARY KEY (run_key, row))""")
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO runs VALUES (?, ?)", (self.run_key, json.dumps(self.run_params, sort_keys=True, default=str)))
+
+    @classmethod
+    def for_results_path(cls, file_path: str, model: str, strategy: str, generation_config: dict, **run_params):
+        db_path = os.path.join(os.path.dirname(os.path.expanduser(file_path)), CHECKPOINT_FILENAME)
+        return cls(db_path, os.path.splitext(os.path.basename(file_path))[0], model, strategy, generation_config, **run_params)
+
+    def completed(self, rows=None) -> dict:
+        """ Outputs already checkpointed for this run, as {row: output}."""
+
+        done = dict(self.conn.execute("SELECT row, output FROM checkpoints WHERE run_key = ?", (self.run_key,)))
+        if rows is not None:
+            done = {row: done[row] for row in rows if row in done}
+        return done
+
+    def save(self, row: int, output: str):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)", (self.run_key, int(row), output))
+            self.conn.execute("DELETE FROM failures WHERE run_key = ? AND row = ?", (self.run_key, int(row)))
+
+    def save_failure(self, row: int, error: str):
+        """ Record a row whose request failed for good; it stays pending, so a resumed run retries it."""
+
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO failures VALUES (?, ?, ?)", (self.run_key, int(row), error))
+
+    def failures(self) -> dict:
+        """ Rows of this run that failed and have not succeeded since, as {row: error}."""
+
+        return dict(self.conn.execute("SELECT row, error FROM failures WHERE run_key = ?", (self.run_key,)))
+
+    def clear(self):
+        """ Drop the checkpoints of this run once its results are saved, so a deliberate rerun samples again."""
+
+        with self.conn:
+            self.conn.execute("DELETE FROM checkpoints WHERE run_key = ?", (self.run_key,))
+            self.conn.execute("DELETE FROM failures WHERE run_key = ?", (self.run_key,))
+            self.conn.execute("DELETE FROM runs WHERE run_key = ?", (self.run_key,))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
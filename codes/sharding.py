@@ -0,0 +1,81 @@
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from codes.evaluation import *
+
+
+def shard_indices(corpus: NBestCorpus, num_shards: int, mode: str="contiguous") -> List[List[int]]:
+    """ Split row indices into shards: contiguous ranges, or by a stable hash of the hypotheses so identical N-best lists share a shard (and dedup within it)."""
+
+    total_rows = len(corpus)
+    if mode == "contiguous":
+        bounds = [round(i * total_rows / num_shards) for i in range(num_shards + 1)]
+        return [list(range(bounds[i], bounds[i + 1])) for i in range(num_shards)]
+    if mode == "hash":
+        shards = [[] for _ in range(num_shards)]
+        for idx, record in enumerate(corpus):
+            key = "\n".join(record.norm_hypotheses).encode("utf-8")
+            shards[zlib.crc32(key) % num_shards].append(idx)
+        return shards
+    raise ValueError(f"Unknown shard mode '{mode}', expected 'contiguous' or 'hash'")
+
+
+def _run_shard(source, indices, model, client_kwargs, postprocessing, generation_config, step, few_shot, error_examples, dedup, checkpoint_path):
+    """ Worker entry point: owns its own event loop and OpenAI client, returns predictions and per-utterance WER statistics."""
+
+    corpus = load_corpus(source)
+    client = openai.AsyncOpenAI(**client_kwargs)
+    checkpoint = open_checkpoint(checkpoint_path, model, postprocessing, generation_config, few_shot, error_examples) if checkpoint_path else None
+    try:
+        predictions = asyncio.run(predict_corpus(corpus, indices, model, client, postprocessing, generation_config, step, few_shot, error_examples, dedup, checkpoint))
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+    # (wer, word errors, reference words) per utterance, computed here to spread the CPU cost over the workers
+    errors = word_errors([corpus[idx].norm_reference for idx in indices], predictions)
+    stats = list(zip(errors.utterance_wer().tolist(), errors.errors.tolist(), errors.reference_words.tolist()))
+    return indices, predictions, stats
+
+
+async def evaluate_model_sharded(dataset, model: str, postprocessing: Callable[[List[str]], str], generation_config: dict, results_path: str, num_shards: int=4, shard_mode: str="contiguous", client_kwargs: dict=None, step: int=256, experimental=False, few_shot: int=0, error_examples: List[str]=None, dedup: bool=True, resume: bool=True):
+    """Evaluates the model with one process (event loop and client) per shard and merges into the same output as evaluate_model_parallel.
+
+    `dataset` is ideally a JSON path or columnar store directory, so each worker loads (or memory-maps) it itself
+    instead of receiving a pickled copy. `client_kwargs` are passed to openai.AsyncOpenAI in every worker."""
+
+    corpus = load_corpus(dataset)
+    if isinstance(dataset, str):
+        source = dataset
+        dataset = corpus
+    else:
+        source = corpus
+    shards = [shard for shard in shard_indices(corpus, num_shards, shard_mode) if shard]
+
+    # Workers share the run's SQLite checkpoint, so a restarted sharded run also resumes
+    checkpoint_path = results_path if resume else None
+
+    loop = asyncio.get_running_loop()
+    # Spawned workers avoid forking a process that already runs an event loop and HTTP client threads
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [loop.run_in_executor(executor, _run_shard, source, shard, model, client_kwargs or {}, postprocessing, generation_config, step, few_shot, error_examples, dedup, checkpoint_path)
+                   for shard in shards]
+        shard_results = await asyncio.gather(*futures)
+
+    # Deterministic merge: every prediction and statistic goes back to its original row index
+    all_predictions = [None] * len(corpus)
+    wer_scores = [None] * len(corpus)
+    errors, ref_words = 0, 0
+    for indices, predictions, stats in shard_results:
+        for idx, prediction, (utterance_wer, utterance_errors, utterance_words) in zip(indices, predictions, stats):
+            all_predictions[idx] = prediction
+            wer_scores[idx] = utterance_wer
+            errors += utterance_errors
+            ref_words += utterance_words
+    print(f"Merged {len(shards)} shards, corpus WER {errors / max(ref_words, 1):.3f}")
+
+    all_references = corpus.normalized_references
+    metrics = finalize_evaluation(dataset, all_references, all_predictions, model, postprocessing.__name__, results_path, experimental, wer_scores)
+    checkpoint = open_checkpoint(checkpoint_path, model, postprocessing, generation_config, few_shot, error_examples) if checkpoint_path else None
+    close_checkpoint(checkpoint)
+    return metrics
@@ -0,0 +1,82 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class SingleFlight:
+    """ Coalesces identical requests: concurrent callers with the same key share one in-flight call.
+
+    Inside a `retain()` block, successful results are also remembered (up to `max_entries`, least recently used
+    dropped first), so a later strategy issuing the same request, e.g. zero_shot_closest after zero_shot_unconstrained
+    in run_evaluation, reuses the earlier output instead of sampling again."""
+
+    def __init__(self, max_entries: int=100000):
+        self.max_entries = max_entries
+        self.in_flight = {}
+        self.recent = OrderedDict()
+        self.retain_depth = 0
+        self.stats = {"calls": 0, "joined": 0, "reused": 0}
+        self._loop = None
+
+    @contextmanager
+    def retain(self):
+        """ Remember results for the duration of the block (blocks may nest); forgotten when the outermost block exits."""
+
+        self.retain_depth += 1
+        try:
+            yield self
+        finally:
+            self.retain_depth -= 1
+            if self.retain_depth == 0:
+                self.recent.clear()
+
+    async def run(self, key: str, factory):
+        """ Await `factory()` unless an identical request is in flight or retained; `factory` returns a coroutine."""
+
+        if key in self.recent:
+            self.recent.move_to_end(key)
+            self.stats["reused"] += 1
+            return self.recent[key]
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Futures of a previous event loop can never complete in this one
+            self._loop = loop
+            self.in_flight.clear()
+        if key in self.in_flight:
+            self.stats["joined"] += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        future = loop.create_future()
+        self.in_flight[key] = future
+        self.stats["calls"] += 1
+        try:
+            result = await factory()
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody joined
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            if self.retain_depth and result:
+                self.recent[key] = result
+                if len(self.recent) > self.max_entries:
+                    self.recent.popitem(last=False)
+            return result
+        finally:
+            del self.in_flight[key]
+
+    def snapshot(self) -> dict:
+        """ Copy of the counters; summary(since=snapshot) then reports only what happened after it."""
+
+        return dict(self.stats)
+
+    def summary(self, since: dict=None) -> str:
+        stats = self.stats if since is None else {key: value - since.get(key, 0) for key, value in self.stats.items()}
+        saved = stats["joined"] + stats["reused"]
+        return (f"Coalescing: {stats['calls']} calls, {stats['joined']} joined in flight, "
+                f"{stats['reused']} reused, {saved / max(saved + stats['calls'], 1):.1%} saved")
+
+
+# Shared by every get_prediction call of the process
+request_coalescer = SingleFlight()
@@ -0,0 +1,159 @@
+import json
+from codes.evaluation import *
+
+
+def _iter_json_array(f, chunk_size):
+    """ Incrementally decode the elements of a top-level JSON array without loading the whole file."""
+
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+    started = False
+    while True:
+        # Skip whitespace, the opening bracket and separators between elements
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+        if pos >= len(buffer):
+            return
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield item
+        pos = end
+
+
+def iter_nbest_json(file_path: str, chunk_size: int=1 << 20):
+    """ Lazily yield raw rows from a JSONL file or from a JSON array file (data/test_*.json)."""
+
+    with open(file_path) as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        if first == "[":
+            yield from _iter_json_array(_Prepend(first, f), chunk_size)
+        else:
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class _Prepend:
+    """ File-like wrapper that replays already consumed characters before the rest of the file."""
+
+    def __init__(self, head, f):
+        self.head = head
+        self.f = f
+
+    def read(self, size):
+        head, self.head = self.head, ""
+        return head + self.f.read(size - len(head)) if head else self.f.read(size)
+
+
+def iter_nbest_records(file_path: str):
+    """ Lazily yield NBestRecords from a JSONL or JSON array N-best file."""
+
+    for row in iter_nbest_json(file_path):
+        if 'source' in row:
+            yield make_record(split_source_hypotheses(row['source']), row['target'])
+        else:
+            yield make_record(row['input'], row['output'])
+
+
+def iter_windows(records, size: int):
+    """ Group a record stream into lists of at most `size` records."""
+
+    window = []
+    for record in records:
+        window.append(record)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+async def stream_corrections(records, model: str, client: openai.AsyncOpenAI, postprocessing: Callable[[List[str]], str], generation_config: dict, step: int=256, few_shot: int=0, error_examples: List[str]=None):
+    """ Async generator of (record, normalized prediction) pairs; only one window of `step` records is held at a time."""
+
+    for window in iter_windows(records, step):
+        window_corpus = NBestCorpus(window)
+        predictions = await predict_corpus(window_corpus, range(len(window)), model, client, postprocessing, generation_config, step, few_shot, error_examples)
+        for record, prediction in zip(window, predictions):
+            yield record, prediction
+
+
+async def evaluate_model_streaming(source: str, model: str, client: openai.AsyncOpenAI, postprocessing: Callable[[List[str]], str], generation_config: dict, output_path: str, step: int=256, few_shot: int=0, error_examples: List[str]=None, bertscore: bool=False):
+    """Evaluates the model over a lazily read N-best file in bounded memory, writing one JSONL result line per utterance."""
+
+    count, wer_sum, meteor_sum, errors, ref_words = 0, 0.0, 0.0, 0, 0
+    bert_sums = {'precision': 0.0, 'recall': 0.0, 'f1': 0.0}
+    scorer = BERTScorer(lang="en", rescale_with_baseline=True) if bertscore else None
+
+    pending = []
+    with open(output_path, "w") as out:
+        async for record, prediction in stream_corrections(iter_nbest_records(source), model, client, postprocessing, generation_config, step, few_shot, error_examples):
+            output = jiwer.process_words(record.norm_reference, prediction)
+            word_errors = output.substitutions + output.deletions + output.insertions
+            out.write(json.dumps({"row": count, "input": list(record.hypotheses), "output": record.reference,
+                                  f"corrected_by_{model}_{postprocessing.__name__}": prediction, "wer": output.wer}) + "\n")
+            count += 1
+            wer_sum += output.wer
+            errors += word_errors
+            ref_words += output.hits + output.substitutions + output.deletions
+            pending.append((prediction, record.norm_reference))
+
+            # Metrics that need a batch (METEOR, BERTScore) are folded into running sums once per window
+            if len(pending) == step:
+                meteor_sum, bert_sums = _fold_window(pending, meteor_sum, bert_sums, scorer)
+                pending = []
+                out.flush()
+                print(f"Progress: {count} tests completed!", end="\r")
+        if pending:
+            meteor_sum, bert_sums = _fold_window(pending, meteor_sum, bert_sums, scorer)
+    print(f"Progress: {count} tests completed! Results streamed to {output_path}", flush=True)
+
+    if count == 0:
+        raise ValueError(f"No N-best records found in {source}")
+    metrics = {
+        'WER': round(wer_sum / count, 3),
+        'Corpus WER': round(errors / max(ref_words, 1), 3),
+        'METEOR': round(meteor_sum / count, 3),
+    }
+    if scorer is not None:
+        metrics['BERT Precision'] = round(bert_sums['precision'] / count, 3)
+        metrics['BERT Recall'] = round(bert_sums['recall'] / count, 3)
+        metrics['BERT F1'] = round(bert_sums['f1'] / count, 3)
+    return metrics
+
+
+def _fold_window(pending, meteor_sum, bert_sums, scorer):
+    predictions = [prediction for prediction, _ in pending]
+    references = [reference for _, reference in pending]
+    meteor_sum += compute_meteor(predictions, references) * len(pending)
+    if scorer is not None:
+        # Same argument order as evaluate_model_parallel, so the streamed tables stay comparable
+        p, r, f1 = scorer.score(references, predictions)
+        bert_sums = {'precision': bert_sums['precision'] + p.sum().item(),
+                     'recall': bert_sums['recall'] + r.sum().item(),
+                     'f1': bert_sums['f1'] + f1.sum().item()}
+    return meteor_sum, bert_sums
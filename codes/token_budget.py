@@ -0,0 +1,111 @@
+import math
+
+import numpy as np
+from transformers import AutoTokenizer
+
+
+def is_reasoning_model(model: str) -> bool:
+    """ Models that think (a <think> trace) before answering; the repo's other DeepSeek special cases use the same test."""
+
+    return "DeepSeek" in model
+
+
+class TokenBudget:
+    """ Per-item max_tokens: the corrected transcript is about as long as the hypotheses, so each request gets
+    `slack` x the tokens of its longest hypothesis plus `margin`, clipped to [min_tokens, max_tokens], instead of one
+    budget per dataset that truncates long utterances and lets short ones run on. Reasoning models get
+    `reasoning_headroom` extra tokens for their trace. Hypotheses are counted with `tokenizer` (the served model's) or,
+    without one, estimated at ~4 characters per token like estimate_request_tokens. `fit` learns the slack from
+    references instead. Completions cut off at the budget (finish_reason "length") are counted for the truncation rate."""
+
+    def __init__(self, tokenizer=None, slack: float=1.5, margin: int=8, reasoning_headroom: int=0, min_tokens: int=8, max_tokens: int=None):
+        self.tokenizer = tokenizer
+        self.slack = slack
+        self.margin = margin
+        self.reasoning_headroom = reasoning_headroom
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.stats = {"completions": 0, "truncated": 0, "budget_tokens": 0, "completion_tokens": 0, "requests": 0}
+
+    def count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            return len(text) // 4 + 1
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def budget(self, hypotheses, model: str="") -> int:
+        longest = max((self.count_tokens(hypothesis) for hypothesis in hypotheses), default=0)
+        tokens = max(math.ceil(self.slack * longest) + self.margin, self.min_tokens)
+        if self.max_tokens is not None:
+            tokens = min(tokens, self.max_tokens)
+        if is_reasoning_model(model):
+            tokens += self.reasoning_headroom
+        return tokens
+
+    def apply(self, generation_config: dict, hypotheses, model: str="") -> dict:
+        """ `generation_config` with the item's max_tokens instead of the dataset's."""
+
+        return {**generation_config, "max_tokens": self.budget(hypotheses, model)}
+
+    def fit(self, hypotheses_lists, references, quantile: float=0.99) -> float:
+        """ Learn the slack from a development set: the `quantile` of (reference tokens - margin) / (longest
+        hypothesis tokens), so about 1 - quantile of the items would be truncated. Returns the new slack."""
+
+        ratios = []
+        for hypotheses, reference in zip(hypotheses_lists, references):
+            longest = max((self.count_tokens(hypothesis) for hypothesis in hypotheses), default=0)
+            if longest:
+                ratios.append((self.count_tokens(reference) - self.margin) / longest)
+        if ratios:
+            self.slack = max(float(np.quantile(ratios, quantile)), 1.0)
+        return self.slack
+
+    def record(self, generation, generation_config: dict):
+        """ Count one response's completions, and those cut off at the budget."""
+
+        choices = getattr(generation, "choices", None) or []
+        self.stats["requests"] += 1
+        self.stats["completions"] += len(choices)
+        self.stats["truncated"] += sum(getattr(choice, "finish_reason", None) == "length" for choice in choices)
+        self.stats["budget_tokens"] += generation_config.get("max_tokens", 0) * max(len(choices), 1)
+        usage = getattr(generation, "usage", None)
+        self.stats["completion_tokens"] += getattr(usage, "completion_tokens", None) or 0
+
+    def signature(self) -> dict:
+        """ What makes two budgets produce different requests (part of the run checkpoint's identity)."""
+
+        return {"tokenizer": getattr(self.tokenizer, "name_or_path", None), "slack": round(self.slack, 4), "margin": self.margin,
+                "reasoning_headroom": self.reasoning_headroom, "min_tokens": self.min_tokens, "max_tokens": self.max_tokens}
+
+    def truncation_rate(self) -> float:
+        return self.stats["truncated"] / max(self.stats["completions"], 1)
+
+    def snapshot(self) -> dict:
+        """ Copy of the counters; summary(since=snapshot) then reports only what happened after it."""
+
+        return dict(self.stats)
+
+    def summary(self, since: dict=None) -> str:
+        stats = self.stats if since is None else {key: value - since.get(key, 0) for key, value in self.stats.items()}
+        completions = max(stats["completions"], 1)
+        return (f"Token budget: slack {self.slack:.2f} + {self.margin}, mean max_tokens {stats['budget_tokens'] / completions:.1f}, "
+                f"{stats['completion_tokens'] / max(stats['budget_tokens'], 1):.0%} of the budget used, "
+                f"{stats['truncated']}/{stats['completions']} completions truncated ({stats['truncated'] / completions:.1%})")
+
+
+# Off by default: every request uses the max_tokens of its generation config until configure_token_budget is called
+token_budget = None
+
+
+def configure_token_budget(enabled: bool=True, tokenizer=None, slack: float=1.5, margin: int=8, reasoning_headroom: int=0, min_tokens: int=8, max_tokens: int=None) -> TokenBudget:
+    """ Derive max_tokens per item from its hypotheses (see TokenBudget). `tokenizer` is a tokenizer or a Hugging Face
+    model id, ideally the served model's."""
+
+    global token_budget
+    if isinstance(tokenizer, str):
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+    token_budget = TokenBudget(tokenizer, slack, margin, reasoning_headroom, min_tokens, max_tokens) if enabled else None
+    return token_budget
+
+
+def get_token_budget() -> TokenBudget:
+    return token_budget
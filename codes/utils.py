@@ -7,6 +7,7 @@ from time import sleep
 from typing import List, Callable
 import jiwer
 from jiwer import wer
+from rapidfuzz.distance import Levenshtein
 import re
 import openai
 from openai import RateLimitError
@@ -20,13 +21,26 @@ from tqdm.notebook import tqdm
 import logging
 from transformers import AutoTokenizer
 from itertools import product
-from collections import defaultdict
+from collections import defaultdict, Counter
 import torch
 import string
 import time
 import asyncio
 import nest_asyncio
 from dotenv import load_dotenv
+from codes.results_store import ResultsStore, RunCheckpoint
+from codes.rate_limit import request_limiter, estimate_request_tokens, configure_rate_limits, endpoint_key, retry_after_seconds
+from codes.response_cache import ResponseCache, request_key, get_response_cache, configure_response_cache
+from codes.single_flight import SingleFlight, request_coalescer
+from codes.endpoints import Endpoint, EndpointPool, pinned_endpoint
+from codes.local_backend import LocalChatModel
+from codes.resilience import LLMRequestError, CircuitOpenError, classify_error, circuit_breaker, configure_retries, get_retry_policy
+from codes.answer_stream import answer_complete, stream_completion, configure_streaming, get_streaming_mode
+from codes.hedging import HedgePolicy, hedged, configure_hedging, get_hedge_policy
+from codes.prompt_templates import PromptTemplate, configure_prompt_layout, get_prompt_layout
+from codes.token_budget import TokenBudget, configure_token_budget, get_token_budget, is_reasoning_model
+from codes.reasoning import ReasoningMode, reasoning_completion, current_item, configure_reasoning, get_reasoning_mode
+from codes.wer import WordInterner, word_errors, utterance_wer, corpus_wer
 
 import nltk
 nltk.download('wordnet')
@@ -58,24 +72,9 @@ def compute_bertscore(references, hypotheses):
 
 
 def compute_levenshtein_distance(s1: str, s2: str) -> int:
-    """Compute the Levenshtein distance between two strings."""
+    """Compute the (character-level) Levenshtein distance between two strings, with rapidfuzz's C++ implementation."""
     
-    len_s1, len_s2 = len(s1), len(s2)
-    dp = np.zeros((len_s1 + 1, len_s2 + 1), dtype=int)
-
-    for i in range(len_s1 + 1):
-        dp[i][0] = i
-    for j in range(len_s2 + 1):
-        dp[0][j] = j
-
-    for i in range(1, len_s1 + 1):
-        for j in range(1, len_s2 + 1):
-            cost = 0 if s1[i - 1] == s2[j - 1] else 1
-            dp[i][j] = min(dp[i - 1][j] + 1,      # Deletion
-                           dp[i][j - 1] + 1,      # Insertion
-                           dp[i - 1][j - 1] + cost)  # Substitution
-
-    return dp[len_s1][len_s2]
+    return Levenshtein.distance(s1, s2)
 
 
 
@@ -86,12 +85,20 @@ def construct_input(question):
 
 
 def extract_hypotheses(dataset, idx):
-    if 'source' in dataset.features:
-        hypotheses = [h.strip() for h in dataset['source'][idx].split('.') if h.strip()]
-        references = dataset['target'][idx]
+    """ Return the hypotheses and reference of one row from a Dataset or an NBestCorpus."""
+    
+    if hasattr(dataset, 'records'):
+        record = dataset[idx]
+        return list(record.hypotheses), record.reference
+    
+    # Index the row first: dataset['column'][idx] would materialize the whole column on every call
+    row = dataset[idx]
+    if 'source' in row:
+        hypotheses = [h.strip() for h in row['source'].split('.') if h.strip()]
+        references = row['target']
     else:
-        hypotheses = dataset['input'][idx]
-        references = dataset['output'][idx]
+        hypotheses = row['input']
+        references = row['output']
         
     return hypotheses, references
 
@@ -113,65 +120,204 @@ def preprocess(text):
     return clean_asr_output(remove_punctuation(text.lower()))
 
 # Saving model results
-def save_results(dataset: Dataset, corrections: list, model_name: str, function_name: str, file_path: str):
+def results_dataset_name(file_path: str) -> str:
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+
+def open_results_store(file_path: str) -> ResultsStore:
+    """ Open the append-only store next to a results JSON, importing the JSON's existing columns on first use."""
+    
+    store = ResultsStore.for_results_path(file_path)
+    dataset_name = results_dataset_name(file_path)
+    if not store.has_dataset(dataset_name) and os.path.exists(os.path.expanduser(file_path)):
+        store.import_json(dataset_name, file_path)
+    return store
+
+
+def save_results(dataset: Dataset, corrections: list, model_name: str, function_name: str, file_path: str, export: bool=True):
+    """ Append one strategy's predictions to the results store; with `export`, also refresh the wide results JSON."""
+    
     correction_column = f"corrected_by_{model_name}_{function_name}"
-    if os.path.exists(file_path):
-        existing_df = pd.read_json(file_path)
-    else:
-        existing_df = dataset.to_pandas()
+    with open_results_store(file_path) as store:
+        store.append(results_dataset_name(file_path), correction_column, range(len(corrections)), corrections, model_name, function_name)
+        print(f"Results saved to {store.db_path} ({correction_column})")
+        if export:
+            export_results(dataset, file_path, store)
 
-    if correction_column not in existing_df.columns:
-        existing_df[correction_column] = None
 
-    existing_df[correction_column] = corrections
-    existing_df.to_json(file_path, orient="records", indent=4)
-    print(f"Results saved to {file_path}")
+def export_results(dataset: Dataset, file_path: str, store: ResultsStore=None):
+    """ Write the wide results JSON (data columns + one corrected_by_* column per run) from the results store.
+    
+    A store passed in stays open; one opened here is closed again."""
+    
+    if store is None:
+        with open_results_store(file_path) as store:
+            return export_results(dataset, file_path, store)
+    store.export_json(results_dataset_name(file_path), results_base(dataset, file_path), file_path)
+
+
+def results_base(dataset, file_path: str) -> pd.DataFrame:
+    """ Base frame of the wide results JSON: the existing results file, else the JSON the corpus was read from, so every
+    data column is kept (an NBestCorpus itself only exports 'input' and 'output'); the dataset's own columns for a new file."""
+    
+    for path in (file_path, getattr(dataset, "source_path", None)):
+        if path is not None and os.path.isfile(os.path.expanduser(path)):
+            return pd.read_json(os.path.expanduser(path))
+    return dataset.to_pandas()
     
 # Helper functions to get model prediction
 async def call_openai_with_retry(messages, model, generation_config, client):
-    """Handles API retries with exponential backoff."""
+    """Handles API retries with jittered exponential backoff, bounded by the retry policy (see configure_retries).
     
-    retry_delay = 0.1  # Initial delay in seconds
-    max_delay = 10
-    while True:
-        try:
-            # Attempt to make the API call
-            generation = await client.chat.completions.create(
+    Every attempt goes through the process-wide request limiter (see configure_rate_limits), whose optional adaptive
+    controller sizes the concurrency of each (model, replica) from latency, 429/5xx and rate-limit headers, and through
+    the endpoint's circuit breaker. With configure_streaming, the completion is streamed and cut off as soon as its answer line is
+    complete. With configure_hedging, an attempt slower than the configured latency percentile is duplicated (on another
+    replica of an EndpointPool) and the first answer wins. With configure_reasoning, reasoning models think within a bounded
+    budget and then answer (see ReasoningMode). Raises LLMRequestError once the request fails for good."""
+    
+    policy = get_retry_policy()
+    streaming = get_streaming_mode()
+    hedging = get_hedge_policy()
+    reasoning = get_reasoning_mode() if is_reasoning_model(model) else None
+    deadline = time.monotonic() + policy.deadline
+    estimated_tokens = estimate_request_tokens(messages, generation_config)
+    if reasoning is not None:
+        estimated_tokens += reasoning.think_budget * generation_config.get("n", 1)
+    endpoint = endpoint_key(client)
+    breaker = circuit_breaker(endpoint)
+    completions = client.chat.completions
+    
+    async def request(ticket):
+        if reasoning is not None:
+            return await reasoning_completion(completions, model, messages, generation_config, reasoning, ticket)
+        if streaming is not None:
+            return await stream_completion(completions, model, messages, generation_config, streaming, ticket)
+        if hasattr(completions, "with_raw_response"):
+            # The raw response carries the x-ratelimit-* headers
+            response = await completions.with_raw_response.create(
                 model=model,
                 messages=messages,
                 **generation_config
             )
+            ticket.headers = response.headers
+            return response.parse()
+        return await completions.create(
+            model=model,
+            messages=messages,
+            **generation_config
+        )
+    
+    async def send(on_sent=None):
+        nonlocal deadline, sent
+        # The replicas of a pool each have their own controller: pick the replica first and pin the request to it
+        replica = client.select(model) if isinstance(client, EndpointPool) else None
+        pinned = pinned_endpoint.set(replica)
+        queued_at = time.monotonic()
+        try:
+            async with request_limiter.slot(model, estimated_tokens, endpoint if replica is None else replica.base_url) as ticket:
+                if not sent:
+                    # Time queued in the local limiter is not the endpoint's: it does not count against the deadline
+                    # (a hedge only queues while the first copy is already out)
+                    deadline += time.monotonic() - queued_at
+                    sent = True
+                if on_sent is not None:
+                    on_sent()
+                return await asyncio.wait_for(request(ticket), max(deadline - time.monotonic(), 0))
+        finally:
+            pinned_endpoint.reset(pinned)
+    
+    for attempt in range(1, policy.max_attempts + 1):
+        breaker.check()
+        sent = False
+        try:
+            # Attempt to make the API call within the request deadline, which runs while requests are out or backing off
+            attempt_coroutine = hedged(send, hedging, (model, endpoint), estimated_tokens) if hedging is not None else send()
+            generation = await attempt_coroutine
+            breaker.record_success()
+            usage = getattr(generation, "usage", None)
+            request_limiter.record_usage(model, estimated_tokens, getattr(usage, "total_tokens", None))
             return generation
 
-        except RateLimitError as e:
-            wait_time = retry_delay
-            if hasattr(e, "response") and e.response is not None:
-                try:
-                    error_data = e.response.json()
-                    wait_time = float(error_data.get("detail", {}).get("wait_seconds", {}))
-                except:
-                    pass
-            await asyncio.sleep(wait_time + 0.1)
-
-
         except Exception as e:
-            await asyncio.sleep(retry_delay)
-            retry_delay = min(retry_delay * 2, max_delay)  # Exponential backoff
+            kind = classify_error(e)
+            # 429s and 4xx mean the endpoint answered: it is busy or the request is bad, not the endpoint broken.
+            # An attempt that failed before leaving the limiter says nothing about the endpoint either way
+            if sent and kind == "transient":
+                breaker.record_failure()
+            elif sent:
+                breaker.record_success()
+            if kind == "fatal":
+                raise LLMRequestError(f"{type(e).__name__}: {e}") from e
+            if attempt == policy.max_attempts:
+                raise LLMRequestError(f"Gave up after {attempt} attempts, last error {type(e).__name__}: {e}") from e
+            
+            wait_time = None
+            if kind == "rate_limit" and getattr(e, "response", None) is not None:
+                wait_time = retry_after_seconds(e.response.headers)
+                if wait_time is None:
+                    try:
+                        error_data = e.response.json()
+                        wait_time = float(error_data.get("detail", {}).get("wait_seconds", {}))
+                    except:
+                        pass
+            if wait_time is None:
+                wait_time = policy.backoff(attempt)
+            if time.monotonic() + wait_time >= deadline:
+                raise LLMRequestError(f"Deadline of {policy.deadline:.0f}s exceeded after {attempt} attempts, last error {type(e).__name__}: {e}") from e
+            await asyncio.sleep(wait_time)
+
+
+async def get_prediction(client: openai.AsyncOpenAI, model: str, messages: List[dict], generation_config: dict, sample: int=None) -> str:
+    """Asynchronously fetch predictions from OpenAI API.
+    
+    Identical concurrent requests share one call (and, inside request_coalescer.retain(), so do later ones). When the
+    response cache is enabled (configure_response_cache), identical (model, messages, generation_config, sample)
+    requests are answered from disk; `sample` defaults to the cache's sample index."""
+    
+    return (await get_predictions(client, model, messages, generation_config, sample))[0]
 
 
-async def get_prediction(client: openai.AsyncOpenAI, model: str, messages: List[dict], generation_config: dict) -> str:
-    """Asynchronously fetch predictions from OpenAI API."""
+async def get_predictions(client: openai.AsyncOpenAI, model: str, messages: List[dict], generation_config: dict, sample: int=None) -> List[str]:
+    """Like get_prediction, but returns every choice: with `n` in generation_config, the n samples of one call."""
+    
+    cache = get_response_cache()
+    if sample is None:
+        sample = cache.sample if cache is not None else 0
+    reasoning = get_reasoning_mode() if is_reasoning_model(model) else None
+    # Bounded-thinking outputs differ from plain ones, so they are cached under their own key
+    key_config = generation_config if reasoning is None else {**generation_config, "reasoning": reasoning.signature()}
+    key = request_key(model, messages, key_config, sample)
+    return await request_coalescer.run(key, lambda: fetch_predictions(client, model, messages, generation_config, key, cache))
+
+
+async def fetch_predictions(client: openai.AsyncOpenAI, model: str, messages: List[dict], generation_config: dict, key: str, cache: ResponseCache=None) -> List[str]:
+    """Answers one request from the response cache or the API. A failed request raises LLMRequestError, so it is never
+    cached, coalesced into later requests or checkpointed as a prediction."""
+    
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    generation = await call_openai_with_retry(messages, model, generation_config, client)
+    if not generation:
+        return [""]
+    if get_token_budget() is not None:
+        get_token_budget().record(generation, generation_config)
+    outputs = [choice.message.content for choice in generation.choices]
+    if cache is not None:
+        cache.put(key, model, outputs)
+    return outputs
     
-    try:
-        generation = await call_openai_with_retry(messages, model, generation_config, client)
-        return generation.choices[0].message.content if generation else ""
-    except Exception as e:
-        print(f"Error: {e}")
-        return ""
     
+async def check_availability(client, model, retry_interval: float=10):
+    """Check if model and client is available. If model is not yet available, try again after some delay.
     
-async def check_availability(client, model):
-    """Check if model and client is available. If model is not yet available, try again after some delay."""
+    The delay is awaited, so other tasks keep running; an EndpointPool is first probed until one replica serves the model,
+    and then keeps probing its ejected replicas in the background to readmit them."""
+    if isinstance(client, EndpointPool):
+        await client.wait_until_available(model, retry_interval)
+        client.start_health_checks(retry_interval)
     output = None
     while output is None:
         try:
@@ -182,7 +328,7 @@ async def check_availability(client, model):
 
         except openai.APIError as e:
             print(e)
-            sleep(10)
+            await asyncio.sleep(retry_interval)
 
     print(output.choices[0].message.content)    
     
@@ -0,0 +1,161 @@
+import re
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+
+THINK_SPAN = re.compile(r"<think>.*?</think>\s*", flags=re.DOTALL)
+
+
+def answer_complete(text: str, reasoning: bool = False, closing_tags: Sequence[str] = ()) -> bool:
+    """
+    Check whether streamed text already holds the whole answer. Only the first line of an output is kept by
+    normalization, so the answer is complete at the first newline (after the <think> span of reasoning models)
+    or at one of the closing tags.
+
+    Args:
+        text (str): The text streamed so far.
+        reasoning (bool): Skip a leading <think>...</think> span first.
+        closing_tags (Sequence[str]): Tags that also end the answer, e.g. "</answer>".
+
+    Returns:
+        bool: True if the rest of the generation can be discarded.
+    """
+    if reasoning:
+        text = THINK_SPAN.sub("", text)
+        if "<think>" in text:
+            return False
+    return "\n" in text or any(tag in text for tag in closing_tags)
+
+
+class StreamStats:
+    """
+    Time-to-first-token and time-to-answer of streamed requests, and how many were cut short.
+    """
+
+    def __init__(self):
+        """
+        Initialize empty statistics.
+        """
+        self.ttft: List[float] = []
+        self.time_to_answer: List[float] = []
+        self.chunks = 0
+        self.stopped_early = 0
+
+    def record(self, ttft: Optional[float], time_to_answer: float, chunks: int, stopped_early: bool):
+        """
+        Record one streamed request.
+
+        Args:
+            ttft (Optional[float]): Seconds until the first content token, None if none arrived.
+            time_to_answer (float): Seconds until the answer was complete.
+            chunks (int): Number of content chunks received.
+            stopped_early (bool): Whether the stream was closed before the generation finished.
+        """
+        if ttft is not None:
+            self.ttft.append(ttft)
+        self.time_to_answer.append(time_to_answer)
+        self.chunks += chunks
+        self.stopped_early += stopped_early
+
+    def snapshot(self) -> Tuple[int, int, int, int]:
+        """
+        Mark the current position in the recorded requests, so that a later summary can report only the requests after it.
+
+        Returns:
+            Tuple[int, int, int, int]: Number of TTFT and time-to-answer samples, chunks and early stops so far.
+        """
+        return len(self.ttft), len(self.time_to_answer), self.chunks, self.stopped_early
+
+    def summary(self, since: Optional[Tuple[int, int, int, int]] = None) -> str:
+        """
+        Format the statistics.
+
+        Args:
+            since (Optional[Tuple[int, int, int, int]]): A snapshot() taken at the start of the run to report. Defaults
+                to the whole process.
+
+        Returns:
+            str: One line with the early-stop rate and TTFT / time-to-answer percentiles.
+        """
+        ttft_start, start, chunks, stopped_early = since or (0, 0, 0, 0)
+        ttft, time_to_answer = self.ttft[ttft_start:], self.time_to_answer[start:]
+        if not time_to_answer:
+            return "Streaming: no requests"
+        ttft = np.percentile(ttft, [50, 95]) if ttft else (float("nan"),) * 2
+        tta = np.percentile(time_to_answer, [50, 95])
+        requests = len(time_to_answer)
+        return (f"Streaming: {requests} requests, {(self.stopped_early - stopped_early) / requests:.1%} stopped at the answer, "
+                f"{(self.chunks - chunks) / requests:.1f} chunks/request, TTFT p50 {ttft[0]:.2f}s p95 {ttft[1]:.2f}s, "
+                f"time-to-answer p50 {tta[0]:.2f}s p95 {tta[1]:.2f}s")
+
+
+class StreamingMode:
+    """
+    Settings of streamed requests, which stop once every choice's answer is complete.
+    """
+
+    def __init__(self, closing_tags: Sequence[str] = (), early_stop: bool = True):
+        """
+        Initialize the settings.
+
+        Args:
+            closing_tags (Sequence[str]): Tags that also end an answer, besides the first newline.
+            early_stop (bool): Close the stream at the answer. If False, requests are only streamed for timing.
+        """
+        self.closing_tags = tuple(closing_tags)
+        self.early_stop = early_stop
+        self.stats = StreamStats()
+
+
+async def stream_completion(completions, model: str, messages: List[Dict[str, str]], generation_config: Dict,
+                            mode: StreamingMode, ticket=None) -> ChatCompletion:
+    """
+    Stream one chat completion, closing the stream (which aborts generation on the server) as soon as every
+    choice holds its complete answer.
+
+    Args:
+        completions: The chat completions resource of the client.
+        model (str): The model name.
+        messages (List[Dict[str, str]]): The chat messages.
+        generation_config (Dict): Generation parameters.
+        mode (StreamingMode): Streaming settings, whose statistics are updated.
+        ticket (Optional[RequestTicket]): Limiter ticket that receives the response headers.
+
+    Returns:
+        ChatCompletion: The text received so far as a regular completion.
+    """
+    reasoning = "DeepSeek" in model
+    n = generation_config.get("n", 1)
+    texts, finish_reasons = [""] * n, [None] * n
+    done = [False] * n
+    start = time.perf_counter()
+    ttft, chunks, stopped_early = None, 0, False
+    stream = await completions.create(model=model, messages=messages, stream=True, **generation_config)
+    if ticket is not None and getattr(stream, "response", None) is not None:
+        ticket.headers = stream.response.headers
+    try:
+        async for chunk in stream:
+            for choice in chunk.choices:
+                content = choice.delta.content if choice.delta is not None else None
+                if content:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    chunks += 1
+                    texts[choice.index] += content
+                    done[choice.index] = done[choice.index] or answer_complete(texts[choice.index], reasoning, mode.closing_tags)
+                if choice.finish_reason:
+                    finish_reasons[choice.index] = choice.finish_reason
+                    done[choice.index] = True
+            if mode.early_stop and all(done):
+                stopped_early = None in finish_reasons
+                break
+    finally:
+        await stream.close()
+    mode.stats.record(ttft, time.perf_counter() - start, chunks, stopped_early)
+    return ChatCompletion(id="stream", object="chat.completion", created=int(time.time()), model=model,
+                          choices=[Choice(index=i, finish_reason=finish_reasons[i] or "stop", message=ChatCompletionMessage(role="assistant", content=texts[i]))
+                                   for i in range(n)])
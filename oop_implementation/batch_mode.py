@@ -0,0 +1,235 @@
+import os
+import json
+import asyncio
+from types import SimpleNamespace
+from typing import Dict, List, Set, Tuple, TYPE_CHECKING
+
+import openai
+from openai.types.chat import ChatCompletion
+
+from response_cache import request_key
+from resilience import LLMRequestError
+
+if TYPE_CHECKING:
+    from llm_client import LLMClient
+
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+class BatchRequestPending(Exception):
+    """
+    The request has no output yet: it was recorded for, or is missing from, a batch.
+    """
+
+
+def batch_request_id(model: str, messages: List[Dict[str, str]], generation_config: Dict) -> str:
+    """
+    Compute the stable custom_id of a batch request: the content address of the request, as used by the response cache.
+
+    Args:
+        model (str): The model name.
+        messages (List[Dict[str, str]]): The chat messages.
+        generation_config (Dict): Generation parameters.
+
+    Returns:
+        str: The custom_id.
+    """
+    return request_key(model, messages, generation_config)
+
+
+class _RecordingCompletions:
+    def __init__(self, recorder: 'BatchRecorder'):
+        self.recorder = recorder
+
+    async def create(self, model: str, messages: List[Dict[str, str]], stream: bool = False, **generation_config):
+        if stream:
+            raise ValueError("Batch mode does not stream; create the LLMClient without streaming")
+        custom_id = batch_request_id(model, messages, generation_config)
+        self.recorder.requests.setdefault(custom_id, {"model": model, "messages": messages, **generation_config})
+        raise BatchRequestPending(custom_id)
+
+
+class BatchRecorder:
+    """
+    Client stand-in that records every chat completion request instead of sending it (the call then fails with
+    BatchRequestPending), so unchanged correction strategies can render the requests of a whole run into a batch file.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty recorder.
+        """
+        self.requests: Dict[str, Dict] = {}
+        self.base_url = "batch-recorder"
+        self.chat = SimpleNamespace(completions=_RecordingCompletions(self))
+
+    def write(self, path: str) -> int:
+        """
+        Write the recorded requests in the OpenAI batch input format.
+
+        Args:
+            path (str): Path of the JSONL batch input file.
+
+        Returns:
+            int: Number of requests written.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            for custom_id, body in self.requests.items():
+                f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}) + "\n")
+        return len(self.requests)
+
+
+class _ReplayCompletions:
+    def __init__(self, results: 'BatchResults'):
+        self.results = results
+
+    async def create(self, model: str, messages: List[Dict[str, str]], stream: bool = False, **generation_config) -> ChatCompletion:
+        if stream:
+            raise ValueError("Batch mode does not stream; create the LLMClient without streaming")
+        custom_id = batch_request_id(model, messages, generation_config)
+        if custom_id not in self.results.outputs:
+            self.results.missing.add(custom_id)
+            raise BatchRequestPending(f"{custom_id}: {self.results.errors.get(custom_id, 'not in the batch output')}")
+        return self.results.outputs[custom_id]
+
+
+class BatchResults:
+    """
+    Client stand-in that answers chat completion requests from completed batch output files (OpenAI batch output
+    format), so the same strategies turn the batch outputs into predictions.
+    """
+
+    def __init__(self, *output_paths: str):
+        """
+        Load batch output files.
+
+        Args:
+            *output_paths (str): Paths of JSONL batch output files; later files override failed requests of earlier ones.
+        """
+        self.outputs: Dict[str, ChatCompletion] = {}
+        self.errors: Dict[str, str] = {}
+        self.missing: Set[str] = set()
+        self.base_url = "batch-results"
+        self.chat = SimpleNamespace(completions=_ReplayCompletions(self))
+        for path in output_paths:
+            self.load(path)
+
+    def load(self, path: str):
+        """
+        Load one batch output file.
+
+        Args:
+            path (str): Path of the JSONL batch output file.
+        """
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    self.outputs[result["custom_id"]] = ChatCompletion.model_validate(response["body"])
+                    self.errors.pop(result["custom_id"], None)
+                elif result["custom_id"] not in self.outputs:
+                    self.errors[result["custom_id"]] = json.dumps(result.get("error") or response.get("body"))
+        print(f"Loaded {len(self.outputs)} batch outputs ({len(self.errors)} failed requests) from {path}")
+
+
+async def process_batch_file(input_path: str, output_path: str, llm_client: 'LLMClient', step: int = 256) -> int:
+    """
+    Local stand-in for a provider batch endpoint: send every request of a batch input file through the client
+    (with its usual limiter and retries) and write the results in the batch output format.
+
+    Args:
+        input_path (str): Path of the JSONL batch input file.
+        output_path (str): Path of the JSONL batch output file to write.
+        llm_client (LLMClient): Client that sends the requests.
+        step (int): Maximum number of requests in flight.
+
+    Returns:
+        int: Number of failed requests.
+    """
+    with open(input_path) as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+    semaphore = asyncio.Semaphore(step)
+
+    async def run(position: int, request: Dict) -> Dict:
+        body = dict(request["body"])
+        model, messages = body.pop("model"), body.pop("messages")
+        result = {"id": f"batch_req_{position}", "custom_id": request["custom_id"], "response": None, "error": None}
+        async with semaphore:
+            try:
+                generation = await llm_client.call_openai_with_retry(messages, model, body)
+                result["response"] = {"status_code": 200, "request_id": generation.id, "body": generation.model_dump(mode="json")}
+            except LLMRequestError as e:
+                result["error"] = {"code": "request_failed", "message": str(e)}
+        return result
+
+    results = await asyncio.gather(*[run(position, request) for position, request in enumerate(requests)])
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    failed = sum(result["error"] is not None for result in results)
+    print(f"Processed {len(results)} batch requests into {output_path}, {failed} failed")
+    return failed
+
+
+async def submit_batch(client: openai.AsyncOpenAI, input_path: str, completion_window: str = "24h") -> str:
+    """
+    Upload a batch input file to the provider's batch API and start the batch.
+
+    Args:
+        client (openai.AsyncOpenAI): Client of the provider.
+        input_path (str): Path of the JSONL batch input file.
+        completion_window (str): Completion window of the batch.
+
+    Returns:
+        str: The batch id.
+    """
+    with open(input_path, "rb") as f:
+        batch_file = await client.files.create(file=f, purpose="batch")
+    batch = await client.batches.create(input_file_id=batch_file.id, endpoint=BATCH_ENDPOINT, completion_window=completion_window)
+    print(f"Submitted batch {batch.id} ({input_path})")
+    return batch.id
+
+
+async def download_batch(client: openai.AsyncOpenAI, batch_id: str, output_path: str) -> str:
+    """
+    Save the output file of a completed provider batch.
+
+    Args:
+        client (openai.AsyncOpenAI): Client of the provider.
+        batch_id (str): The batch id.
+        output_path (str): Path of the JSONL batch output file to write.
+
+    Returns:
+        str: The batch status; the output is only written once it is "completed".
+    """
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status == "completed" and batch.output_file_id:
+        content = await client.files.content(batch.output_file_id)
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, "w") as f:
+            f.write(content.text)
+    return batch.status
+
+
+def batch_paths(batch_dir: str, results_path: str, model: str, strategy: str) -> Tuple[str, str]:
+    """
+    Get the request and output file of one (dataset, model, strategy) run.
+
+    Args:
+        batch_dir (str): Directory of the batch files.
+        results_path (str): Path of the results JSON, whose name identifies the dataset.
+        model (str): The model name.
+        strategy (str): The strategy name.
+
+    Returns:
+        Tuple[str, str]: Paths of the batch input and output files.
+    """
+    dataset_name = os.path.splitext(os.path.basename(results_path))[0]
+    stem = os.path.join(os.path.expanduser(batch_dir), f"{dataset_name}_{model.replace('/', '_')}_{strategy}")
+    return stem + ".requests.jsonl", stem + ".output.jsonl"
@@ -1,7 +1,12 @@
+import re
+import string
 from abc import ABC, abstractmethod
-from typing import List, TYPE_CHECKING
+from collections import Counter
+from typing import List, Tuple, TYPE_CHECKING
 import numpy as np
 
+from prompt_templates import PromptTemplate
+
 if TYPE_CHECKING:
     from llm_client import LLMClient
     from metrics import MetricsCalculator
@@ -27,13 +32,21 @@ class CorrectionStrategy(ABC):
         """
         pass
 
+    @property
+    def name(self) -> str:
+        """
+        Name of the strategy in results columns, checkpoints and batch files.
+
+        Returns:
+            str: The class name; strategies whose settings change their output add those settings.
+        """
+        return type(self).__name__
+
 class OneShotUnconstrainedCorrection(CorrectionStrategy):
     """
     Generates a corrected transcription using a language model without constraints and in 1-shot setting.
     """
-    async def correct(self, hypotheses: List[str], llm_client: 'LLMClient', model: str, generation_config: dict) -> str:
-
-        prompt = ("""Input: Perform error correction based on the top 5 outputs generated by an Automatic Speech Recognition (ASR) system.                      The ASR hypotheses are listed in order of their ASR posterior score. You need to provide the corrected ASR hypothesis                        directly without any explanations. Here is seven in-context examples:\n\n
+    template = PromptTemplate(head=("""Input: Perform error correction based on the top 5 outputs generated by an Automatic Speech Recognition (ASR) system.                      The ASR hypotheses are listed in order of their ASR posterior score. You need to provide the corrected ASR hypothesis                        directly without any explanations. Here is seven in-context examples:\n\n
                      Example 1:\n
                      <hypothesis1> see stongers were executed for these crimes and manures devoted to other islands </hypothesis1>\n
                      <hypothesis2> the stungers were executed for this crime and maneuvers devoted to other islands </hypothesis2>\n
@@ -110,21 +123,33 @@ class OneShotUnconstrainedCorrection(CorrectionStrategy):
                      
                      Your output: tomme de montagne is a collective term for the upland varieties e g \n\n
                      
-                     Feel free to refer to these examples, and also do not add any explanation or other words. Please start:\n""")
-                  
-                 
-        
-        for idx, hypothesis in enumerate(hypotheses):
-            prompt += f"<hypothesis{idx}>{hypothesis}</hypothesis{idx}>\n"
-        prompt += "\n your output:"
-        messages = llm_client.construct_input_prompt(prompt)
+                     Feel free to refer to these examples, and also do not add any explanation or other words. Please start:\n"""),
+                              tail="\n your output:")
+
+    async def correct(self, hypotheses: List[str], llm_client: 'LLMClient', model: str, generation_config: dict) -> str:
+        messages = self.template.render(hypotheses, llm_client.prompt_layout)
         return await llm_client.get_prediction(model, messages, generation_config)
 
+    @staticmethod
+    def build_prompt(hypotheses: List[str]) -> str:
+        """
+        Build the 1-shot unconstrained correction prompt.
+
+        Args:
+            hypotheses (List[str]): A list of ASR hypotheses.
+
+        Returns:
+            str: The prompt.
+        """
+        return OneShotUnconstrainedCorrection.template.render_text(hypotheses)
+
 
 class OneShotClosestCorrection(CorrectionStrategy):
     """
     Selects the hypothesis closest to an unconstrained correction output based on Levenshtein distance.
     """
+    template = OneShotUnconstrainedCorrection.template
+
     def __init__(self, metrics_calculator: 'MetricsCalculator'):
         """
         Initialize ZeroShotClosestCorrection with a MetricsCalculator instance.
@@ -143,6 +168,101 @@ class OneShotClosestCorrection(CorrectionStrategy):
         best_idx = np.argmin(distances)
         return hypotheses[best_idx]
 
+class SelfConsistencyCorrection(CorrectionStrategy):
+    """
+    Samples n unconstrained corrections in a single request (the "n" parameter) and keeps the most consistent one,
+    which reduces the variance of sampling at temperature > 0 without issuing n separate calls.
+    """
+    template = OneShotUnconstrainedCorrection.template
+
+    def __init__(self, metrics_calculator: 'MetricsCalculator', n: int = 5, method: str = "majority"):
+        """
+        Initialize SelfConsistencyCorrection.
+
+        Args:
+            metrics_calculator (MetricsCalculator): Instance of MetricsCalculator to compute distances.
+            n (int): Number of samples per request. Defaults to 5.
+            method (str): "majority" keeps the most frequent normalized answer (ties broken by the total Levenshtein
+                distance to the other samples), "medoid" the answer with the minimum total Levenshtein distance.
+        """
+        if method not in ("majority", "medoid"):
+            raise ValueError(f"Unknown selection method '{method}'")
+        self.metrics_calculator = metrics_calculator
+        self.n = n
+        self.method = method
+        self.agreement_scores: List[float] = []
+
+    @property
+    def name(self) -> str:
+        """
+        Name of the strategy with its selection method and sample count, so runs with other settings keep their own
+        results column, checkpoint and batch file.
+
+        Returns:
+            str: E.g. "SelfConsistencyCorrection_majority_n5".
+        """
+        return f"{type(self).__name__}_{self.method}_n{self.n}"
+
+    @staticmethod
+    def normalize(text: str, model: str) -> str:
+        """
+        Normalize a sample for comparison: drop reasoning traces, lowercase, strip punctuation, keep the first line.
+        """
+        if 'DeepSeek' in model:
+            text = re.sub(r"<think>.*?</think>\s*", "", text, flags=re.DOTALL)
+        text = text.lower().translate(str.maketrans("", "", string.punctuation))
+        return re.split(r'\n+', text, maxsplit=1)[0].strip()
+
+    def select(self, samples: List[str], model: str) -> Tuple[str, float]:
+        """
+        Pick one of the sampled corrections.
+
+        Args:
+            samples (List[str]): The sampled corrections.
+            model (str): The name of the language model.
+
+        Returns:
+            Tuple[str, float]: The chosen raw sample and its agreement, the fraction of samples normalizing to the same answer.
+        """
+        normalized = [self.normalize(sample or "", model) for sample in samples]
+        counts = Counter(normalized)
+        if self.method == "majority":
+            top = max(counts.values())
+            candidates = [i for i in range(len(samples)) if counts[normalized[i]] == top]
+        else:
+            candidates = list(range(len(samples)))
+        answers = {normalized[i] for i in candidates}
+        if len(answers) == 1:
+            # A clear majority (or unanimous samples) needs no distances
+            best = candidates[0]
+        else:
+            # Total distance of each candidate answer to every sample; identical samples are compared once
+            distance = self.metrics_calculator.compute_levenshtein_distance
+            totals = {answer: sum(count * distance(answer, other) for other, count in counts.items()) for answer in answers}
+            best = min(candidates, key=lambda i: totals[normalized[i]])
+        return samples[best], counts[normalized[best]] / len(samples)
+
+    async def correct(self, hypotheses: List[str], llm_client: 'LLMClient', model: str, generation_config: dict) -> str:
+        """
+        Sample n corrections in one request and keep the most consistent one.
+        """
+        messages = OneShotUnconstrainedCorrection.template.render(hypotheses, llm_client.prompt_layout)
+        samples = await llm_client.get_predictions(model, messages, {**generation_config, "n": self.n})
+        answer, agreement = self.select(samples, model)
+        self.agreement_scores.append(agreement)
+        return answer
+
+    def report_agreement(self):
+        """
+        Print (and reset) the agreement of the answers picked so far.
+        """
+        if not self.agreement_scores:
+            return
+        scores = np.array(self.agreement_scores)
+        print(f"Self-consistency agreement: mean {scores.mean():.2f}, unanimous {np.mean(scores == 1.0):.1%}, "
+              f"no majority {np.mean(scores <= 0.5):.1%} of {len(scores)} answers")
+        self.agreement_scores.clear()
+
 class OracleHypothesisSelection(CorrectionStrategy):
     """
     Selects the hypothesis with the lowest WER compared to the reference (oracle baseline).
@@ -172,9 +292,25 @@ class OracleHypothesisSelection(CorrectionStrategy):
         """
         if reference is None:
             raise ValueError("Reference transcript is required for Oracle Hypothesis Selection.")
-        wers = [self.metrics_calculator.compute_wer(reference, hyp) for hyp in hypotheses]
-        best_idx = np.argmin(wers)
-        return hypotheses[best_idx]
+        return self.select([hypotheses], [reference])[0]
+
+    def select(self, hypotheses_lists: List[List[str]], references: List[str]) -> List[str]:
+        """
+        Selects the oracle hypothesis of many rows, scoring the hypotheses of all rows in one vectorized WER pass.
+
+        Args:
+            hypotheses_lists (List[List[str]]): The N-best list of each row.
+            references (List[str]): The reference transcript of each row.
+
+        Returns:
+            List[str]: The oracle hypothesis of each row.
+        """
+        counts = [len(hypotheses) for hypotheses in hypotheses_lists]
+        wers = self.metrics_calculator.compute_word_errors(
+            [reference for reference, count in zip(references, counts) for _ in range(count)],
+            [hyp for hypotheses in hypotheses_lists for hyp in hypotheses]).utterance_wer()
+        starts = np.cumsum([0] + counts[:-1])
+        return [hypotheses[np.argmin(wers[start:start + count])] for hypotheses, start, count in zip(hypotheses_lists, starts, counts)]
 
 class Top1HypothesisSelection(CorrectionStrategy):
     """
@@ -1,7 +1,201 @@
 import os
+import json
+import numpy as np
 import pandas as pd
 from datasets import Dataset
-from typing import List
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+from results_store import ResultsStore
+
+
+class NBestRecord(NamedTuple):
+    """
+    A compact, immutable record for one utterance of an N-best test set.
+    """
+    hypotheses: Tuple[str, ...]
+    reference: str
+    norm_hypotheses: Tuple[str, ...]
+    norm_reference: str
+
+
+class NBestCorpus:
+    """
+    Per-utterance N-best records built once per dataset, with O(1) indexed and sliced access.
+    """
+
+    def __init__(self, records: List[NBestRecord], source_path: Optional[str] = None):
+        """
+        Initialize the corpus from precomputed records.
+
+        Args:
+            records (List[NBestRecord]): One record per utterance, in dataset order.
+            source_path (Optional[str]): The JSON file the whole corpus was read from, if any. Defaults to None.
+        """
+        self.records = records
+        self.source_path = source_path
+
+    @classmethod
+    def from_dataset(cls, dataset: Dataset) -> 'NBestCorpus':
+        """
+        Build a corpus from a dataset, reading each column exactly once.
+
+        Args:
+            dataset (Dataset): A dataset in either the 'source'/'target' or the 'input'/'output' layout.
+
+        Returns:
+            NBestCorpus: The corpus with hypotheses and references pre-normalized for evaluation.
+        """
+        if 'source' in dataset.features:
+            all_hypotheses = [[h.strip() for h in source.split('.') if h.strip()] for source in dataset['source']]
+            all_references = dataset['target']
+        else:
+            all_hypotheses = dataset['input']
+            all_references = dataset['output']
+
+        records = []
+        for hypotheses, reference in zip(all_hypotheses, all_references):
+            hypotheses = tuple(hypotheses)
+            records.append(NBestRecord(hypotheses, reference, tuple(h.lower() for h in hypotheses), reference.lower()))
+        return cls(records)
+
+    @classmethod
+    def from_json(cls, file_path: str) -> 'NBestCorpus':
+        """
+        Build a corpus from a data JSON file.
+
+        Args:
+            file_path (str): The path of a JSON file in the 'source'/'target' or the 'input'/'output' layout.
+
+        Returns:
+            NBestCorpus: The corpus, remembering the file it was read from.
+        """
+        corpus = cls.from_dataset(Dataset.from_pandas(pd.read_json(os.path.expanduser(file_path))))
+        corpus.source_path = file_path
+        return corpus
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[NBestRecord, 'NBestCorpus']:
+        if isinstance(idx, slice):
+            return NBestCorpus(self.records[idx])
+        return self.records[idx]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def unique_indices(self, indices: List[int]) -> Tuple[List[int], List[int]]:
+        """
+        Group rows whose normalized hypothesis lists are identical.
+
+        Args:
+            indices (List[int]): The rows to group.
+
+        Returns:
+            Tuple[List[int], List[int]]: The first row of every group, and the group position of each input row.
+        """
+        groups = {}
+        representatives, inverse = [], []
+        for idx in indices:
+            key = self.records[idx].norm_hypotheses
+            if key not in groups:
+                groups[key] = len(representatives)
+                representatives.append(idx)
+            inverse.append(groups[key])
+        return representatives, inverse
+
+    @property
+    def references(self) -> List[str]:
+        return [record.reference for record in self.records]
+
+    @property
+    def normalized_references(self) -> List[str]:
+        return [record.norm_reference for record in self.records]
+
+    def to_pandas(self) -> pd.DataFrame:
+        """
+        Export the corpus in the 'input'/'output' layout used by the data and results JSON files.
+
+        Returns:
+            pd.DataFrame: One row per utterance.
+        """
+        return pd.DataFrame({'input': [list(record.hypotheses) for record in self.records], 'output': self.references})
+
+
+# Format version of the columnar stores written by `python -m codes.nbest_store`
+STORE_VERSION = 1
+
+
+class MappedRecords:
+    """
+    Lazy sequence of NBestRecords decoded on access from the memory-mapped columns of a columnar N-best store.
+    """
+
+    def __init__(self, store_dir: str, rows: Optional[range] = None, columns: Optional[dict] = None):
+        """
+        Map the raw hypothesis and reference columns of a store.
+
+        Args:
+            store_dir (str): The store directory, containing meta.json.
+            rows (Optional[range]): The store rows of this sequence. Defaults to every row.
+            columns (Optional[dict]): Arrays already mapped by another sequence over the same store. Defaults to None.
+        """
+        if columns is None:
+            with open(os.path.join(store_dir, "meta.json")) as f:
+                meta = json.load(f)
+            if meta["version"] != STORE_VERSION:
+                raise ValueError(f"Unsupported N-best store version {meta['version']} in {store_dir}")
+            load = lambda name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r")
+            columns = {"rows": load("row_offsets"), "hyps": (load("hyps_offsets"), load("hyps_buffer")),
+                       "refs": (load("refs_offsets"), load("refs_buffer")), "num_rows": meta["num_rows"]}
+        self.store_dir = store_dir
+        self.columns = columns
+        self.rows = rows if rows is not None else range(columns["num_rows"])
+
+    def string(self, column: str, i: int) -> str:
+        offsets, buffer = self.columns[column]
+        return buffer[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+
+    def record(self, row: int) -> NBestRecord:
+        # The store's normalized columns use the codes preprocessing, so normalize the raw text as from_dataset does
+        start, end = int(self.columns["rows"][row]), int(self.columns["rows"][row + 1])
+        hypotheses = tuple(self.string("hyps", i) for i in range(start, end))
+        reference = self.string("refs", row)
+        return NBestRecord(hypotheses, reference, tuple(h.lower() for h in hypotheses), reference.lower())
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[NBestRecord, 'MappedRecords']:
+        if isinstance(idx, slice):
+            return MappedRecords(self.store_dir, self.rows[idx], self.columns)
+        return self.record(self.rows[idx])
+
+    def __iter__(self):
+        return (self.record(row) for row in self.rows)
+
+
+class MappedNBestCorpus(NBestCorpus):
+    """
+    NBestCorpus backed by a memory-mapped columnar store, so worker processes share the page cache instead of copying it.
+    """
+
+    def __init__(self, store_dir: str, records: Optional[MappedRecords] = None):
+        """
+        Open a columnar store written by `python -m codes.nbest_store`.
+
+        Args:
+            store_dir (str): The store directory, containing meta.json.
+            records (Optional[MappedRecords]): A row subset of the store. Defaults to every row.
+        """
+        super().__init__(records if records is not None else MappedRecords(store_dir))
+        self.store_dir = store_dir
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[NBestRecord, 'MappedNBestCorpus']:
+        if isinstance(idx, slice):
+            return MappedNBestCorpus(self.store_dir, self.records[idx])
+        return self.records[idx]
+
 
 class DataHandler:
     """
@@ -9,7 +203,42 @@ class DataHandler:
     """
 
     def __init__(self):
-        pass # You can add initialization if needed later
+        self._corpora = {}
+
+    def build_corpus(self, dataset: Union[Dataset, NBestCorpus, str]) -> NBestCorpus:
+        """
+        Build (or reuse) the NBestCorpus for a dataset, so every strategy of a run shares one index.
+
+        Args:
+            dataset (Union[Dataset, NBestCorpus, str]): The dataset object, or the path of a data JSON file or of a
+                columnar N-best store directory.
+
+        Returns:
+            NBestCorpus: The precomputed corpus for this dataset.
+        """
+        if isinstance(dataset, NBestCorpus):
+            return dataset
+        key = dataset if isinstance(dataset, str) else dataset._fingerprint
+        if key not in self._corpora:
+            self._corpora[key] = self.load_corpus(dataset)
+        return self._corpora[key]
+
+    @staticmethod
+    def load_corpus(source: Union[Dataset, str]) -> NBestCorpus:
+        """
+        Load an evaluation corpus from a Dataset, a data JSON file or a columnar N-best store directory.
+
+        Args:
+            source (Union[Dataset, str]): The dataset object or path.
+
+        Returns:
+            NBestCorpus: A MappedNBestCorpus for a store directory, else an in-memory corpus.
+        """
+        if isinstance(source, Dataset):
+            return NBestCorpus.from_dataset(source)
+        if os.path.isfile(os.path.join(os.path.expanduser(source), "meta.json")):
+            return MappedNBestCorpus(os.path.expanduser(source))
+        return NBestCorpus.from_json(source)
 
     def extract_hypotheses(self, dataset: Dataset, idx: int) -> tuple[List[str], str]:
         """
@@ -22,39 +251,79 @@ class DataHandler:
         Returns:
             tuple[List[str], str]: A tuple containing the list of hypotheses and the reference transcript.
         """
-        if 'source' in dataset.features:
-            hypotheses = [h.strip() for h in dataset['source'][idx].split('.') if h.strip()]
-            references = dataset['target'][idx]
-        else:
-            hypotheses = dataset['input'][idx]
-            references = dataset['output'][idx]
-        return hypotheses, references
+        record = self.build_corpus(dataset)[idx]
+        return list(record.hypotheses), record.reference
 
-    def save_results(self, dataset: Dataset, corrections: list, model_name: str, function_name: str, file_path: str):
+    def open_results_store(self, file_path: str) -> ResultsStore:
         """
-        Save the correction results to a JSON file, merging with existing data if the file exists.
+        Open the append-only results store next to a results JSON, importing the JSON's existing columns on first use.
+
+        Args:
+            file_path (str): The path of the results JSON file.
+
+        Returns:
+            ResultsStore: The store shared by the results directory.
+        """
+        store = ResultsStore.for_results_path(file_path)
+        dataset_name = self.results_dataset_name(file_path)
+        if not store.has_dataset(dataset_name) and os.path.exists(os.path.expanduser(file_path)):
+            store.import_json(dataset_name, file_path)
+        return store
+
+    @staticmethod
+    def results_dataset_name(file_path: str) -> str:
+        return os.path.splitext(os.path.basename(file_path))[0]
+
+    def save_results(self, dataset: Dataset, corrections: list, model_name: str, function_name: str, file_path: str, export: bool = True):
+        """
+        Append the correction results to the results store, keeping previously stored values.
 
         Args:
             dataset (Dataset): The original dataset.
             corrections (list): A list of corrected transcripts.
             model_name (str): The name of the model used for correction.
             function_name (str): The name of the correction function.
-            file_path (str): The path to save the results JSON file.
+            file_path (str): The path of the results JSON file.
+            export (bool): Also rewrite the wide results JSON from the store. Defaults to True.
         """
         correction_column = f"corrected_by_{model_name}_{function_name}"
+        with self.open_results_store(file_path) as store:
+            # Update only missing values (keep previous results)
+            store.append(self.results_dataset_name(file_path), correction_column, range(len(corrections)), corrections,
+                         model_name, function_name, overwrite=False)
+            print(f"Results saved to {store.db_path} ({correction_column})")
+            if export:
+                self.export_results(dataset, file_path, store)
 
-        if os.path.exists(file_path):
-            existing_df = pd.read_json(file_path)
-        else:
-            existing_df = dataset.to_pandas()
+    def export_results(self, dataset: Dataset, file_path: str, store: ResultsStore = None):
+        """
+        Write the wide results JSON (dataset columns + one corrected_by_* column per run) from the results store.
 
-        if correction_column not in existing_df.columns:
-            existing_df[correction_column] = None
+        Args:
+            dataset (Dataset): The original dataset.
+            file_path (str): The path to save the results JSON file.
+            store (ResultsStore, optional): An already opened store, left open. Defaults to the store next to file_path,
+                closed again afterwards.
+        """
+        if store is None:
+            with self.open_results_store(file_path) as store:
+                return self.export_results(dataset, file_path, store)
+        store.export_json(self.results_dataset_name(file_path), self.results_base(dataset, file_path), file_path)
+
+    def results_base(self, dataset: Union[Dataset, NBestCorpus, str], file_path: str) -> pd.DataFrame:
+        """
+        Base frame of the wide results JSON, so that every data column of the original file is kept.
 
-        # Update only missing values (keep previous results)
-        for idx, correction in enumerate(corrections):
-            if pd.isna(existing_df.at[idx, correction_column]):
-                existing_df.at[idx, correction_column] = correction
+        Args:
+            dataset (Union[Dataset, NBestCorpus, str]): The original dataset, or the path it was loaded from.
+            file_path (str): The path of the results JSON file.
 
-        existing_df.to_json(file_path, orient="records", indent=4)
-        print(f"Results saved to {file_path}")
\ No newline at end of file
+        Returns:
+            pd.DataFrame: The existing results file, else the JSON the corpus was read from, else the dataset itself.
+        """
+        if isinstance(dataset, str):
+            dataset = self.build_corpus(dataset)
+        for path in (file_path, getattr(dataset, "source_path", None)):
+            if path is not None and os.path.isfile(os.path.expanduser(path)):
+                return pd.read_json(os.path.expanduser(path))
+        return dataset.to_pandas()
@@ -0,0 +1,395 @@
+import time
+import random
+import asyncio
+import contextvars
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Optional, Union
+
+import httpx
+import openai
+
+
+# Errors that say something about the replica rather than the request
+REPLICA_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+# Replicas the requests of the current task should avoid, and a list collecting the replicas they were routed to;
+# hedged requests use them to send the duplicate to a different replica than the original
+avoided_endpoints = contextvars.ContextVar("avoided_endpoints", default=())
+routed_endpoints = contextvars.ContextVar("routed_endpoints", default=None)
+# Replica chosen for the current task's request before it waited for that replica's limiter slot
+pinned_endpoint = contextvars.ContextVar("pinned_endpoint", default=None)
+
+
+class Endpoint:
+    """
+    One OpenAI-compatible replica with its routing and health state.
+    """
+
+    def __init__(self, base_url: str, client: openai.AsyncOpenAI, models: Optional[Iterable[str]] = None):
+        """
+        Initialize the replica.
+
+        Args:
+            base_url (str): Base URL of the replica, e.g. "http://host:8000/v1".
+            client (openai.AsyncOpenAI): Client bound to that URL.
+            models (Optional[Iterable[str]]): Models served by the replica, if known.
+        """
+        self.base_url = base_url
+        self.client = client
+        self.models = set(models) if models else None
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.stats = {"requests": 0, "errors": 0, "ejections": 0, "latency": 0.0}
+
+    def serves(self, model: str) -> bool:
+        """
+        Check whether the replica serves a model. Replicas not probed yet are assumed to serve it.
+
+        Args:
+            model (str): The model name.
+
+        Returns:
+            bool: True if requests for the model may be routed here.
+        """
+        return self.models is None or model in self.models
+
+    def eject(self, cooldown: float):
+        """
+        Take the replica out of rotation.
+
+        Args:
+            cooldown (float): Seconds before the replica is probed again.
+        """
+        if self.healthy:
+            self.stats["ejections"] += 1
+            print(f"Ejecting {self.base_url} for {cooldown:.0f}s")
+        self.healthy = False
+        self.ejected_until = time.monotonic() + cooldown
+
+    def readmit(self):
+        """
+        Put the replica back into rotation.
+        """
+        if not self.healthy:
+            print(f"Readmitting {self.base_url}")
+        self.healthy = True
+        self.failures = 0
+
+
+class _PooledStream:
+    """
+    A streamed completion that keeps its request outstanding on the replica (and its latency running) until the
+    stream is exhausted or closed, so routing sees the replica busy while it is still generating.
+    """
+
+    def __init__(self, pool: 'EndpointPool', endpoint: Endpoint, stream: openai.AsyncStream, start: float):
+        """
+        Wrap a stream.
+
+        Args:
+            pool (EndpointPool): The pool that routed the request.
+            endpoint (Endpoint): The replica serving the stream.
+            stream (openai.AsyncStream): The stream of chunks.
+            start (float): perf_counter() time the request was sent.
+        """
+        self.pool = pool
+        self.endpoint = endpoint
+        self.stream = stream
+        self.start = start
+        self.response = getattr(stream, "response", None)
+        self.finished = False
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.stream:
+                yield chunk
+        except REPLICA_ERRORS:
+            self.pool.record_error(self.endpoint)
+            raise
+        finally:
+            self.finish()
+
+    async def __aenter__(self) -> '_PooledStream':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def finish(self):
+        """
+        Release the replica, once.
+        """
+        if not self.finished:
+            self.finished = True
+            self.pool.release(self.endpoint, self.start)
+
+    async def close(self):
+        """
+        Close the stream (aborting generation on the server) and release the replica.
+        """
+        try:
+            await self.stream.close()
+        finally:
+            self.finish()
+
+
+class _RawCompletions:
+    def __init__(self, pool: 'EndpointPool'):
+        self.pool = pool
+
+    async def create(self, model: str, **kwargs):
+        return await self.pool.create(model=model, raw=True, **kwargs)
+
+
+class _Completions:
+    def __init__(self, pool: 'EndpointPool'):
+        self.pool = pool
+        self.with_raw_response = _RawCompletions(pool)
+
+    async def create(self, model: str, **kwargs):
+        return await self.pool.create(model=model, **kwargs)
+
+
+class EndpointPool:
+    """
+    A drop-in replacement for openai.AsyncOpenAI that routes each request to the healthy replica of its model
+    with the fewest outstanding requests, ejecting replicas based on errors and failed probes and readmitting them once
+    a background health probe (started with the first request) or a request to them succeeds.
+    """
+
+    def __init__(self, endpoints: Dict[str, Union[str, List[str]]], api_key: str = "EMPTY", max_connections: int = 1024,
+                 eject_after: int = 3, cooldown: float = 30.0, timeout: float = 600.0, health_interval: float = 10.0):
+        """
+        Initialize the pool.
+
+        Args:
+            endpoints (Dict[str, Union[str, List[str]]]): Model name -> replica base URLs. "*" lists replicas for any other model.
+            api_key (str): API key sent to every replica.
+            max_connections (int): Size of the shared, keep-alive HTTP connection pool.
+            eject_after (int): Consecutive connection/timeout/5xx errors before a replica is ejected.
+            cooldown (float): Seconds an ejected replica waits before being probed again.
+            timeout (float): Request timeout in seconds.
+            health_interval (float): Seconds between health probes of ejected replicas.
+        """
+        self.eject_after = eject_after
+        self.cooldown = cooldown
+        self.health_interval = health_interval
+        self.http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                                             timeout=timeout)
+        replicas: Dict[str, Endpoint] = {}
+        self.routes: Dict[str, List[Endpoint]] = {}
+        for model, urls in endpoints.items():
+            for url in ([urls] if isinstance(urls, str) else urls):
+                if url not in replicas:
+                    replicas[url] = Endpoint(url, openai.AsyncOpenAI(api_key=api_key, base_url=url, http_client=self.http_client))
+                self.routes.setdefault(model, []).append(replicas[url])
+        self.endpoints = list(replicas.values())
+        self.chat = SimpleNamespace(completions=_Completions(self))
+        self._health_task = None
+
+    def candidates(self, model: str) -> List[Endpoint]:
+        """
+        List the replicas registered for a model.
+
+        Args:
+            model (str): The model name.
+
+        Returns:
+            List[Endpoint]: Replicas that may serve the model.
+        """
+        return [endpoint for endpoint in self.routes.get(model, self.routes.get("*", [])) if endpoint.serves(model)]
+
+    def select(self, model: str) -> Endpoint:
+        """
+        Pick the healthy replica with the fewest outstanding requests (ties broken at random), avoiding the
+        replicas in avoided_endpoints when another one is available.
+
+        Args:
+            model (str): The model name.
+
+        Returns:
+            Endpoint: The chosen replica.
+        """
+        candidates = self.candidates(model)
+        if not candidates:
+            raise ValueError(f"No endpoint registered for model '{model}'")
+        healthy = [endpoint for endpoint in candidates if endpoint.healthy]
+        avoided = avoided_endpoints.get()
+        if avoided:
+            healthy = [endpoint for endpoint in healthy if endpoint.base_url not in avoided] or healthy
+        if not healthy:
+            # Everything is ejected: try the replica whose cooldown ends first rather than failing outright
+            healthy = [min(candidates, key=lambda endpoint: endpoint.ejected_until)]
+        fewest = min(endpoint.outstanding for endpoint in healthy)
+        return random.choice([endpoint for endpoint in healthy if endpoint.outstanding == fewest])
+
+    async def create(self, model: str, raw: bool = False, **kwargs) -> openai.types.chat.ChatCompletion:
+        """
+        Send a chat completion request to the pinned replica (see pinned_endpoint) if it is still healthy, else to the
+        selected one.
+
+        Args:
+            model (str): The model name.
+            raw (bool): Return the raw HTTP response (with headers) instead of the parsed completion.
+            **kwargs: Remaining chat completion parameters.
+
+        Returns:
+            openai.types.chat.ChatCompletion: The completion, or the raw response if raw is True.
+        """
+        self.start_health_checks(self.health_interval)
+        endpoint = pinned_endpoint.get()
+        if endpoint is None or not endpoint.healthy or endpoint not in self.candidates(model):
+            endpoint = self.select(model)
+        route = routed_endpoints.get()
+        if route is not None:
+            route.append(endpoint.base_url)
+        endpoint.outstanding += 1
+        endpoint.stats["requests"] += 1
+        start = time.perf_counter()
+        streamed = False
+        try:
+            completions = endpoint.client.chat.completions
+            generation = await (completions.with_raw_response if raw else completions).create(model=model, **kwargs)
+            if kwargs.get("stream") and not raw:
+                # Tokens are still coming: the stream releases the replica once it is consumed or closed
+                generation = _PooledStream(self, endpoint, generation, start)
+                streamed = True
+        except REPLICA_ERRORS:
+            self.record_error(endpoint)
+            raise
+        finally:
+            if not streamed:
+                self.release(endpoint, start)
+        # An ejected replica that answered (as the all-ejected fallback) is back
+        endpoint.readmit()
+        return generation
+
+    def release(self, endpoint: Endpoint, start: float):
+        """
+        Mark a request to a replica as finished.
+
+        Args:
+            endpoint (Endpoint): The replica.
+            start (float): perf_counter() time the request was sent.
+        """
+        endpoint.outstanding -= 1
+        endpoint.stats["latency"] += time.perf_counter() - start
+
+    def record_error(self, endpoint: Endpoint):
+        """
+        Count a connection/timeout/5xx error of a replica, ejecting it after eject_after in a row.
+
+        Args:
+            endpoint (Endpoint): The replica.
+        """
+        endpoint.stats["errors"] += 1
+        endpoint.failures += 1
+        if endpoint.failures >= self.eject_after:
+            endpoint.eject(self.cooldown)
+
+    async def probe_endpoint(self, endpoint: Endpoint, timeout: float = 10.0) -> bool:
+        """
+        Probe a replica's /models route and refresh its model list.
+
+        Args:
+            endpoint (Endpoint): The replica.
+            timeout (float): Seconds to wait for the answer.
+
+        Returns:
+            bool: True if the replica is healthy.
+        """
+        try:
+            models = await asyncio.wait_for(endpoint.client.models.list(), timeout)
+        except Exception as e:
+            print(f"Probe of {endpoint.base_url} failed: {e}")
+            endpoint.eject(self.cooldown)
+            return False
+        endpoint.models = {m.id for m in models.data} or None
+        endpoint.readmit()
+        return True
+
+    async def probe(self, model: Optional[str] = None, timeout: float = 10.0) -> int:
+        """
+        Probe every replica (of a model, if given) concurrently.
+
+        Args:
+            model (Optional[str]): Restrict the probe to the replicas of this model.
+            timeout (float): Seconds to wait for each replica.
+
+        Returns:
+            int: Number of healthy replicas serving the model.
+        """
+        endpoints = self.endpoints if model is None else self.routes.get(model, self.routes.get("*", []))
+        await asyncio.gather(*[self.probe_endpoint(endpoint, timeout) for endpoint in endpoints])
+        return sum(endpoint.healthy and (model is None or endpoint.serves(model)) for endpoint in endpoints)
+
+    async def _health_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            # Only ejected replicas past their cooldown are probed; live traffic already watches the healthy ones
+            due = [endpoint for endpoint in self.endpoints if not endpoint.healthy and endpoint.ejected_until <= now]
+            await asyncio.gather(*[self.probe_endpoint(endpoint) for endpoint in due])
+
+    def start_health_checks(self, interval: float = 10.0) -> asyncio.Task:
+        """
+        Probe ejected replicas in the background and readmit those that recovered.
+
+        Args:
+            interval (float): Seconds between probe rounds.
+
+        Returns:
+            asyncio.Task: The background task.
+        """
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop(interval))
+        return self._health_task
+
+    async def wait_until_available(self, model: str, interval: float = 10.0, timeout: Optional[float] = None) -> int:
+        """
+        Probe until at least one replica serves the model, without blocking the event loop between rounds.
+
+        Args:
+            model (str): The model name.
+            interval (float): Seconds between probe rounds.
+            timeout (Optional[float]): Give up after this many seconds. Waits forever if None.
+
+        Returns:
+            int: Number of available replicas.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            available = await self.probe(model)
+            if available:
+                print(f"{available}/{len(self.candidates(model)) or available} replicas available for {model}")
+                return available
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"No replica of {model} became available")
+            await asyncio.sleep(interval)
+
+    def summary(self) -> str:
+        """
+        Format per-replica routing and health statistics.
+
+        Returns:
+            str: One line per replica.
+        """
+        lines = []
+        for endpoint in self.endpoints:
+            mean_latency = endpoint.stats["latency"] / max(endpoint.stats["requests"], 1)
+            lines.append(f"{endpoint.base_url}: {'up' if endpoint.healthy else 'ejected'}, {endpoint.stats['requests']} requests, "
+                         f"{endpoint.stats['errors']} errors, {endpoint.stats['ejections']} ejections, mean latency {mean_latency:.2f}s")
+        return "\n".join(lines)
+
+    async def close(self):
+        """
+        Stop health checks and close the shared connection pool.
+        """
+        if self._health_task is not None:
+            self._health_task.cancel()
+        await self.http_client.aclose()
@@ -1,9 +1,11 @@
+import os
 import asyncio
 import random
+from collections import Counter
 import numpy as np
 import pandas as pd
 from datasets import Dataset
-from typing import List, TYPE_CHECKING
+from typing import Dict, List, Optional, TYPE_CHECKING, Union
 
 
 
@@ -14,6 +16,12 @@ from correction_strategies import (
     OracleHypothesisSelection,
     Top1HypothesisSelection
 )
+from results_store import RunCheckpoint
+from resilience import LLMRequestError
+from batch_mode import BatchRecorder, BatchRequestPending, BatchResults, batch_paths
+from local_backend import LocalChatModel
+from reasoning import current_item
+from token_budget import is_reasoning_model
 
 if TYPE_CHECKING:
     from llm_client import LLMClient
@@ -30,7 +38,7 @@ class EvaluationPipeline:
     Orchestrates the evaluation of different ASR error correction strategies.
     """
 
-    def __init__(self, metrics_calculator: 'MetricsCalculator', data_handler: 'DataHandler', progress_tracker: 'ProgressTracker'):
+    def __init__(self, metrics_calculator: 'MetricsCalculator', data_handler: 'DataHandler', progress_tracker: 'ProgressTracker', dedup: bool = True):
         """
         Initialize the EvaluationPipeline with necessary utility classes.
 
@@ -38,13 +46,15 @@ class EvaluationPipeline:
             metrics_calculator (MetricsCalculator): Instance of MetricsCalculator.
             data_handler (DataHandler): Instance of DataHandler.
             progress_tracker (ProgressTracker): Instance of ProgressTracker.
+            dedup (bool): Send each unique (normalized) N-best list to LLM strategies only once. Defaults to True.
         """
         self.metrics_calculator = metrics_calculator
         self.data_handler = data_handler
         self.progress_tracker = progress_tracker
+        self.dedup = dedup
 
     async def process_batch(self, dataset: Dataset, model: str, llm_client: 'LLMClient', correction_strategy: 'CorrectionStrategy',
-                            generation_config: dict) -> List[str]:
+                            generation_config: dict, checkpoint: Optional['RunCheckpoint'] = None) -> List[str]:
         """
         Processes a batch of data using a given correction strategy asynchronously.
 
@@ -54,44 +64,234 @@ class EvaluationPipeline:
             llm_client (LLMClient): Instance of LLMClient.
             correction_strategy (CorrectionStrategy): The correction strategy to apply.
             generation_config (dict): Generation configuration for the language model.
+            checkpoint (Optional[RunCheckpoint]): If given, rows already checkpointed are restored instead of
+                recomputed, and each new output is saved as soon as it completes. Defaults to None.
 
         Returns:
             List[str]: List of corrected transcripts.
         """
+        corpus = self.data_handler.build_corpus(dataset)
+        needs_reference = isinstance(correction_strategy, OracleHypothesisSelection) # Oracle needs reference
+
+        # Reference-based strategies must see every row; the others only need each unique N-best list once
+        indices = list(range(len(corpus)))
+        inverse = None
+        if self.dedup and not needs_reference:
+            indices, inverse = corpus.unique_indices(indices)
+            hits = len(inverse) - len(indices)
+            print(f"Dedup: {len(indices)} unique N-best lists for {len(inverse)} rows, hit rate {hits / max(len(inverse), 1):.1%}")
+
+        outputs = checkpoint.completed() if checkpoint is not None else {}
+        if outputs:
+            print(f"Resuming: {sum(idx in outputs for idx in indices)}/{len(indices)} rows restored from checkpoint")
+        pending = [idx for idx in indices if idx not in outputs]
+        if needs_reference and pending:
+            # Scored for all rows in one vectorized WER pass instead of one task per row
+            outputs.update(zip(pending, correction_strategy.select([list(corpus[idx].hypotheses) for idx in pending],
+                                                                   [corpus[idx].reference for idx in pending])))
+            pending = []
+
         tasks = []
-        for idx in range(len(dataset)):
-            hypotheses, reference = self.data_handler.extract_hypotheses(dataset, idx)
-            if isinstance(correction_strategy, OracleHypothesisSelection): # Oracle needs reference
-                tasks.append(asyncio.create_task(correction_strategy.correct(hypotheses, llm_client, model, generation_config, reference=reference)))
+        failures: Dict[int, str] = {}
+        since = self.stats_snapshot(llm_client)
+        for idx in pending:
+            hypotheses, reference = list(corpus[idx].hypotheses), corpus[idx].reference
+            item_config = llm_client.item_config(generation_config, hypotheses, model)
+            if needs_reference:
+                coroutine = correction_strategy.correct(hypotheses, llm_client, model, item_config, reference=reference)
             else:
-                tasks.append(asyncio.create_task(correction_strategy.correct(hypotheses, llm_client, model, generation_config)))
+                coroutine = correction_strategy.correct(hypotheses, llm_client, model, item_config)
+            if checkpoint is not None:
+                coroutine = self._checkpointed(coroutine, checkpoint, idx)
+            tasks.append(asyncio.create_task(self._attributed(self._guarded(coroutine, checkpoint, idx, failures), idx)))
 
         print("Submitted all tasks!")
-        results = await self.progress_tracker.track_progress(tasks)
+        outputs.update(zip(pending, await self.progress_tracker.track_progress(tasks)))
+        self.report_failures(failures, len(pending))
+        if hasattr(correction_strategy, "report_agreement"):
+            correction_strategy.report_agreement()
+        if tasks and getattr(correction_strategy, "template", None) is not None:
+            tokenizer = llm_client.client.tokenizer if isinstance(llm_client.client, LocalChatModel) else None
+            print(correction_strategy.template.describe(list(corpus[pending[0]].hypotheses), tokenizer, llm_client.prompt_layout))
+        if tasks:
+            self.report_stats(llm_client, model, since)
+        results = [outputs[idx] for idx in indices]
+        if inverse is not None:
+            results = [results[group] for group in inverse]
         return results
 
-    async def evaluate_model_parallel(self, dataset: Dataset, model: str, llm_client: 'LLMClient', correction_strategy: 'CorrectionStrategy',
-                                    generation_config: dict, results_path: str):
+    @staticmethod
+    async def _attributed(coroutine, idx: int) -> str:
+        """
+        Await one item with reasoning.current_item set, so per-request statistics (think tokens) are attributed to its row.
+        """
+        current_item.set(idx)
+        return await coroutine
+
+    @staticmethod
+    async def _checkpointed(coroutine, checkpoint: 'RunCheckpoint', idx: int) -> str:
+        """
+        Await one item and durably record its output before returning it.
+        """
+        output = await coroutine
+        checkpoint.save(idx, output)
+        return output
+
+    @staticmethod
+    async def _guarded(coroutine, checkpoint: Optional['RunCheckpoint'], idx: int, failures: Dict[int, str]) -> str:
+        """
+        Await one item, turning a request that failed for good into an empty output instead of failing the whole batch.
+        The failure is recorded in the checkpoint, where the row stays pending for the next run.
+        """
+        try:
+            return await coroutine
+        except LLMRequestError as e:
+            failures[idx] = str(e)
+            if checkpoint is not None:
+                checkpoint.save_failure(idx, failures[idx])
+            return ""
+
+    @staticmethod
+    def stats_sources(llm_client: 'LLMClient') -> dict:
+        """
+        Collect the request statistics the client keeps: local backend, hedging, streaming, cache, token budget, reasoning.
+
+        Args:
+            llm_client (LLMClient): Instance of LLMClient.
+
+        Returns:
+            dict: The statistics objects in use, by name.
+        """
+        streaming, reasoning = getattr(llm_client, "streaming", None), getattr(llm_client, "reasoning", None)
+        sources = {"local": llm_client.client if isinstance(llm_client.client, LocalChatModel) else None,
+                   "hedging": getattr(llm_client, "hedging", None), "streaming": streaming and streaming.stats,
+                   "cache": getattr(llm_client, "cache", None), "token_budget": getattr(llm_client, "token_budget", None),
+                   "reasoning": reasoning and reasoning.stats}
+        return {name: source for name, source in sources.items() if source is not None}
+
+    def stats_snapshot(self, llm_client: 'LLMClient') -> dict:
+        """
+        Snapshot every statistics source at the start of a run. The counters are kept for the client's whole lifetime,
+        so the run's summaries report the differences to this snapshot.
+
+        Args:
+            llm_client (LLMClient): Instance of LLMClient.
+
+        Returns:
+            dict: The snapshot of each source, by name.
+        """
+        return {name: source.snapshot() for name, source in self.stats_sources(llm_client).items()}
+
+    def report_stats(self, llm_client: 'LLMClient', model: str, since: dict):
+        """
+        Print the request statistics of one run.
+
+        Args:
+            llm_client (LLMClient): Instance of LLMClient.
+            model (str): The name of the language model.
+            since (dict): The stats_snapshot() taken at the start of the run.
+        """
+        for name, source in self.stats_sources(llm_client).items():
+            if name == "reasoning" and not is_reasoning_model(model):
+                continue
+            print(source.summary(since.get(name)))
+
+    @staticmethod
+    def report_failures(failures: Dict[int, str], total: int):
+        """
+        Print how many rows failed and their most common errors.
+
+        Args:
+            failures (Dict[int, str]): Mapping from row index to error.
+            total (int): Number of rows processed.
+        """
+        if not failures:
+            return
+        print(f"WARNING: {len(failures)}/{total} rows failed and were scored as empty predictions")
+        for error, count in Counter(failures.values()).most_common(3):
+            print(f"  {count} x {error}")
+
+    async def render_batch_requests(self, dataset: Dataset, model: str, llm_client: 'LLMClient', correction_strategy: 'CorrectionStrategy',
+                                    generation_config: dict) -> BatchRecorder:
+        """
+        Run a strategy against a BatchRecorder to collect every request it would send; with dedup, once per unique
+        N-best list, as process_batch will ask for them when the output is ingested.
+
+        Args:
+            dataset (Dataset): The dataset to process.
+            model (str): The name of the language model.
+            llm_client (LLMClient): Instance of LLMClient whose settings are reused.
+            correction_strategy (CorrectionStrategy): The correction strategy to render.
+            generation_config (dict): Generation configuration for the language model.
+
+        Returns:
+            BatchRecorder: The recorder holding the requests.
+        """
+        recorder = BatchRecorder()
+        recording_client = llm_client.with_client(recorder)
+        corpus = self.data_handler.build_corpus(dataset)
+        indices = list(range(len(corpus)))
+        if self.dedup:
+            indices, _ = corpus.unique_indices(indices)
+        coroutines = [correction_strategy.correct(list(corpus[idx].hypotheses), recording_client, model,
+                                                  llm_client.item_config(generation_config, list(corpus[idx].hypotheses), model))
+                      for idx in indices]
+        for result in await asyncio.gather(*coroutines, return_exceptions=True):
+            # Every recorded request fails with BatchRequestPending (wrapped in LLMRequestError); anything else is a real error
+            if isinstance(result, BaseException) and not isinstance(result.__cause__, BatchRequestPending):
+                raise result
+        return recorder
+
+    async def evaluate_model_parallel(self, dataset: Union[Dataset, str], model: str, llm_client: 'LLMClient', correction_strategy: 'CorrectionStrategy',
+                                    generation_config: dict, results_path: str, export: bool = True, resume: bool = True,
+                                    batch_dir: Optional[str] = None):
         """
         Evaluates a correction strategy on the dataset and computes metrics.
 
         Args:
-            dataset (Dataset): The dataset to evaluate on.
+            dataset (Union[Dataset, str]): The dataset to evaluate on, or the path of a data JSON file or of a
+                columnar N-best store directory (see DataHandler.load_corpus).
             model (str): The name of the language model.
             llm_client (LLMClient): Instance of LLMClient.
             correction_strategy (CorrectionStrategy): The correction strategy to evaluate.
             generation_config (dict): Generation configuration for the language model.
             results_path (str): Path to save the results.
+            export (bool): Rewrite the wide results JSON after saving. Defaults to True.
+            resume (bool): Checkpoint every item of an LLM strategy next to results_path, so a restarted run only recomputes
+                missing items. Defaults to True.
+            batch_dir (Optional[str]): Run LLM strategies in offline batch mode. The first call writes every request
+                to a JSONL batch input file in this directory and returns None; once its output file exists
+                (batch_mode.process_batch_file, or submit_batch/download_batch for a provider batch API), the next
+                call ingests it into predictions and metrics. Defaults to None.
 
         Returns:
-            dict: Dictionary of evaluation metrics.
+            dict: Dictionary of evaluation metrics, or None if batch requests were written.
         """
-        all_predictions = await self.process_batch(dataset, model, llm_client, correction_strategy, generation_config)
-        all_references = dataset['target'] if 'target' in dataset.features else dataset['output']
+        strategy_name = correction_strategy.name
+        # Oracle and Top 1 are cheap local strategies: never batched nor checkpointed
+        calls_llm = not isinstance(correction_strategy, (OracleHypothesisSelection, Top1HypothesisSelection))
+        if batch_dir is not None and calls_llm:
+            requests_path, output_path = batch_paths(batch_dir, results_path, model, strategy_name)
+            if not os.path.exists(output_path):
+                recorder = await self.render_batch_requests(dataset, model, llm_client, correction_strategy, generation_config)
+                print(f"Wrote {recorder.write(requests_path)} batch requests to {requests_path}; rerun once their output is in {output_path}")
+                return None
+            llm_client, resume = llm_client.with_client(BatchResults(output_path)), False
+        # Budgeted runs send other requests than fixed-budget ones, so they get their own checkpoint
+        checkpoint_config = generation_config if llm_client.token_budget is None else {**generation_config, "token_budget": llm_client.token_budget.signature()}
+        if llm_client.reasoning is not None and is_reasoning_model(model):
+            checkpoint_config = {**checkpoint_config, "reasoning": llm_client.reasoning.signature()}
+        # So do runs with reworded prompts; "original" keeps the checkpoints of runs from before layouts existed
+        if llm_client.prompt_layout != "original":
+            checkpoint_config = {**checkpoint_config, "prompt_layout": llm_client.prompt_layout}
+        checkpoint = RunCheckpoint.for_results_path(results_path, model, strategy_name, checkpoint_config) if resume and calls_llm else None
+        all_predictions = await self.process_batch(dataset, model, llm_client, correction_strategy, generation_config, checkpoint)
+        if llm_client.reasoning is not None and llm_client.reasoning.stats.records:
+            llm_client.reasoning.stats.save(results_path.replace(".json", f"_{model.replace('/', '_')}_{strategy_name}_think_tokens.csv"))
 
         # Normalize for evaluation
         all_predictions = [pred.lower() for pred in all_predictions]
-        all_references = [ref.lower() for ref in all_references]
+        all_references = self.data_handler.build_corpus(dataset).normalized_references
 
         # Print 3 random results for manual review
         random_indices = random.sample(range(len(all_predictions)), 3)
@@ -101,10 +301,20 @@ class EvaluationPipeline:
             print(f"Pred:   {all_predictions[idx]}")
             print("-" * 50)
 
-        self.data_handler.save_results(dataset, all_predictions, model, type(correction_strategy).__name__, results_path)
+        self.data_handler.save_results(dataset, all_predictions, model, strategy_name, results_path, export)
+        if checkpoint is not None:
+            with checkpoint:
+                failures = checkpoint.failures()
+                if failures:
+                    # Failed rows stay pending, so rerunning the same evaluation retries only those
+                    print(f"{len(failures)} failed rows kept in {checkpoint.db_path}; rerun the same evaluation to retry only those")
+                else:
+                    checkpoint.clear()
 
         # Compute evaluation metrics
-        wer_scores = np.array([self.metrics_calculator.compute_wer(reference=ref, hypothesis=pred) for ref, pred in zip(all_references, all_predictions)])
+        errors = self.metrics_calculator.compute_word_errors(all_references, all_predictions)
+        wer_scores = errors.utterance_wer()
+        print(f"Corpus WER {errors.corpus_wer():.3f} ({int(errors.errors.sum())} errors / {int(errors.reference_words.sum())} reference words)")
         bertscore = self.metrics_calculator.compute_bertscore(all_predictions, all_references)
         metrics = {
             'WER': round(wer_scores.mean().item(), 3),
@@ -115,12 +325,13 @@ class EvaluationPipeline:
         }
         return metrics
 
-    async def run_evaluation(self, dataset: Dataset, model: str, llm_client: 'LLMClient', generation_config: dict, results_path: str):
+    async def run_evaluation(self, dataset: Union[Dataset, str], model: str, llm_client: 'LLMClient', generation_config: dict, results_path: str):
         """
         Runs evaluation for all defined correction strategies.
 
         Args:
-            dataset (Dataset): The dataset to evaluate on.
+            dataset (Union[Dataset, str]): The dataset to evaluate on, or the path of a data JSON file or of a
+                columnar N-best store directory (see DataHandler.load_corpus).
             model (str): The name of the language model.
             llm_client (LLMClient): Instance of LLMClient.
             generation_config (dict): Generation configuration for the language model.
@@ -129,17 +340,24 @@ class EvaluationPipeline:
         Returns:
             pd.DataFrame: DataFrame containing the evaluation metrics for each strategy.
         """
-        print("Evaluating One-shot Unconstrained:")
-        metrics_one_shot_unconstrained = await self.evaluate_model_parallel(dataset, model, llm_client, OneShotUnconstrainedCorrection(), generation_config, results_path)
+        # Retain generations across strategies: One-shot Closest then reuses the One-shot Unconstrained outputs
+        since = llm_client.coalescer.snapshot()
+        with llm_client.coalescer.retain():
+            print("Evaluating One-shot Unconstrained:")
+            metrics_one_shot_unconstrained = await self.evaluate_model_parallel(dataset, model, llm_client, OneShotUnconstrainedCorrection(), generation_config, results_path, export=False)
 
-        print("Evaluating One-shot Closest:")
-        metrics_one_shot_closest = await self.evaluate_model_parallel(dataset, model, llm_client, OneShotClosestCorrection(self.metrics_calculator), generation_config, results_path) # Pass metrics_calculator
+            print("Evaluating One-shot Closest:")
+            metrics_one_shot_closest = await self.evaluate_model_parallel(dataset, model, llm_client, OneShotClosestCorrection(self.metrics_calculator), generation_config, results_path, export=False) # Pass metrics_calculator
+        print(llm_client.coalescer.summary(since))
 
         print("Evaluating Oracle:")
-        metrics_oracle = await self.evaluate_model_parallel(dataset, model, llm_client, OracleHypothesisSelection(self.metrics_calculator), generation_config, results_path) # Pass metrics_calculator
+        metrics_oracle = await self.evaluate_model_parallel(dataset, model, llm_client, OracleHypothesisSelection(self.metrics_calculator), generation_config, results_path, export=False) # Pass metrics_calculator
 
         print("Evaluating Top 1:")
-        metrics_top1 = await self.evaluate_model_parallel(dataset, model, llm_client, Top1HypothesisSelection(), generation_config, results_path)
+        metrics_top1 = await self.evaluate_model_parallel(dataset, model, llm_client, Top1HypothesisSelection(), generation_config, results_path, export=False)
+
+        # One wide JSON rewrite per run instead of one per strategy
+        self.data_handler.export_results(dataset, results_path)
 
         results_table = {
             "Top 1": metrics_top1,
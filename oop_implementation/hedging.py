@@ -0,0 +1,157 @@
+import time
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+from endpoint_pool import avoided_endpoints, routed_endpoints
+
+
+class HedgePolicy:
+    """
+    Request hedging: a request outstanding longer than a latency percentile of its (model, endpoint) is duplicated,
+    on another replica of an EndpointPool when there is one; the first success wins and the other is cancelled.
+    """
+
+    def __init__(self, percentile: float = 95.0, min_samples: int = 20, max_rate: float = 0.1, window: int = 1000):
+        """
+        Initialize the policy.
+
+        Args:
+            percentile (float): Latency percentile after which a request is hedged.
+            min_samples (int): Latencies needed before requests are hedged.
+            max_rate (float): Maximum fraction of hedged requests, which caps the extra cost.
+            window (int): Number of recent latencies kept per (model, endpoint).
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_rate = max_rate
+        self.window = window
+        self.latencies: Dict[Hashable, Deque[float]] = {}
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "cancelled": 0, "extra_tokens": 0}
+
+    def record(self, key: Hashable, latency: float):
+        """
+        Record the latency of a successful request.
+
+        Args:
+            key (Hashable): The (model, endpoint) of the request.
+            latency (float): Seconds from sending to the answer.
+        """
+        if key not in self.latencies:
+            self.latencies[key] = deque(maxlen=self.window)
+        self.latencies[key].append(latency)
+
+    def delay(self, key: Hashable) -> Optional[float]:
+        """
+        Get the time to wait before hedging a request.
+
+        Args:
+            key (Hashable): The (model, endpoint) of the request.
+
+        Returns:
+            Optional[float]: Seconds to wait, or None when the request must not be hedged.
+        """
+        latencies = self.latencies.get(key)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+        if self.stats["hedged"] >= self.max_rate * max(self.stats["requests"], 1):
+            return None
+        return float(np.percentile(latencies, self.percentile))
+
+    def snapshot(self) -> dict:
+        """
+        Copy the counters, so that a later summary can report only what happened after this point.
+
+        Returns:
+            dict: The counters so far.
+        """
+        return dict(self.stats)
+
+    def summary(self, since: Optional[dict] = None) -> str:
+        """
+        Format the hedging statistics.
+
+        Args:
+            since (Optional[dict]): A snapshot() taken at the start of the run to report. Defaults to the whole process.
+
+        Returns:
+            str: One line with hedge rate, wins and extra cost.
+        """
+        stats = self.stats if since is None else {key: value - since.get(key, 0) for key, value in self.stats.items()}
+        requests = max(stats["requests"], 1)
+        return (f"Hedging: {stats['hedged']}/{stats['requests']} requests hedged ({stats['hedged'] / requests:.1%}), "
+                f"{stats['hedge_wins']} won by the hedge, {stats['cancelled']} cancelled, "
+                f"~{stats['extra_tokens']} extra tokens")
+
+
+class _Attempt:
+    def __init__(self):
+        self.sent = asyncio.Event()
+        self.sent_at = None
+
+    def mark_sent(self):
+        self.sent_at = time.monotonic()
+        self.sent.set()
+
+
+async def _routed(send: Callable[..., Awaitable], attempt: _Attempt, route: List[str], avoid: Sequence[str] = ()):
+    # Runs in its own task, so the context variables only steer this copy of the request
+    routed_endpoints.set(route)
+    avoided_endpoints.set(tuple(avoid))
+    result = await send(attempt.mark_sent)
+    return result, time.monotonic() - (attempt.sent_at or time.monotonic())
+
+
+async def hedged(send: Callable[..., Awaitable], policy: HedgePolicy, key: Hashable, estimated_tokens: int = 0):
+    """
+    Perform one request, hedging it according to the policy. The hedge delay runs from the moment the request leaves
+    the request limiter, so time spent queueing in the limiter never triggers a hedge.
+
+    Args:
+        send (Callable[..., Awaitable]): Coroutine function performing the request; it calls its on_sent argument
+            once the request leaves the limiter.
+        policy (HedgePolicy): The hedging policy, whose statistics are updated.
+        key (Hashable): The (model, endpoint) of the request.
+        estimated_tokens (int): Estimated token cost of one copy of the request.
+
+    Returns:
+        The result of the first copy that succeeded.
+    """
+    policy.stats["requests"] += 1
+    route: List[str] = []
+    attempt = _Attempt()
+    primary = asyncio.ensure_future(_routed(send, attempt, route))
+    tasks = [primary]
+    try:
+        sent = asyncio.ensure_future(attempt.sent.wait())
+        await asyncio.wait([primary, sent], return_when=asyncio.FIRST_COMPLETED)
+        sent.cancel()
+        delay = policy.delay(key)
+        if delay is not None and not primary.done():
+            await asyncio.wait([primary], timeout=delay)
+            if not primary.done():
+                policy.stats["hedged"] += 1
+                policy.stats["extra_tokens"] += estimated_tokens
+                tasks.append(asyncio.ensure_future(_routed(send, _Attempt(), [], avoid=route)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    result, latency = task.result()
+                    policy.record(key, latency)
+                    if task is not primary:
+                        policy.stats["hedge_wins"] += 1
+                    return result
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                policy.stats["cancelled"] += 1
+        # Let the losers release their limiter slots and connections before returning
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,58 +1,318 @@
+import copy
+import time
 import openai
 import asyncio
-from typing import List, Dict
+from typing import List, Dict, Optional, Union
+
+from rate_limiter import RequestLimiter, endpoint_key, estimate_request_tokens, retry_after_seconds
+from response_cache import ResponseCache, request_key
+from single_flight import SingleFlight
+from endpoint_pool import EndpointPool, pinned_endpoint
+from resilience import CircuitBreaker, LLMRequestError, RetryPolicy, classify_error
+from answer_stream import StreamingMode, stream_completion
+from hedging import HedgePolicy, hedged
+from local_backend import LocalChatModel
+from token_budget import TokenBudget, is_reasoning_model
+from reasoning import ReasoningMode, reasoning_completion
+from prompt_templates import PROMPT_LAYOUTS
 
 class LLMClient:
     """
     A class to handle interactions with a Language Model API (like OpenAI).
     """
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, max_concurrency: Optional[int] = None, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None, cache: Optional[ResponseCache] = None,
+                 endpoints: Optional[Dict[str, Union[str, List[str]]]] = None, adaptive: Optional[Dict[str, float]] = None,
+                 retry_policy: Optional[RetryPolicy] = None, breaker_settings: Optional[Dict[str, float]] = None,
+                 streaming: Optional[StreamingMode] = None, hedging: Optional[HedgePolicy] = None,
+                 local_model: Optional[LocalChatModel] = None, token_budget: Optional[TokenBudget] = None,
+                 reasoning: Optional[ReasoningMode] = None, prompt_layout: str = "original"):
         """
         Initialize the LLMClient with an API key.
 
         Args:
             api_key (str): The API key for accessing the LLM service.
+            max_concurrency (Optional[int]): Maximum number of requests in flight across all strategies and models.
+            requests_per_minute (Optional[float]): Request budget per model (see RequestLimiter.set_model_limits for overrides).
+            tokens_per_minute (Optional[float]): Token budget per model.
+            cache (Optional[ResponseCache]): Response cache consulted by get_prediction. No caching if None.
+            endpoints (Optional[Dict[str, Union[str, List[str]]]]): Model name -> base URLs of OpenAI-compatible replicas.
+                If given, requests are load-balanced over the replicas instead of going to the OpenAI API.
+            adaptive (Optional[Dict[str, float]]): Settings of an AIMD concurrency controller per (model, replica), e.g.
+                rate_limiter.DEFAULT_ADAPTIVE. No adaptive concurrency if None.
+            retry_policy (Optional[RetryPolicy]): Retry budget and per-request deadline. Defaults to RetryPolicy().
+            breaker_settings (Optional[Dict[str, float]]): Keyword arguments of the per-endpoint CircuitBreaker.
+            streaming (Optional[StreamingMode]): If given, completions are streamed and cut off as soon as the answer
+                line is complete, and time-to-first-token / time-to-answer are recorded in streaming.stats.
+            hedging (Optional[HedgePolicy]): If given, requests slower than its latency percentile are duplicated
+                (on another replica when endpoints are given) and the first answer wins.
+            local_model (Optional[LocalChatModel]): If given, requests are answered by this in-process model instead
+                of an API server.
+            token_budget (Optional[TokenBudget]): If given, each item's max_tokens is derived from its hypotheses
+                (see item_config) and truncated completions are counted.
+            reasoning (Optional[ReasoningMode]): If given, reasoning models think within its budget and then answer
+                within the request's max_tokens; think tokens are recorded in reasoning.stats.
+            prompt_layout (str): Layout the strategies render their prompts in: "original", or "prefix" to move the
+                instructions in front of the hypotheses where possible (see PromptTemplate). Defaults to "original".
+        """
+        if local_model is not None:
+            self.client = local_model
+        elif endpoints:
+            self.client = EndpointPool(endpoints, api_key=api_key or "EMPTY")
+        else:
+            self.client = openai.AsyncOpenAI(api_key=api_key)
+        # One limiter per client; the pipeline shares a single client across every strategy and model
+        self.limiter = RequestLimiter(max_concurrency, requests_per_minute, tokens_per_minute, adaptive)
+        self.cache = cache
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker_settings = breaker_settings or {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.streaming = streaming
+        self.hedging = hedging
+        self.token_budget = token_budget
+        self.reasoning = reasoning
+        if prompt_layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown prompt layout {prompt_layout!r}; use one of {PROMPT_LAYOUTS}")
+        self.prompt_layout = prompt_layout
+        # Identical concurrent requests share one call; see EvaluationPipeline.run_evaluation for cross-strategy reuse
+        self.coalescer = SingleFlight()
+
+    def item_config(self, generation_config: Dict, hypotheses: List[str], model: str) -> Dict:
+        """
+        Get the generation configuration of one item.
+
+        Args:
+            generation_config (Dict): The run's generation configuration.
+            hypotheses (List[str]): The item's ASR hypotheses.
+            model (str): The name of the language model.
+
+        Returns:
+            Dict: The configuration with the item's max_tokens if a token budget is set, else generation_config.
         """
-        self.client = openai.AsyncOpenAI(api_key=api_key)
+        if self.token_budget is None:
+            return generation_config
+        return self.token_budget.apply(generation_config, hypotheses, model)
+
+    def circuit_breaker(self, endpoint: str) -> CircuitBreaker:
+        """
+        Get the circuit breaker of an endpoint.
+
+        Args:
+            endpoint (str): The endpoint identifier.
+
+        Returns:
+            CircuitBreaker: The endpoint's breaker.
+        """
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(**self.breaker_settings)
+        return self.breakers[endpoint]
 
     async def call_openai_with_retry(self, messages: List[Dict[str, str]], model: str, generation_config: Dict) -> openai.ChatCompletion: # Corrected Definition - Removed 'client' argument
         """
-        Handles API retries with exponential backoff for OpenAI API calls.
+        Handles API retries with jittered exponential backoff for OpenAI API calls, bounded by the client's retry policy.
+        Every attempt waits for the client's rate limiter, whose optional adaptive controller sizes the concurrency of each
+        replica from latency, 429/5xx and rate-limit headers, and passes the endpoint's circuit breaker. In streaming mode the completion is
+        cut off as soon as its answer line is complete. With hedging, a slow attempt is duplicated and the first answer wins.
+        In reasoning mode, reasoning models think within a bounded budget and then answer (see ReasoningMode).
+
+        Raises:
+            LLMRequestError: If the request fails for good.
         """
-        retry_delay = 0.1  # Initial delay in seconds
-        while True:
-            try:
-                # Attempt to make the API call
-                generation = await self.client.chat.completions.create( # Using self.client here
+        policy = self.retry_policy
+        deadline = time.monotonic() + policy.deadline
+        reasoning = self.reasoning if is_reasoning_model(model) else None
+        estimated_tokens = estimate_request_tokens(messages, generation_config)
+        if reasoning is not None:
+            estimated_tokens += reasoning.think_budget * generation_config.get("n", 1)
+        endpoint = endpoint_key(self.client)
+        breaker = self.circuit_breaker(endpoint)
+        completions = self.client.chat.completions # Using self.client here
+
+        async def request(ticket) -> openai.ChatCompletion:
+            if reasoning is not None:
+                return await reasoning_completion(completions, model, messages, generation_config, reasoning, ticket)
+            if self.streaming is not None:
+                return await stream_completion(completions, model, messages, generation_config, self.streaming, ticket)
+            if hasattr(completions, "with_raw_response"):
+                # The raw response carries the x-ratelimit-* headers
+                response = await completions.with_raw_response.create(
                     model=model,
                     messages=messages,
                     **generation_config
                 )
+                ticket.headers = response.headers
+                return response.parse()
+            return await completions.create(
+                model=model,
+                messages=messages,
+                **generation_config
+            )
+
+        async def send(on_sent=None) -> openai.ChatCompletion:
+            nonlocal deadline, sent
+            # The replicas of a pool each have their own controller: pick the replica first and pin the request to it
+            replica = self.client.select(model) if isinstance(self.client, EndpointPool) else None
+            pinned = pinned_endpoint.set(replica)
+            queued_at = time.monotonic()
+            try:
+                async with self.limiter.slot(model, estimated_tokens, endpoint if replica is None else replica.base_url) as ticket:
+                    if not sent:
+                        # Time queued in the local limiter is not the endpoint's: it does not count against the deadline
+                        # (a hedge only queues while the first copy is already out)
+                        deadline += time.monotonic() - queued_at
+                        sent = True
+                    if on_sent is not None:
+                        on_sent()
+                    return await asyncio.wait_for(request(ticket), max(deadline - time.monotonic(), 0))
+            finally:
+                pinned_endpoint.reset(pinned)
+
+        for attempt in range(1, policy.max_attempts + 1):
+            breaker.check()
+            sent = False
+            try:
+                # Attempt to make the API call within the request deadline, which runs while requests are out or backing off
+                attempt_coroutine = hedged(send, self.hedging, (model, endpoint), estimated_tokens) if self.hedging is not None else send()
+                generation = await attempt_coroutine
+                breaker.record_success()
+                usage = getattr(generation, "usage", None)
+                self.limiter.record_usage(model, estimated_tokens, getattr(usage, "total_tokens", None))
                 return generation
 
             except Exception as e:
-                await asyncio.sleep(retry_delay)
-                retry_delay = min(retry_delay * 2, 10)  # Exponential backoff up to 10s
+                kind = classify_error(e)
+                # 429s and 4xx mean the endpoint answered: it is busy or the request is bad, not the endpoint broken.
+                # An attempt that failed before leaving the limiter says nothing about the endpoint either way
+                if sent and kind == "transient":
+                    breaker.record_failure()
+                elif sent:
+                    breaker.record_success()
+                if kind == "fatal":
+                    raise LLMRequestError(f"{type(e).__name__}: {e}") from e
+                if attempt == policy.max_attempts:
+                    raise LLMRequestError(f"Gave up after {attempt} attempts, last error {type(e).__name__}: {e}") from e
+                wait_time = None
+                if kind == "rate_limit" and getattr(e, "response", None) is not None:
+                    wait_time = retry_after_seconds(e.response.headers)
+                if wait_time is None:
+                    wait_time = policy.backoff(attempt)
+                if time.monotonic() + wait_time >= deadline:
+                    raise LLMRequestError(f"Deadline of {policy.deadline:.0f}s exceeded after {attempt} attempts, last error {type(e).__name__}: {e}") from e
+                await asyncio.sleep(wait_time)
 
-    async def get_prediction(self, model: str, messages: List[Dict[str, str]], generation_config: Dict) -> str:
+    async def get_prediction(self, model: str, messages: List[Dict[str, str]], generation_config: Dict, sample: Optional[int] = None) -> str:
         """
-        Asynchronously fetch predictions from the LLM API.
+        Asynchronously fetch predictions from the LLM API. Identical concurrent (or, inside coalescer.retain(), repeated)
+        requests share one call, and identical requests are answered from the response cache if one is set.
 
         Args:
             model (str): The name of the language model to use.
             messages (List[Dict[str, str]]): The list of messages for the chat completion.
             generation_config (Dict): Configuration parameters for text generation.
+            sample (Optional[int]): Sample index of the request in the cache key. Defaults to the cache's sample index.
 
         Returns:
-            str: The predicted text content, or an empty string in case of error.
-        """
-        try:
-            generation = await self.call_openai_with_retry(messages, model, generation_config)
-            return generation.choices[0].message.content if generation else ""
-        except Exception as e:
-            print(f"Error: {e}")
-            return ""
+            str: The predicted text content.
+
+        Raises:
+            LLMRequestError: If the request fails for good.
+        """
+        return (await self.get_predictions(model, messages, generation_config, sample))[0]
+
+    async def get_predictions(self, model: str, messages: List[Dict[str, str]], generation_config: Dict, sample: Optional[int] = None) -> List[str]:
+        """
+        Like get_prediction, but return every choice: with "n" in the generation config, the n samples of one call.
+
+        Args:
+            model (str): The name of the language model to use.
+            messages (List[Dict[str, str]]): The list of messages for the chat completion.
+            generation_config (Dict): Configuration parameters for text generation.
+            sample (Optional[int]): Sample index of the request in the cache key. Defaults to the cache's sample index.
+
+        Returns:
+            List[str]: The text content of every choice.
+
+        Raises:
+            LLMRequestError: If the request fails for good.
+        """
+        if sample is None:
+            sample = self.cache.sample if self.cache is not None else 0
+        # Bounded-thinking outputs differ from plain ones, so they are cached under their own key
+        if self.reasoning is not None and is_reasoning_model(model):
+            key = request_key(model, messages, {**generation_config, "reasoning": self.reasoning.signature()}, sample)
+        else:
+            key = request_key(model, messages, generation_config, sample)
+        return await self.coalescer.run(key, lambda: self._fetch_predictions(model, messages, generation_config, key))
+
+    async def _fetch_predictions(self, model: str, messages: List[Dict[str, str]], generation_config: Dict, key: str) -> List[str]:
+        """
+        Answer one request from the response cache or the API. Failures raise, so they are never cached or checkpointed.
+
+        Args:
+            model (str): The name of the language model to use.
+            messages (List[Dict[str, str]]): The list of messages for the chat completion.
+            generation_config (Dict): Configuration parameters for text generation.
+            key (str): The request key.
+
+        Returns:
+            List[str]: The text content of every choice.
+
+        Raises:
+            LLMRequestError: If the request fails for good.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        generation = await self.call_openai_with_retry(messages, model, generation_config)
+        if not generation:
+            return [""]
+        if self.token_budget is not None:
+            self.token_budget.record(generation, generation_config)
+        outputs = [choice.message.content for choice in generation.choices]
+        if self.cache is not None:
+            self.cache.put(key, model, outputs)
+        return outputs
+
+    def with_client(self, client) -> 'LLMClient':
+        """
+        Get a copy of this LLMClient that sends its requests through another client, e.g. a batch stand-in.
+
+        Args:
+            client: An openai.AsyncOpenAI-compatible client.
+
+        Returns:
+            LLMClient: The copy, sharing limiter, cache and retry settings, with its own coalescer and breakers.
+        """
+        routed = copy.copy(self)
+        routed.client = client
+        routed.coalescer = SingleFlight()
+        routed.breakers = {}
+        return routed
+
+    async def wait_until_available(self, model: str, interval: float = 10.0):
+        """
+        Wait until the model answers a chat request, retrying without blocking the event loop.
+
+        Args:
+            model (str): The name of the language model to check.
+            interval (float): Seconds between attempts.
+        """
+        if isinstance(self.client, EndpointPool):
+            await self.client.wait_until_available(model, interval)
+            self.client.start_health_checks(interval)
+        output = None
+        while output is None:
+            try:
+                output = await self.client.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": "Please introduce yourself."}],
+                )
+            except openai.APIError as e:
+                print(e)
+                await asyncio.sleep(interval)
+        print(output.choices[0].message.content)
 
     def construct_input_prompt(self, question: str) -> List[Dict[str, str]]:
         """
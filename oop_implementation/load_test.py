@@ -0,0 +1,241 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+from typing import Dict, List, Optional, Sequence
+
+import httpx
+import pandas as pd
+from datasets import Dataset
+
+from metrics import MetricsCalculator
+from data_handler import DataHandler
+from llm_client import LLMClient
+from correction_strategies import CorrectionStrategy, OneShotUnconstrainedCorrection
+from evaluation_pipeline import EvaluationPipeline
+from utils import ProgressTracker
+
+
+def rss_mb() -> float:
+    """
+    Get the resident memory of this process.
+
+    Returns:
+        float: Current RSS in MB (the peak so far where /proc is unavailable).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class ResourceSampler:
+    """
+    Context manager measuring one run: wall and client CPU time, plus resident memory and event loop lag (how late
+    a short sleep wakes up) sampled while the run is in progress.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        """
+        Initialize the sampler.
+
+        Args:
+            interval (float): Seconds between samples.
+        """
+        self.interval = interval
+        self.peak_rss = 0.0
+        self.max_lag = 0.0
+        self.cpu = 0.0
+        self.wall = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.max_lag = max(self.max_lag, loop.time() - start - self.interval)
+            self.peak_rss = max(self.peak_rss, rss_mb())
+
+    def __enter__(self) -> 'ResourceSampler':
+        self.peak_rss = rss_mb()
+        self._cpu_start, self._wall_start = time.process_time(), time.perf_counter()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.cpu = time.process_time() - self._cpu_start
+        self.wall = time.perf_counter() - self._wall_start
+        self.peak_rss = max(self.peak_rss, rss_mb())
+
+
+class NoBertScoreMetricsCalculator(MetricsCalculator):
+    """
+    MetricsCalculator that skips the BERTScore model (zeros instead), so a load test measures the pipeline, not the scorer.
+    """
+
+    def compute_bertscore(self, references: List[str], hypotheses: List[str]) -> dict:
+        return {'precision': 0.0, 'recall': 0.0, 'f1': 0.0}
+
+
+def start_mock_server(port: int, server_args: Sequence[str] = ()) -> subprocess.Popen:
+    """
+    Start mock_server.py in a child process, so its CPU and memory are not counted as the client's.
+
+    Args:
+        port (int): Port of the server.
+        server_args (Sequence[str]): Further command line arguments of mock_server.py.
+
+    Returns:
+        subprocess.Popen: The server process.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen([sys.executable, os.path.join(here, "mock_server.py"), "--port", str(port), *server_args], cwd=here)
+
+
+async def wait_for_server(base_url: str, timeout: float = 30.0):
+    """
+    Wait until the server answers /models.
+
+    Args:
+        base_url (str): Base URL of the server, ending in /v1.
+        timeout (float): Seconds before giving up.
+    """
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while True:
+            try:
+                (await http.get(f"{base_url}/models")).raise_for_status()
+                return
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def server_stats(base_url: str, reset_peak: bool = False) -> Dict[str, int]:
+    """
+    Get the counters of a mock server.
+
+    Args:
+        base_url (str): Base URL of the server, ending in /v1.
+        reset_peak (bool): Restart the server's max_in_flight, so the next read is the peak since this one.
+            Defaults to False.
+
+    Returns:
+        Dict[str, int]: The counters of MockLLMServer.stats.
+    """
+    async with httpx.AsyncClient() as http:
+        return (await http.get(base_url.rsplit("/v1", 1)[0] + "/mock/stats", params={"reset_peak": 1} if reset_peak else None)).json()
+
+
+async def load_test(dataset: Dataset, base_url: str, concurrency_levels: Sequence[int] = (1, 8, 64, 256),
+                    entry_point: str = "evaluate_model_parallel", correction_strategy: Optional[CorrectionStrategy] = None,
+                    model: str = "mock", generation_config: Optional[dict] = None, results_dir: Optional[str] = None,
+                    bertscore: bool = False) -> pd.DataFrame:
+    """
+    Run an entry point of the EvaluationPipeline against an OpenAI-compatible server once per concurrency level,
+    each into fresh results files, and tabulate throughput, client CPU, peak memory and event loop lag.
+
+    Args:
+        dataset (Dataset): The dataset to evaluate on.
+        base_url (str): Base URL of the server, ending in /v1.
+        concurrency_levels (Sequence[int]): Values of the LLMClient's max_concurrency to test.
+        entry_point (str): "evaluate_model_parallel" (with correction_strategy) or "run_evaluation".
+        correction_strategy (Optional[CorrectionStrategy]): Strategy of evaluate_model_parallel. Defaults to
+            OneShotUnconstrainedCorrection.
+        model (str): Model name sent to the server.
+        generation_config (Optional[dict]): Generation configuration. Defaults to 20 tokens at temperature 0.9.
+        results_dir (Optional[str]): Directory of the per-level results files, each in a new subdirectory so a rerun never
+            replays checkpointed outputs. Defaults to a temporary directory.
+        bertscore (bool): Include the BERTScore model in the metrics. Defaults to False.
+
+    Returns:
+        pd.DataFrame: One row per concurrency level.
+    """
+    correction_strategy = correction_strategy or OneShotUnconstrainedCorrection()
+    generation_config = generation_config or {"max_tokens": 20, "temperature": 0.9}
+    results_dir = results_dir or tempfile.mkdtemp(prefix="load_test_")
+    metrics_calculator = MetricsCalculator() if bertscore else NoBertScoreMetricsCalculator()
+    pipeline = EvaluationPipeline(metrics_calculator, DataHandler(), ProgressTracker())
+    rows = []
+    for concurrency in concurrency_levels:
+        llm_client = LLMClient(api_key="EMPTY", max_concurrency=concurrency, endpoints={"*": [base_url]}, adaptive=None)
+        # A new directory per level and run: a checkpoint left by an earlier run would be replayed instead of requested
+        os.makedirs(results_dir, exist_ok=True)
+        results_path = os.path.join(tempfile.mkdtemp(prefix=f"c{concurrency}_", dir=results_dir), "test_load.json")
+        before = await server_stats(base_url, reset_peak=True)
+        with ResourceSampler() as usage:
+            if entry_point == "run_evaluation":
+                await pipeline.run_evaluation(dataset, model, llm_client, generation_config, results_path)
+            else:
+                await pipeline.evaluate_model_parallel(dataset, model, llm_client, correction_strategy, generation_config, results_path, resume=False)
+        after = await server_stats(base_url)
+        await llm_client.client.close()
+        requests = after["requests"] - before["requests"]
+        rows.append({
+            "entry point": entry_point,
+            "concurrency": concurrency,
+            "items": len(dataset),
+            "wall s": round(usage.wall, 2),
+            "items/s": round(len(dataset) / usage.wall, 1),
+            "requests/s": round(requests / usage.wall, 1),
+            "client CPU s": round(usage.cpu, 2),
+            "client CPU %": round(100 * usage.cpu / usage.wall, 1),
+            "CPU ms/request": round(1000 * usage.cpu / max(requests, 1), 2),
+            "peak RSS MB": round(usage.peak_rss, 1),
+            "max loop lag ms": round(1000 * usage.max_lag, 1),
+            "429s": after["rate_limited"] - before["rate_limited"],
+            "500s": after["errors"] - before["errors"],
+            "cancelled streams": after["cancelled"] - before["cancelled"],
+            "server max in flight": after["max_in_flight"],
+        })
+    return pd.DataFrame(rows)
+
+
+async def main(args: argparse.Namespace):
+    """
+    Run the load test from command line arguments.
+    """
+    df = pd.read_json(args.dataset)
+    dataset = Dataset.from_pandas(df.iloc[:args.limit] if args.limit else df)
+    base_url = args.base_url
+    server = None
+    if base_url is None:
+        server = start_mock_server(args.port, args.server_args)
+        base_url = f"http://127.0.0.1:{args.port}/v1"
+    try:
+        await wait_for_server(base_url)
+        table = await load_test(dataset, base_url, args.concurrency, args.entry_point, results_dir=args.results_dir, bertscore=args.bertscore)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print(table.to_string(index=False))
+    if args.output:
+        table.to_csv(args.output, index=False)
+        print(f"Load test table saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the EvaluationPipeline against a mock OpenAI-compatible server.")
+    parser.add_argument("--dataset", default="../data/test_cv.json", help="N-best JSON test set")
+    parser.add_argument("--limit", type=int, help="Only use the first LIMIT rows")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64, 256])
+    parser.add_argument("--entry-point", choices=["evaluate_model_parallel", "run_evaluation"], default="evaluate_model_parallel")
+    parser.add_argument("--base-url", help="Existing server to test instead of starting mock_server.py")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--results-dir", help="Directory of the per-level results files (default: a temporary directory)")
+    parser.add_argument("--bertscore", action="store_true", help="Include the BERTScore model in the metrics")
+    parser.add_argument("--output", help="Also save the table as CSV")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="Arguments for mock_server.py after --, e.g. -- --latency fixed:0.05 --error-rate 0.01")
+    args = parser.parse_args()
+    if args.server_args[:1] == ["--"]:
+        args.server_args = args.server_args[1:]
+    asyncio.run(main(args))
@@ -0,0 +1,207 @@
+import time
+import asyncio
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+
+# (model name, messages, generation config, future) of one queued request
+_Request = Tuple[str, List[Dict[str, str]], Dict, asyncio.Future]
+
+
+class _LocalCompletions:
+    def __init__(self, backend: 'LocalChatModel'):
+        self.backend = backend
+
+    async def create(self, model: str, messages: List[Dict[str, str]], stream: bool = False, **generation_config) -> ChatCompletion:
+        if stream:
+            raise ValueError("The local backend does not stream; create the LLMClient without streaming")
+        return await self.backend.submit(model, messages, generation_config)
+
+
+class LocalChatModel:
+    """
+    In-process transformers backend behind the AsyncOpenAI interface (client.chat.completions.create), so the
+    LLMClient and every strategy run against a local model without any network service. Concurrent requests are
+    coalesced into dynamic batches, and requests with the same temperature, top_p and n share one generate() call,
+    whatever their max_tokens.
+    """
+
+    def __init__(self, model_path: str, max_batch_size: int = 8, max_wait: float = 0.02, device: str = "cpu",
+                 threads: Optional[int] = None):
+        """
+        Initialize the backend; the model is loaded on first use.
+
+        Args:
+            model_path (str): Hugging Face model id or local directory of a chat model.
+            max_batch_size (int): Maximum number of requests per batch.
+            max_wait (float): Seconds the first queued request waits for others to join its batch.
+            device (str): Torch device of the model.
+            threads (Optional[int]): Number of CPU threads for torch. Defaults to torch's choice.
+        """
+        self.model_path = model_path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.device = device
+        self.threads = threads
+        self.base_url = f"local://{model_path}"
+        self.chat = SimpleNamespace(completions=_LocalCompletions(self))
+        self.tokenizer = None
+        self.model = None
+        self._loop = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {"requests": 0, "batches": 0, "generate_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "busy": 0.0}
+
+    def load(self):
+        """
+        Load the tokenizer and the model if not loaded yet.
+        """
+        if self.model is not None:
+            return
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        # Decoder-only batches are left-padded so every prompt ends where generation starts
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        self.tokenizer = tokenizer
+        self.model = AutoModelForCausalLM.from_pretrained(self.model_path).to(self.device).eval()
+
+    def _primitives(self) -> asyncio.Queue:
+        # The queue and the batching task belong to the running event loop; recreate them when it changes
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._batch_loop(self._queue))
+        return self._queue
+
+    async def submit(self, model: str, messages: List[Dict[str, str]], generation_config: Dict) -> ChatCompletion:
+        """
+        Queue one chat completion request and wait for its batch.
+
+        Args:
+            model (str): Model name reported in the completion.
+            messages (List[Dict[str, str]]): The chat messages.
+            generation_config (Dict): Generation parameters (max_tokens, temperature, top_p, n).
+
+        Returns:
+            ChatCompletion: The completion.
+        """
+        queue = self._primitives()
+        future = asyncio.get_running_loop().create_future()
+        self.stats["requests"] += 1
+        await queue.put((model, messages, generation_config, future))
+        return await future
+
+    async def _batch_loop(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            self.stats["batches"] += 1
+            # Only requests with the same temperature, top_p and n can share a generate() call; each keeps its own max_tokens
+            groups: Dict[Tuple[float, float, int], List[_Request]] = {}
+            for request in batch:
+                config = request[2]
+                groups.setdefault((config.get("temperature", 1.0), config.get("top_p", 1.0), config.get("n", 1)), []).append(request)
+            for group in groups.values():
+                live = [request for request in group if not request[3].done()]
+                if not live:
+                    continue
+                try:
+                    # Batches run one at a time in a worker thread, so the event loop stays responsive
+                    completions = await asyncio.to_thread(self._generate, live)
+                except Exception as e:
+                    for *_, future in live:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (*_, future), completion in zip(live, completions):
+                    if not future.done():
+                        future.set_result(completion)
+
+    def _generate(self, requests: List[_Request]) -> List[ChatCompletion]:
+        self.load()
+        start = time.perf_counter()
+        generation_config = requests[0][2]
+        n = generation_config.get("n", 1)
+        temperature = generation_config.get("temperature", 1.0)
+        budgets = [config.get("max_tokens", 256) for _, _, config, _ in requests]
+        prompts = [self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False) for _, messages, _, _ in requests]
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False).to(self.device)
+        # The group runs to its largest budget; every completion is then cut to its own max_tokens
+        kwargs = {"max_new_tokens": max(budgets), "pad_token_id": self.tokenizer.pad_token_id}
+        if temperature > 0:
+            kwargs.update(do_sample=True, temperature=temperature, top_p=generation_config.get("top_p", 1.0), num_return_sequences=n)
+        else:
+            kwargs.update(do_sample=False)
+        with torch.inference_mode():
+            output = self.model.generate(**inputs, **kwargs)
+        new_tokens = output[:, inputs["input_ids"].shape[1]:]
+        per_request = n if temperature > 0 else 1
+        row_budgets = [budgets[row // per_request] for row in range(len(new_tokens))]
+        texts = self.tokenizer.batch_decode([tokens[:budget] for tokens, budget in zip(new_tokens, row_budgets)], skip_special_tokens=True)
+        lengths = [min(length, budget) for length, budget in zip((new_tokens != self.tokenizer.pad_token_id).sum(dim=1).tolist(), row_budgets)]
+        completions = []
+        for i, attention_mask in enumerate(inputs["attention_mask"]):
+            # Greedy decoding is deterministic: every requested choice is the same sequence
+            rows = [i * per_request + j for j in range(per_request)] * (n // per_request)
+            prompt_tokens = int(attention_mask.sum())
+            completion_tokens = sum(lengths[row] for row in rows)
+            choices = [Choice(index=j, finish_reason="length" if lengths[row] >= budgets[i] else "stop",
+                              message=ChatCompletionMessage(role="assistant", content=texts[row]))
+                       for j, row in enumerate(rows)]
+            completions.append(ChatCompletion(id=f"local-{self.stats['generate_calls']}-{i}", object="chat.completion", created=int(time.time()),
+                                              model=requests[i][0], choices=choices,
+                                              usage=CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                                                    total_tokens=prompt_tokens + completion_tokens)))
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+        self.stats["generate_calls"] += 1
+        self.stats["busy"] += time.perf_counter() - start
+        return completions
+
+    def snapshot(self) -> dict:
+        """
+        Copy the counters, so that a later summary can report only what happened after this point.
+
+        Returns:
+            dict: The counters so far.
+        """
+        return dict(self.stats)
+
+    def summary(self, since: Optional[dict] = None) -> str:
+        """
+        Format batching and throughput statistics.
+
+        Args:
+            since (Optional[dict]): A snapshot() taken at the start of the run to report. Defaults to the whole process.
+
+        Returns:
+            str: One line with requests, batch size and generation throughput.
+        """
+        stats = self.stats if since is None else {key: value - since.get(key, 0) for key, value in self.stats.items()}
+        calls = max(stats["generate_calls"], 1)
+        return (f"Local backend: {stats['requests']} requests in {stats['generate_calls']} generate calls "
+                f"(mean batch {stats['requests'] / calls:.1f}), {stats['completion_tokens']} tokens generated in "
+                f"{stats['busy']:.1f}s ({stats['completion_tokens'] / max(stats['busy'], 1e-9):.1f} tokens/s)")
+
+    async def close(self):
+        """
+        Stop the batching task.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
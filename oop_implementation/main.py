@@ -4,12 +4,12 @@ import asyncio
 import nest_asyncio
 from datasets import Dataset
 from dotenv import load_dotenv
-from time import sleep
 import logging
 
 from metrics import MetricsCalculator
 from data_handler import DataHandler
 from llm_client import LLMClient
+from local_backend import LocalChatModel
 from correction_strategies import (
     ZeroShotUnconstrainedCorrection,
     ZeroShotConstrainedCorrection,
@@ -35,7 +35,12 @@ async def main():
     metrics_calculator = MetricsCalculator()
     data_handler = DataHandler()
     progress_tracker = ProgressTracker()
-    llm_client = LLMClient(api_key=os.environ.get("OPENAI_API_KEY"))
+    # Comma-separated base URLs of OpenAI-compatible replicas, e.g. "http://gpu1:8000/v1,http://gpu2:8000/v1"
+    replicas = [url for url in os.environ.get("LLM_ENDPOINTS", "").split(",") if url]
+    # Path or id of a small chat model to run in-process on CPU instead of calling a server
+    local_model_path = os.environ.get("LOCAL_MODEL_PATH")
+    llm_client = LLMClient(api_key=os.environ.get("OPENAI_API_KEY"), endpoints={"*": replicas} if replicas else None,
+                           local_model=LocalChatModel(local_model_path) if local_model_path else None)
 
     evaluation_pipeline = EvaluationPipeline(metrics_calculator, data_handler, progress_tracker)
 
@@ -45,17 +50,7 @@ async def main():
     #moderate_generation_config = {"max_tokens": 200, "temperature": 0.9} # If needed later
 
     # Basic model availability check (you can remove or adjust this)
-    output = None
-    while output is None:
-        try:
-            output = await llm_client.client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": "Please introduce yourself."}],
-            )
-        except openai.APIError as e: # Assuming openai is imported in main if you are using openai check.
-            print(e)
-            sleep(10)
-    print(output.choices[0].message.content)
+    await llm_client.wait_until_available(model)
 
     # Load Dataset - adjust path if needed
     df = pd.read_csv("~/projects/ASR-Error-Correction/data/test_cv.csv").iloc[:100]
@@ -1,10 +1,12 @@
 import jiwer
+from rapidfuzz.distance import Levenshtein
 import numpy as np
 from sacrebleu import corpus_bleu
 from nltk.translate.meteor_score import meteor_score
 from bert_score import BERTScorer
 import nltk
-from typing import List
+from typing import List, Optional
+from wer import WordErrors, WordInterner, word_errors
 
 
 nltk.download('wordnet', quiet=True)
@@ -27,6 +29,21 @@ class MetricsCalculator:
             float: The WER score.
         """
         return jiwer.wer(reference, hypothesis)
+
+    def compute_word_errors(self, references: List[str], hypotheses: List[str],
+                            interner: Optional[WordInterner] = None) -> WordErrors:
+        """
+        Compute the word errors of many (reference, hypothesis) pairs in one vectorized pass.
+
+        Args:
+            references (List[str]): A list of reference transcripts.
+            hypotheses (List[str]): A list of hypothesis transcripts.
+            interner (Optional[WordInterner]): Interner shared across calls over the same corpus. Defaults to None.
+
+        Returns:
+            WordErrors: Per-pair counts, with the per-utterance WERs (as compute_wer) and the pooled corpus WER.
+        """
+        return word_errors(references, hypotheses, interner)
   
     def compute_bleu(self, references: List[str], hypotheses: List[str]) -> float:
         """
@@ -77,7 +94,7 @@ class MetricsCalculator:
 
     def compute_levenshtein_distance(self, s1: str, s2: str) -> int:
         """
-        Compute the Levenshtein distance between two strings.
+        Compute the (character-level) Levenshtein distance between two strings, with rapidfuzz's C++ implementation.
 
         Args:
             s1 (str): The first string.
@@ -86,19 +103,4 @@ class MetricsCalculator:
         Returns:
             int: The Levenshtein distance.
         """
-        len_s1, len_s2 = len(s1), len(s2)
-        dp = np.zeros((len_s1 + 1, len_s2 + 1), dtype=int)
-
-        for i in range(len_s1 + 1):
-            dp[i][0] = i
-        for j in range(len_s2 + 1):
-            dp[0][j] = j
-
-        for i in range(1, len_s1 + 1):
-            for j in range(1, len_s2 + 1):
-                cost = 0 if s1[i - 1] == s2[j - 1] else 1
-                dp[i][j] = min(dp[i - 1][j] + 1,      # Deletion
-                               dp[i][j - 1] + 1,      # Insertion
-                               dp[i - 1][j - 1] + cost)  # Substitution
-
-        return dp[len_s1][len_s2]
\ No newline at end of file
+        return Levenshtein.distance(s1, s2)
\ No newline at end of file
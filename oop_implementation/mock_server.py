@@ -0,0 +1,345 @@
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+from rate_limiter import TokenBucket
+from response_cache import ResponseCache, request_key
+from token_budget import is_reasoning_model
+
+
+def latency_sampler(spec: str) -> Callable[[random.Random], float]:
+    """
+    Build a latency distribution from a spec.
+
+    Args:
+        spec (str): "fixed:S", "uniform:LOW,HIGH", "exponential:MEAN" or "lognormal:MEDIAN,SIGMA", in seconds.
+
+    Returns:
+        Callable[[random.Random], float]: Function drawing one latency.
+
+    Raises:
+        ValueError: If the distribution is unknown.
+    """
+    name, _, args = spec.partition(":")
+    params = [float(arg) for arg in args.split(",") if arg]
+    if name == "fixed":
+        return lambda rng: params[0]
+    if name == "uniform":
+        return lambda rng: rng.uniform(params[0], params[1])
+    if name == "exponential":
+        return lambda rng: rng.expovariate(1 / params[0])
+    if name == "lognormal":
+        return lambda rng: params[0] * rng.lognormvariate(0, params[1])
+    raise ValueError(f"Unknown latency distribution {spec!r}; use fixed, uniform, exponential or lognormal")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count whitespace tokens, a stand-in for the real tokenizer in usage and token-rate accounting.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The token count.
+    """
+    return len(text.split())
+
+
+def split_tokens(text: str) -> List[str]:
+    """
+    Split a text into the whitespace tokens of count_tokens, each with the whitespace before it, so streams keep line breaks.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        List[str]: The tokens.
+    """
+    return re.findall(r"\s*\S+", text)
+
+
+class MockLLMServer:
+    """
+    Local stand-in for an OpenAI-compatible chat completions server, so the pipeline's own overhead can be measured
+    without a model. Latency, injected 500s and 429s, decoding speed, a server-wide token budget and the <think> span
+    of reasoning models are configurable.
+    """
+
+    def __init__(self, latency: str = "lognormal:0.2,0.5", error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 tokens_per_second: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 responses: Optional[Dict[str, str]] = None, replay: Optional[str] = None, seed: int = 0,
+                 think_tokens: int = 0):
+        """
+        Initialize the server.
+
+        Args:
+            latency (str): Latency distribution of every request (see latency_sampler).
+            error_rate (float): Fraction of requests answered with a 500.
+            rate_limit_rate (float): Fraction of requests answered with a 429 and retry-after.
+            tokens_per_second (Optional[float]): Decoding speed; adds the completion's decoding time to the latency.
+            tokens_per_minute (Optional[float]): Server-wide token budget; 429 with x-ratelimit-* headers once spent.
+            responses (Optional[Dict[str, str]]): Canned answers by prompt (the last user message with hypotheses).
+            replay (Optional[str]): Response cache database whose outputs answer identical requests.
+            seed (int): Seed of the latency and fault draws.
+            think_tokens (int): Mean length (exponentially distributed) of a <think> span starting the answers of
+                reasoning models; a request continuing an assistant message (continue_final_message) gets the
+                answer alone. Defaults to 0, no span.
+        """
+        self.latency = latency_sampler(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.tokens_per_second = tokens_per_second
+        self.budget = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.responses = responses or {}
+        self.replay = ResponseCache(replay) if replay else None
+        self.rng = random.Random(seed)
+        self.think_tokens = think_tokens
+        self.stats = {"requests": 0, "completed": 0, "errors": 0, "rate_limited": 0, "completion_tokens": 0, "cancelled": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def load_responses(self, path: str):
+        """
+        Add canned answers from a file.
+
+        Args:
+            path (str): JSON object {prompt: answer} or JSONL lines {"prompt": ..., "response": ...}.
+        """
+        with open(path) as f:
+            if path.endswith(".jsonl"):
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.responses[record["prompt"]] = record["response"]
+            else:
+                self.responses.update(json.load(f))
+
+    def answers(self, model: str, messages: List[Dict[str, str]], generation_config: Dict, n: int) -> List[str]:
+        """
+        Answer a request: a canned answer, else a replayed output, else the echoed top hypothesis of the prompt.
+
+        Args:
+            model (str): The model name.
+            messages (List[Dict[str, str]]): The chat messages.
+            generation_config (Dict): Generation parameters as sent by the client.
+            n (int): Number of choices.
+
+        Returns:
+            List[str]: One answer per choice.
+        """
+        # The last user message holding hypotheses, as follow-up turns (e.g. "answer now") carry none
+        prompts = [message["content"] for message in messages if message["role"] == "user"] or [messages[-1]["content"]]
+        prompt = next((prompt for prompt in reversed(prompts) if "<hypothesis" in prompt), prompts[-1])
+        if prompt in self.responses:
+            return [self.responses[prompt]] * n
+        if self.replay is not None:
+            outputs = self.replay.get(request_key(model, messages, generation_config))
+            if outputs:
+                return (outputs * n)[:n]
+        # The top hypothesis of the last N-best list in the prompt, after any in-context examples
+        tagged = re.findall(r"<hypothesis(\d+)>(.*?)</hypothesis\1>", prompt, re.DOTALL)
+        if not tagged:
+            return [prompt.strip().splitlines()[-1]] * n
+        top = min(int(index) for index, _ in tagged)
+        return [[text.strip() for index, text in tagged if int(index) == top][-1]] * n
+
+    def think_span(self) -> str:
+        """
+        Draw the <think> span of one reasoning model answer.
+
+        Returns:
+            str: The closed span, followed by a blank line.
+        """
+        return "<think>\n" + " ".join(["hmm"] * int(self.rng.expovariate(1 / self.think_tokens))) + "\n</think>\n\n"
+
+    @staticmethod
+    def _error(status: int, message: str, headers: Optional[Dict[str, str]] = None) -> web.Response:
+        return web.json_response({"error": {"message": message, "type": "mock_error", "code": status}}, status=status, headers=headers)
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        """
+        Handle POST /v1/chat/completions.
+
+        Args:
+            request (web.Request): The request.
+
+        Returns:
+            web.StreamResponse: The completion, an SSE stream of chunks, or an injected error.
+        """
+        body = await request.json()
+        self.stats["requests"] += 1
+        model, messages, stream = body.pop("model"), body.pop("messages"), body.pop("stream", False)
+        body.pop("stream_options", None)
+        n = body.get("n", 1)
+        max_tokens = body.get("max_tokens")
+        draw = self.rng.random()
+        if draw < self.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            return self._error(429, "Injected rate limit", {"retry-after-ms": "200"})
+        if draw < self.rate_limit_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return self._error(500, "Injected server error")
+
+        answers = self.answers(model, messages, body, n)
+        if self.think_tokens and is_reasoning_model(model) and messages[-1]["role"] == "user":
+            answers = [self.think_span() + answer for answer in answers]
+        if max_tokens:
+            answers = ["".join(split_tokens(answer)[:max_tokens]) for answer in answers]
+        prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+        completion_tokens = sum(count_tokens(answer) for answer in answers)
+        if self.budget is not None:
+            wait = self.budget.wait_time(prompt_tokens + completion_tokens)
+            if wait > 0:
+                self.stats["rate_limited"] += 1
+                return self._error(429, "Token budget exceeded", {"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": f"{wait:.3f}s"})
+            self.budget.consume(prompt_tokens + completion_tokens)
+
+        self.stats["in_flight"] += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+        try:
+            await asyncio.sleep(self.latency(self.rng))
+            decode_time = completion_tokens / n / self.tokens_per_second if self.tokens_per_second else 0.0
+            created = int(time.time())
+            completion_id = f"chatcmpl-mock-{self.stats['requests']}"
+            finish_reason = lambda answer: "length" if max_tokens and count_tokens(answer) >= max_tokens else "stop"
+            if stream:
+                return await self._stream(request, completion_id, created, model, answers, decode_time, finish_reason)
+            await asyncio.sleep(decode_time)
+            self.stats["completed"] += 1
+            self.stats["completion_tokens"] += completion_tokens
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": i, "finish_reason": finish_reason(answer), "message": {"role": "assistant", "content": answer}}
+                            for i, answer in enumerate(answers)],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+            })
+        finally:
+            self.stats["in_flight"] -= 1
+
+    async def _stream(self, request: web.Request, completion_id: str, created: int, model: str, answers: List[str],
+                      decode_time: float, finish_reason: Callable[[str], str]) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        words = [split_tokens(answer) for answer in answers]
+        steps = max(len(tokens) for tokens in words) if words else 0
+        try:
+            await response.prepare(request)
+            for step in range(steps + 1):
+                choices = []
+                for i, tokens in enumerate(words):
+                    if step < len(tokens):
+                        choices.append({"index": i, "delta": {"content": tokens[step]}, "finish_reason": None})
+                    elif step == len(tokens):
+                        choices.append({"index": i, "delta": {}, "finish_reason": finish_reason(answers[i])})
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model, "choices": choices}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                if step < steps:
+                    self.stats["completion_tokens"] += sum(step < len(tokens) for tokens in words)
+                    await asyncio.sleep(decode_time / max(steps, 1))
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # The client went away (streaming early stop, cancelled hedge): nothing more is generated
+            self.stats["cancelled"] += 1
+            return response
+        self.stats["completed"] += 1
+        return response
+
+    async def models(self, request: web.Request) -> web.Response:
+        """
+        Handle GET /v1/models, the health probe of EndpointPool.
+        """
+        return web.json_response({"object": "list", "data": [{"id": "mock", "object": "model", "created": 0, "owned_by": "mock"}]})
+
+    async def stats_handler(self, request: web.Request) -> web.Response:
+        """
+        Handle GET /mock/stats with the server counters. With ?reset_peak=1, max_in_flight then restarts from the
+        current in_flight, so a load test can read the peak of each concurrency level.
+        """
+        stats = dict(self.stats)
+        if request.query.get("reset_peak"):
+            self.stats["max_in_flight"] = self.stats["in_flight"]
+        return web.json_response(stats)
+
+    def app(self) -> web.Application:
+        """
+        Build the aiohttp application.
+
+        Returns:
+            web.Application: The application.
+        """
+        app = web.Application(client_max_size=64 << 20)
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_get("/mock/stats", self.stats_handler)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000) -> web.AppRunner:
+        """
+        Serve in the running event loop.
+
+        Args:
+            host (str): Host to bind.
+            port (int): Port to bind.
+
+        Returns:
+            web.AppRunner: The runner; stop it with `await runner.cleanup()`.
+        """
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port, backlog=4096).start()
+        return runner
+
+    def summary(self) -> str:
+        """
+        Format the server counters.
+
+        Returns:
+            str: One line with requests, injected faults and tokens.
+        """
+        return (f"Mock server: {self.stats['requests']} requests, {self.stats['completed']} completed, "
+                f"{self.stats['errors']} injected errors, {self.stats['rate_limited']} rate limited, {self.stats['cancelled']} cancelled streams, "
+                f"{self.stats['completion_tokens']} completion tokens, max {self.stats['max_in_flight']} in flight")
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000, report_every: float = 10.0):
+        """
+        Run the server until cancelled, printing its summary periodically.
+
+        Args:
+            host (str): Host to bind.
+            port (int): Port to bind.
+            report_every (float): Seconds between summaries.
+        """
+        runner = await self.start(host, port)
+        print(f"Mock LLM server listening on http://{host}:{port}/v1", flush=True)
+        try:
+            while True:
+                await asyncio.sleep(report_every)
+                print(self.summary(), flush=True)
+        finally:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock chat completions server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="lognormal:0.2,0.5", help='fixed:S, uniform:LOW,HIGH, exponential:MEAN or lognormal:MEDIAN,SIGMA')
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--tokens-per-second", type=float, help="Decoding speed of every request")
+    parser.add_argument("--tokens-per-minute", type=float, help="Server-wide token budget; 429 once it is spent")
+    parser.add_argument("--responses", help="Canned answers: JSON {prompt: answer} or JSONL {prompt, response}")
+    parser.add_argument("--replay", help="Response cache database whose outputs are replayed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--think-tokens", type=int, default=0, help="Mean length of the <think> span of reasoning models (DeepSeek* names)")
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.latency, args.error_rate, args.rate_limit_rate, args.tokens_per_second, args.tokens_per_minute,
+                           replay=args.replay, seed=args.seed, think_tokens=args.think_tokens)
+    if args.responses:
+        server.load_responses(args.responses)
+    asyncio.run(server.serve(args.host, args.port))
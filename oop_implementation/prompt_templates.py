@@ -0,0 +1,123 @@
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+
+PROMPT_LAYOUTS = ("original", "prefix")
+
+
+def hypotheses_block(hypotheses: List[str], start: int = 0) -> str:
+    """
+    Render the N-best list as <hypothesisI>...</hypothesisI> lines.
+
+    Args:
+        hypotheses (List[str]): A list of ASR hypotheses.
+        start (int): Index of the first hypothesis tag.
+
+    Returns:
+        str: One tagged line per hypothesis.
+    """
+    return "".join(f"<hypothesis{idx}>{hypothesis}</hypothesis{idx}>\n" for idx, hypothesis in enumerate(hypotheses, start))
+
+
+class PromptTemplate:
+    """
+    A strategy's chat prompt, compiled once into the static prefix shared by every item (history turns and the head
+    of the final user message) and the per-item suffix (the hypotheses and any static tail after them). Servers with
+    prefix (KV) caching only reuse the prompt up to the first per-item token.
+    """
+
+    def __init__(self, head: str, tail: str = "", history: Sequence[Dict[str, str]] = (),
+                 item: Callable[[List[str]], str] = hypotheses_block, hoisted_tail: Optional[str] = None):
+        """
+        Initialize the template.
+
+        Args:
+            head (str): Static text of the final user message before the hypotheses.
+            tail (str): Static text after the hypotheses.
+            history (Sequence[Dict[str, str]]): Static chat turns before the final user message.
+            item (Callable[[List[str]], str]): Renders the per-item part from the hypotheses.
+            hoisted_tail (Optional[str]): The tail reworded to precede the head in the "prefix" layout, leaving only
+                the hypotheses as suffix. None keeps the tail in place, e.g. for a short answer cue.
+        """
+        self.head = head
+        self.tail = tail
+        self.history = tuple(history)
+        self.item = item
+        self.hoisted_tail = hoisted_tail
+
+    def render_text(self, hypotheses: List[str], layout: str = "original") -> str:
+        """
+        Render the final user message.
+
+        Args:
+            hypotheses (List[str]): A list of ASR hypotheses.
+            layout (str): "original" renders the prompt as written; "prefix" moves a hoisted tail in front of the head.
+
+        Returns:
+            str: The content of the final user message.
+
+        Raises:
+            ValueError: If the layout is unknown.
+        """
+        if layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown prompt layout {layout!r}; use one of {PROMPT_LAYOUTS}")
+        if layout == "prefix" and self.hoisted_tail is not None:
+            return self.hoisted_tail + self.head + self.item(hypotheses)
+        return self.head + self.item(hypotheses) + self.tail
+
+    def render(self, hypotheses: List[str], layout: str = "original") -> List[Dict[str, str]]:
+        """
+        Render the chat messages of one item.
+
+        Args:
+            hypotheses (List[str]): A list of ASR hypotheses.
+            layout (str): Prompt layout (see render_text).
+
+        Returns:
+            List[Dict[str, str]]: The history turns followed by the final user message.
+        """
+        return list(self.history) + [{"role": "user", "content": self.render_text(hypotheses, layout)}]
+
+    def token_counts(self, hypotheses: List[str], tokenizer=None, layout: str = "original") -> Dict[str, int]:
+        """
+        Count the tokens of the static prefix and of the per-item suffix of one item's prompt.
+
+        Args:
+            hypotheses (List[str]): A list of ASR hypotheses.
+            tokenizer: A Hugging Face tokenizer; its chat template is applied if it has one. Without a tokenizer,
+                tokens are estimated at ~4 characters each.
+            layout (str): Prompt layout (see render_text).
+
+        Returns:
+            Dict[str, int]: "prefix", "suffix" and "total" token counts.
+        """
+        prompt = self._encode(self.render(hypotheses, layout), tokenizer)
+        # The prefix is whatever the prompt shares with the prompt of any other item
+        other = self._encode(self.render(["#"] * len(hypotheses), layout), tokenizer)
+        shared = next((i for i, (a, b) in enumerate(zip(prompt, other)) if a != b), min(len(prompt), len(other)))
+        scale = 1 if tokenizer is not None else 4
+        return {"prefix": shared // scale, "suffix": (len(prompt) - shared) // scale, "total": len(prompt) // scale}
+
+    @staticmethod
+    def _encode(messages: List[Dict[str, str]], tokenizer) -> Union[str, List[int]]:
+        if tokenizer is None:
+            return "".join(message["role"] + message["content"] for message in messages)
+        if getattr(tokenizer, "chat_template", None):
+            return tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True, return_dict=False)
+        return tokenizer.encode("\n".join(message["content"] for message in messages))
+
+    def describe(self, hypotheses: List[str], tokenizer=None, layout: str = "original") -> str:
+        """
+        Format the prefix / suffix token split of one item's prompt.
+
+        Args:
+            hypotheses (List[str]): A list of ASR hypotheses.
+            tokenizer: Optional Hugging Face tokenizer (see token_counts).
+            layout (str): Prompt layout (see render_text).
+
+        Returns:
+            str: One line with the token counts and the share reusable by prefix caching.
+        """
+        counts = self.token_counts(hypotheses, tokenizer, layout)
+        unit = "tokens" if tokenizer is not None else "tokens (estimated)"
+        return (f"Prompt ({layout} layout): {counts['prefix']} static prefix + {counts['suffix']} per-item {unit}, "
+                f"{counts['prefix'] / max(counts['total'], 1):.0%} reusable by server-side prefix caching")
@@ -0,0 +1,440 @@
+import re
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional, Tuple
+
+import openai
+
+
+# Errors signalling that the endpoint is overloaded, as opposed to a bad request
+OVERLOAD_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APITimeoutError)
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously at a per-minute rate.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        """
+        Initialize a full bucket.
+
+        Args:
+            rate_per_minute (float): Tokens added per minute.
+            capacity (Optional[float]): Maximum content of the bucket. Defaults to one minute of budget.
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Compute how long to wait until `amount` tokens are available.
+
+        Args:
+            amount (float): Tokens needed. Amounts larger than the bucket only wait for a full bucket.
+
+        Returns:
+            float: Seconds to wait, 0 if the tokens are available now.
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount: float):
+        """
+        Take tokens from the bucket.
+
+        Args:
+            amount (float): Tokens to take.
+        """
+        self._refill()
+        self.level -= amount
+
+    def refund(self, amount: float):
+        """
+        Return tokens to the bucket (or charge more with a negative amount) once the real usage is known.
+
+        Args:
+            amount (float): Tokens to return.
+        """
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a rate-limit reset header: plain seconds ("1.5") or Go-style durations ("6m0s", "20ms").
+
+    Args:
+        value (Optional[str]): The header value.
+
+    Returns:
+        Optional[float]: Seconds, or None if the value is missing or not understood.
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+def retry_after_seconds(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """
+    Read the server-requested back-off from retry-after-ms / retry-after headers.
+
+    Args:
+        headers (Optional[Mapping[str, str]]): Response headers.
+
+    Returns:
+        Optional[float]: Seconds to wait, or None.
+    """
+    if not headers:
+        return None
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    return parse_duration(headers.get("retry-after"))
+
+
+def exhausted_budget_seconds(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """
+    Compute the time until the budget resets when x-ratelimit-remaining-{requests,tokens} reports it exhausted.
+
+    Args:
+        headers (Optional[Mapping[str, str]]): Response headers.
+
+    Returns:
+        Optional[float]: Seconds to wait, or None if budget remains.
+    """
+    if not headers:
+        return None
+    waits = []
+    for kind in ("requests", "tokens"):
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+        if remaining is not None and remaining.strip() in ("0", "0.0"):
+            waits.append(parse_duration(headers.get(f"x-ratelimit-reset-{kind}")) or 1.0)
+    return max(waits) if waits else None
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller of the in-flight requests to one (model, replica): slow start, then additive increase,
+    multiplicative decrease on 429/5xx/timeouts or on a latency rise sustained for a whole round trip, and pauses
+    requested by the server. Latency is compared with a slowly decaying mean rather than the best latency seen, since
+    LLM latency also varies with the output length.
+    """
+
+    def __init__(self, initial: int = 16, min_limit: int = 1, max_limit: int = 1024, latency_tolerance: float = 2.0, backoff: float = 0.5,
+                 baseline_decay: float = 0.01):
+        """
+        Initialize the controller.
+
+        Args:
+            initial (int): Initial concurrency limit.
+            min_limit (int): Lower bound of the limit.
+            max_limit (int): Upper bound of the limit.
+            latency_tolerance (float): Recent latency above this multiple of the baseline counts as congestion.
+            backoff (float): Factor applied to the limit on overload errors.
+            baseline_decay (float): Weight of each completion in the baseline latency, a slowly decaying mean.
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.baseline_decay = baseline_decay
+        self.in_flight = 0
+        self.slow_start = True
+        self.baseline: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.congested = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.stats = {"increases": 0, "decreases": 0, "pauses": 0, "peak_limit": initial}
+
+    def has_capacity(self) -> bool:
+        """
+        Check whether another request may start.
+
+        Returns:
+            bool: True if the in-flight count is below the limit.
+        """
+        return self.in_flight < int(self.limit)
+
+    def on_success(self, latency: float):
+        """
+        Grow the limit after a successful request, unless latency is rising; cut it by 10% once the rise has lasted a
+        whole round trip (`limit` completions in a row).
+
+        Args:
+            latency (float): Latency of the request in seconds.
+        """
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.baseline is None:
+            self.baseline = latency
+        if self.latency > self.baseline * self.latency_tolerance:
+            # One long generation is not load; a gradient held for a whole round trip is. Back off once, then take the
+            # new latency as the norm, so a lasting shift of the workload does not shrink the limit round after round
+            self.congested += 1
+            if self.congested >= self.limit:
+                self.congested = 0
+                self.baseline = self.latency
+                self._decrease(0.9)
+            return
+        self.congested = 0
+        self.baseline = (1 - self.baseline_decay) * self.baseline + self.baseline_decay * latency
+        self.limit = min(self.max_limit, self.limit + (1 if self.slow_start else 1 / self.limit))
+        self.stats["increases"] += 1
+        self.stats["peak_limit"] = max(self.stats["peak_limit"], int(self.limit))
+
+    def on_overload(self):
+        """
+        Cut the limit after a 429, 5xx or timeout.
+        """
+        self.slow_start = False
+        self._decrease(self.backoff)
+
+    def _decrease(self, factor: float):
+        now = time.monotonic()
+        # A burst of failures from the same round trip counts as one congestion signal
+        if now - self.last_decrease < max(self.latency or 0.0, 0.5):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+        self.stats["decreases"] += 1
+
+    def pause(self, seconds: Optional[float]):
+        """
+        Hold back new requests.
+
+        Args:
+            seconds (Optional[float]): Pause length; ignored if None or not positive.
+        """
+        if seconds and seconds > 0:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.stats["pauses"] += 1
+
+
+class RequestTicket:
+    """
+    Handed to the body of RequestLimiter.slot so the caller can pass back the response headers.
+    """
+
+    def __init__(self):
+        self.headers: Optional[Mapping[str, str]] = None
+
+
+def endpoint_key(client: Any) -> str:
+    """
+    Identify the endpoint behind a client, for per-endpoint adaptive concurrency and circuit breakers. The replicas of
+    an EndpointPool each get their own controller (keyed by their base URL) once selected.
+
+    Args:
+        client (Any): An openai.AsyncOpenAI-like client.
+
+    Returns:
+        str: The base URL, or a per-object identifier for clients without one.
+    """
+    base_url = getattr(client, "base_url", None)
+    return str(base_url) if base_url is not None else f"{type(client).__name__}@{id(client):x}"
+
+
+class RequestLimiter:
+    """
+    Admission control for chat completion requests: a cap on in-flight requests plus requests-per-minute
+    and tokens-per-minute buckets. The concurrency cap is shared by every model; with adaptive settings, every
+    (model, endpoint) additionally gets an AdaptiveConcurrency controller.
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None, adaptive: Optional[Dict[str, float]] = None):
+        """
+        Initialize the limiter. Limits left as None are not enforced.
+
+        Args:
+            max_concurrency (Optional[int]): Maximum number of requests in flight.
+            requests_per_minute (Optional[float]): Default request budget per model.
+            tokens_per_minute (Optional[float]): Default token budget per model.
+            adaptive (Optional[Dict[str, float]]): Keyword arguments of AdaptiveConcurrency, or None to disable it.
+        """
+        self.max_concurrency = max_concurrency
+        self.default_limits = (requests_per_minute, tokens_per_minute)
+        self.model_limits: Dict[str, Tuple[Optional[float], Optional[float]]] = {}
+        self.buckets: Dict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+        self.adaptive = adaptive
+        self.controllers: Dict[Tuple[str, str], AdaptiveConcurrency] = {}
+        self.in_flight = 0
+        self.stats = {"requests": 0, "throttled": 0, "throttle_seconds": 0.0, "estimated_tokens": 0, "used_tokens": 0}
+        self._loop = None
+        self._condition = None
+        self._lock = None
+
+    def set_model_limits(self, model: str, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        """
+        Override the request and token budgets of one model.
+
+        Args:
+            model (str): The model name.
+            requests_per_minute (Optional[float]): Request budget of the model.
+            tokens_per_minute (Optional[float]): Token budget of the model.
+        """
+        self.model_limits[model] = (requests_per_minute, tokens_per_minute)
+        self.buckets.pop(model, None)
+
+    def _primitives(self) -> Tuple[asyncio.Condition, asyncio.Lock]:
+        # asyncio primitives are bound to one loop; recreate them if the limiter is reused from a new loop
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self._lock = asyncio.Lock()
+        return self._condition, self._lock
+
+    def _buckets(self, model: str) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        if model not in self.buckets:
+            rpm, tpm = self.model_limits.get(model, self.default_limits)
+            self.buckets[model] = (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+        return self.buckets[model]
+
+    async def _wait_for_budget(self, model: str, estimated_tokens: int):
+        request_bucket, token_bucket = self._buckets(model)
+        while True:
+            delay = max(request_bucket.wait_time(1) if request_bucket else 0.0,
+                        token_bucket.wait_time(estimated_tokens) if token_bucket else 0.0)
+            if delay <= 0:
+                break
+            self.stats["throttled"] += 1
+            self.stats["throttle_seconds"] += delay
+            await asyncio.sleep(delay)
+        if request_bucket:
+            request_bucket.consume(1)
+        if token_bucket:
+            token_bucket.consume(estimated_tokens)
+
+    def controller(self, model: str, endpoint: Optional[str]) -> Optional[AdaptiveConcurrency]:
+        """
+        Get the adaptive controller of a (model, endpoint).
+
+        Args:
+            model (str): The model name.
+            endpoint (Optional[str]): The endpoint identifier.
+
+        Returns:
+            Optional[AdaptiveConcurrency]: The controller, or None if adaptive concurrency is disabled.
+        """
+        if self.adaptive is None:
+            return None
+        if (model, endpoint) not in self.controllers:
+            self.controllers[(model, endpoint)] = AdaptiveConcurrency(**self.adaptive)
+        return self.controllers[(model, endpoint)]
+
+    @asynccontextmanager
+    async def slot(self, model: str, estimated_tokens: int = 0, endpoint: Optional[str] = None) -> AsyncIterator[RequestTicket]:
+        """
+        Wait for a concurrency slot and for request/token budget, holding the slot for the duration of the block.
+        Exceptions leaving the block and the headers stored on the yielded ticket drive the adaptive controller.
+
+        Args:
+            model (str): The model the request is sent to.
+            estimated_tokens (int): Estimated token cost of the request.
+            endpoint (Optional[str]): The endpoint identifier (see endpoint_key).
+        """
+        condition, lock = self._primitives()
+        controller = self.controller(model, endpoint)
+        while controller is not None and controller.paused_until > time.monotonic():
+            await asyncio.sleep(controller.paused_until - time.monotonic())
+        async with condition:
+            await condition.wait_for(lambda: (self.max_concurrency is None or self.in_flight < self.max_concurrency)
+                                             and (controller is None or controller.has_capacity()))
+            self.in_flight += 1
+            if controller is not None:
+                controller.in_flight += 1
+        ticket = RequestTicket()
+        try:
+            # Serialize budget waits so concurrent requests do not overdraw the bucket together
+            async with lock:
+                await self._wait_for_budget(model, estimated_tokens)
+            self.stats["requests"] += 1
+            self.stats["estimated_tokens"] += estimated_tokens
+            start = time.monotonic()
+            try:
+                yield ticket
+            except OVERLOAD_ERRORS as e:
+                if controller is not None:
+                    controller.on_overload()
+                    response = getattr(e, "response", None)
+                    controller.pause(retry_after_seconds(response.headers if response is not None else None))
+                raise
+            if controller is not None:
+                controller.on_success(time.monotonic() - start)
+                controller.pause(exhausted_budget_seconds(ticket.headers))
+        finally:
+            async with condition:
+                self.in_flight -= 1
+                if controller is not None:
+                    controller.in_flight -= 1
+                # Waiters may be blocked on different controllers, so wake them all
+                condition.notify_all()
+
+    def summary(self) -> str:
+        """
+        Format the throttling statistics and the current limit of every adaptive controller.
+
+        Returns:
+            str: A multi-line summary.
+        """
+        lines = [f"Requests: {self.stats['requests']}, throttled {self.stats['throttled']} times ({self.stats['throttle_seconds']:.1f}s)"]
+        for (model, endpoint), controller in self.controllers.items():
+            lines.append(f"{model} @ {endpoint}: limit {controller.limit:.1f} (peak {controller.stats['peak_limit']}), "
+                         f"{controller.stats['decreases']} decreases, {controller.stats['pauses']} pauses")
+        return "\n".join(lines)
+
+    def record_usage(self, model: str, estimated_tokens: int, used_tokens: Optional[int]):
+        """
+        Reconcile the token bucket with the usage reported by the server.
+
+        Args:
+            model (str): The model the request was sent to.
+            estimated_tokens (int): The estimate charged before the request.
+            used_tokens (Optional[int]): Total tokens reported by the server, if any.
+        """
+        if used_tokens is None:
+            return
+        self.stats["used_tokens"] += used_tokens
+        _, token_bucket = self._buckets(model)
+        if token_bucket:
+            token_bucket.refund(estimated_tokens - used_tokens)
+
+
+def estimate_request_tokens(messages: List[Dict[str, str]], generation_config: Dict) -> int:
+    """
+    Roughly estimate the token cost of a request (~4 characters per prompt token plus the completion budget).
+
+    Args:
+        messages (List[Dict[str, str]]): The chat messages.
+        generation_config (Dict): Generation parameters, read for max_tokens and n.
+
+    Returns:
+        int: Estimated total tokens.
+    """
+    prompt_chars = sum(len(message.get("content") or "") for message in messages)
+    return prompt_chars // 4 + len(messages) * 4 + generation_config.get("max_tokens", 256) * generation_config.get("n", 1)
+
+
+# Settings to opt into AIMD with, e.g. LLMClient(..., adaptive=DEFAULT_ADAPTIVE)
+DEFAULT_ADAPTIVE = {"initial": 16, "min_limit": 1, "max_limit": 1024, "latency_tolerance": 2.0, "backoff": 0.5, "baseline_decay": 0.01}
@@ -0,0 +1,249 @@
+import time
+import asyncio
+import contextvars
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+from answer_stream import answer_complete
+
+
+THINK_OPEN, THINK_CLOSE = "<think>", "</think>"
+
+# Row of the item whose request is being sent, so per-request statistics can be attributed to it
+current_item: contextvars.ContextVar = contextvars.ContextVar("current_item", default=None)
+
+
+def split_think(text: str) -> Tuple[str, str, bool]:
+    """
+    Split a reasoning model's output. Chat templates that open the think span themselves stream no <think>, so
+    everything before </think> is the think span.
+
+    Args:
+        text (str): The output.
+
+    Returns:
+        Tuple[str, str, bool]: The think span, the answer, and whether the span was closed.
+    """
+    body = text.split(THINK_OPEN, 1)[1] if THINK_OPEN in text else text
+    think, closed, answer = body.partition(THINK_CLOSE)
+    return think, answer, bool(closed)
+
+
+class ReasoningStats:
+    """
+    Think tokens (streamed chunks, one token each on vLLM/TGI) and latency of every reasoning completion, and whether
+    its thinking budget ran out so the answer had to be forced.
+    """
+
+    def __init__(self):
+        """
+        Initialize empty statistics.
+        """
+        self.records: List[Dict] = []
+
+    def record(self, item: Optional[int], think_tokens: int, forced: bool, seconds: float):
+        """
+        Record one completion.
+
+        Args:
+            item (Optional[int]): Row of the item, None outside the pipeline.
+            think_tokens (int): Tokens of the think span.
+            forced (bool): Whether the thinking budget ran out and the answer was forced.
+            seconds (float): Duration of the request, forced answer included.
+        """
+        self.records.append({"row": item, "think_tokens": think_tokens, "forced": forced, "seconds": seconds})
+
+    def per_item(self) -> pd.DataFrame:
+        """
+        Sum the records per row (OneShotClosestCorrection sends its base request once per row).
+
+        Returns:
+            pd.DataFrame: Think tokens, forced answers and seconds per row.
+        """
+        df = pd.DataFrame(self.records, columns=["row", "think_tokens", "forced", "seconds"])
+        return df.groupby("row", dropna=False).agg({"think_tokens": "sum", "forced": "sum", "seconds": "sum"}).reset_index()
+
+    def save(self, file_path: str):
+        """
+        Write the per-row table to CSV and start over for the next run.
+
+        Args:
+            file_path (str): Path of the CSV file.
+        """
+        self.per_item().to_csv(file_path, index=False)
+        self.records.clear()
+        print(f"Think tokens per row saved to {file_path}")
+
+    def snapshot(self) -> int:
+        """
+        Mark the current position in the records, so that a later summary can report only the completions after it.
+
+        Returns:
+            int: Number of records so far.
+        """
+        return len(self.records)
+
+    def summary(self, since: int = 0) -> str:
+        """
+        Format the think token distribution and the share of forced answers.
+
+        Args:
+            since (int): A snapshot() taken at the start of the run to report. Defaults to every record.
+
+        Returns:
+            str: A one-line summary.
+        """
+        records = self.records[since:]
+        if not records:
+            return "Reasoning: no completions"
+        think = np.array([record["think_tokens"] for record in records])
+        forced = sum(record["forced"] for record in records)
+        p50, p95 = np.percentile(think, [50, 95])
+        return (f"Reasoning: {len(think)} completions, think tokens mean {think.mean():.0f}, p50 {p50:.0f}, p95 {p95:.0f}, "
+                f"max {think.max()}; {forced} ({forced / len(think):.1%}) hit the thinking budget and had their answer forced")
+
+
+class ReasoningMode:
+    """
+    Generation of reasoning models with a bounded think span. The completion is streamed with think_budget tokens for
+    the think span plus the request's max_tokens for the answer; a choice still thinking after think_budget tokens is
+    cut off and its answer forced by a second, answer-only request of max_tokens. Outputs keep the <think> span,
+    closed, so it is stripped as before.
+    """
+
+    def __init__(self, think_budget: int = 1024, continuation: str = "prefill", early_stop: bool = True,
+                 forced_close: str = "\nOkay, I have to answer now.\n</think>\n\n",
+                 instruction: str = "Stop thinking. Reply with only the corrected transcription."):
+        """
+        Initialize the mode.
+
+        Args:
+            think_budget (int): Most tokens of the think span. Defaults to 1024.
+            continuation (str): "prefill" continues the truncated span, closed by forced_close, as the assistant's own
+                message (continue_final_message of vLLM and SGLang); "instruct" follows the closed span with a user
+                turn asking for the answer alone, for servers without assistant prefill. Defaults to "prefill".
+            early_stop (bool): Close the stream once the answer line is complete. Defaults to True.
+            forced_close (str): Text closing a truncated think span in the "prefill" continuation.
+            instruction (str): User turn of the "instruct" continuation.
+
+        Raises:
+            ValueError: If the continuation is unknown.
+        """
+        if continuation not in ("prefill", "instruct"):
+            raise ValueError(f"Unknown continuation {continuation!r}; use 'prefill' or 'instruct'")
+        self.think_budget = think_budget
+        self.continuation = continuation
+        self.early_stop = early_stop
+        self.forced_close = forced_close
+        self.instruction = instruction
+        self.stats = ReasoningStats()
+
+    def signature(self) -> Dict:
+        """
+        Get the settings that make outputs of this mode differ from plain requests, for cache keys and checkpoints.
+
+        Returns:
+            Dict: The mode's settings.
+        """
+        return {"think_budget": self.think_budget, "continuation": self.continuation, "forced_close": self.forced_close,
+                "instruction": self.instruction if self.continuation == "instruct" else None}
+
+    def forced_request(self, messages: List[Dict[str, str]], think: str) -> Tuple[List[Dict[str, str]], Dict]:
+        """
+        Build the answer-only request after a think span cut off at the budget.
+
+        Args:
+            messages (List[Dict[str, str]]): Messages of the original request.
+            think (str): The truncated think span.
+
+        Returns:
+            Tuple[List[Dict[str, str]], Dict]: The messages and extra arguments of the request.
+        """
+        if self.continuation == "prefill":
+            return (messages + [{"role": "assistant", "content": THINK_OPEN + think + self.forced_close}],
+                    {"extra_body": {"continue_final_message": True, "add_generation_prompt": False}})
+        return (messages + [{"role": "assistant", "content": THINK_OPEN + think + THINK_CLOSE},
+                            {"role": "user", "content": self.instruction}], {})
+
+
+async def reasoning_completion(completions, model: str, messages: List[Dict[str, str]], generation_config: Dict,
+                               mode: ReasoningMode, ticket=None) -> ChatCompletion:
+    """
+    Generate one chat completion of a reasoning model with a bounded think span.
+
+    Args:
+        completions: The chat.completions resource of an OpenAI-compatible client.
+        model (str): The name of the language model.
+        messages (List[Dict[str, str]]): The list of messages for the chat completion.
+        generation_config (Dict): Generation configuration; its max_tokens is the answer budget.
+        mode (ReasoningMode): The reasoning settings, whose stats record the completion.
+        ticket: Optional rate limiter ticket receiving the response headers.
+
+    Returns:
+        ChatCompletion: The outputs, each with its closed think span and answer.
+    """
+    n = generation_config.get("n", 1)
+    answer_tokens = generation_config.get("max_tokens", 256)
+    texts, finish_reasons = [""] * n, [None] * n
+    think_tokens, closed, exhausted, done = [0] * n, [False] * n, [False] * n, [False] * n
+    start = time.perf_counter()
+    stream = await completions.create(model=model, messages=messages, stream=True,
+                                      **{**generation_config, "max_tokens": mode.think_budget + answer_tokens})
+    if ticket is not None and getattr(stream, "response", None) is not None:
+        ticket.headers = stream.response.headers
+    try:
+        async for chunk in stream:
+            for choice in chunk.choices:
+                i = choice.index
+                if done[i]:
+                    continue
+                content = choice.delta.content if choice.delta is not None else None
+                if content:
+                    texts[i] += content
+                    # Only the end of the text can hold a newly completed </think>
+                    closed[i] = closed[i] or THINK_CLOSE in texts[i][-len(content) - len(THINK_CLOSE):]
+                    if not closed[i]:
+                        think_tokens[i] += 1
+                        exhausted[i] = done[i] = think_tokens[i] >= mode.think_budget
+                    elif mode.early_stop and answer_complete(split_think(texts[i])[1].lstrip()):
+                        done[i] = True
+                if choice.finish_reason:
+                    finish_reasons[i] = choice.finish_reason
+                    # A server counting several tokens per chunk can reach max_tokens before think_budget chunks
+                    exhausted[i] = choice.finish_reason == "length" and not closed[i]
+                    done[i] = True
+            if all(done):
+                break
+    finally:
+        await stream.close()
+
+    async def force_answer(i: int) -> Choice:
+        forced_messages, extra = mode.forced_request(messages, split_think(texts[i])[0])
+        response = await completions.create(model=model, messages=forced_messages, **{**generation_config, "n": 1}, **extra)
+        return response.choices[0]
+
+    forced = [i for i in range(n) if exhausted[i]]
+    for i, choice in zip(forced, await asyncio.gather(*[force_answer(i) for i in forced])):
+        # The forced answer follows the truncated span; a model that thinks again has that span dropped, and no answer
+        # if the span is still open at the end of the answer budget
+        content = choice.message.content or ""
+        if THINK_OPEN in content or THINK_CLOSE in content:
+            content = split_think(content)[1]
+        texts[i] = THINK_OPEN + split_think(texts[i])[0] + THINK_CLOSE + "\n\n" + content.lstrip()
+        finish_reasons[i] = choice.finish_reason
+    seconds = time.perf_counter() - start
+    for i in range(n):
+        think, answer, span_closed = split_think(texts[i])
+        if span_closed:
+            texts[i] = THINK_OPEN + think + THINK_CLOSE + answer
+        elif finish_reasons[i] == "stop":
+            # Finished without a think span: all of it is the answer
+            think_tokens[i] = 0
+        mode.stats.record(current_item.get(), think_tokens[i], exhausted[i], seconds)
+    return ChatCompletion(id="reasoning", object="chat.completion", created=int(time.time()), model=model,
+                          choices=[Choice(index=i, finish_reason=finish_reasons[i] or "stop", message=ChatCompletionMessage(role="assistant", content=texts[i]))
+                                   for i in range(n)])
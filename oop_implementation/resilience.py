@@ -0,0 +1,153 @@
+import time
+import random
+import asyncio
+from collections import deque
+from typing import Deque, Tuple
+
+import openai
+
+
+class LLMRequestError(Exception):
+    """
+    A request that failed for good: non-retryable error, retry budget or deadline exhausted, or circuit open.
+    """
+
+
+class CircuitOpenError(LLMRequestError):
+    """
+    Raised without contacting the endpoint while its circuit breaker is open.
+    """
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    Classify an exception raised by a chat completion request.
+
+    Args:
+        error (BaseException): The exception.
+
+    Returns:
+        str: "rate_limit", "transient" (worth retrying) or "fatal" (retrying cannot help, e.g. a malformed request).
+    """
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError, asyncio.TimeoutError)):
+        return "transient"
+    if isinstance(error, openai.APIStatusError):
+        # 408 Request Timeout and 409 Conflict are retryable; every other 4xx is the request's fault
+        return "transient" if error.status_code in (408, 409) or error.status_code >= 500 else "fatal"
+    return "fatal"
+
+
+class RetryPolicy:
+    """
+    Bounded retries: a maximum number of attempts within a per-request deadline, with full-jitter exponential backoff.
+    """
+
+    def __init__(self, max_attempts: int = 6, deadline: float = 300.0, base_delay: float = 0.5, max_delay: float = 30.0):
+        """
+        Initialize the policy.
+
+        Args:
+            max_attempts (int): Maximum number of attempts per request.
+            deadline (float): Seconds a request may take, retries and backoff included; time queued in the local rate
+                limiter does not count.
+            base_delay (float): Backoff ceiling of the first retry in seconds.
+            max_delay (float): Upper bound of the backoff ceiling in seconds.
+        """
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Draw the wait before the next attempt.
+
+        Args:
+            attempt (int): Number of the attempt that just failed, starting at 1.
+
+        Returns:
+            float: Seconds to wait.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker that fails fast while the recent error rate of the endpoint is too high.
+    """
+
+    def __init__(self, failure_threshold: float = 0.5, min_requests: int = 20, window: float = 30.0, cooldown: float = 30.0):
+        """
+        Initialize a closed breaker.
+
+        Args:
+            failure_threshold (float): Failure fraction of the recent requests that opens the breaker.
+            min_requests (int): Minimum number of recent requests before the breaker may open.
+            window (float): Seconds of history considered.
+            cooldown (float): Seconds the breaker stays open before letting one probe request through.
+        """
+        self.failure_threshold = failure_threshold
+        self.min_requests = min_requests
+        self.window = window
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = 0.0
+        # Start time of the half-open probe request, 0 when none is in flight
+        self.probing = 0.0
+        self.outcomes: Deque[Tuple[float, bool]] = deque()
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def _trim(self, now: float):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+
+    def check(self):
+        """
+        Raise CircuitOpenError unless a request may be sent now.
+        """
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        now = time.monotonic()
+        # A probe that never reported back (e.g. cancelled) stops blocking after one cooldown
+        probing = self.probing and now - self.probing < self.cooldown
+        if self.state == "open" or (self.state == "half_open" and probing):
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(f"Circuit open after a {self.failure_threshold:.0%}+ error rate; retrying in {self.cooldown:.0f}s")
+        if self.state == "half_open":
+            self.probing = now
+
+    def record_success(self):
+        """
+        Record a request the endpoint answered; closes a half-open breaker.
+        """
+        if self.state == "half_open":
+            self.state = "closed"
+            self.probing = 0.0
+            self.outcomes.clear()
+        now = time.monotonic()
+        self.outcomes.append((now, True))
+        self._trim(now)
+
+    def record_failure(self):
+        """
+        Record a failed request; opens the breaker when the error rate crosses the threshold.
+        """
+        now = time.monotonic()
+        if self.state == "half_open":
+            self._open(now)
+            return
+        self.outcomes.append((now, False))
+        self._trim(now)
+        failures = sum(not ok for _, ok in self.outcomes)
+        if len(self.outcomes) >= self.min_requests and failures / len(self.outcomes) >= self.failure_threshold:
+            self._open(now)
+
+    def _open(self, now: float):
+        if self.state != "open":
+            self.stats["opened"] += 1
+            print(f"Circuit breaker opened for {self.cooldown:.0f}s")
+        self.state = "open"
+        self.opened_at = now
+        self.probing = 0.0
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from typing import Dict, Iterable, List, Optional
+
+
+CACHE_PATH = "results/response_cache.db"
+
+
+def request_key(model: str, messages: List[Dict[str, str]], generation_config: Dict, sample: int = 0) -> str:
+    """
+    Compute the content address of a chat completion request.
+
+    Args:
+        model (str): The model name.
+        messages (List[Dict[str, str]]): The full chat messages.
+        generation_config (Dict): Generation parameters.
+        sample (int): Sample index.
+
+    Returns:
+        str: The hex digest identifying the request.
+    """
+    request = {"model": model, "messages": messages, "generation_config": generation_config, "sample": sample}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    A disk-backed, content-addressed cache of chat completion outputs, safe to share between processes.
+    """
+
+    def __init__(self, db_path: str = CACHE_PATH, max_bytes: int = 1 << 30, sample: int = 0):
+        """
+        Open (or create) the cache.
+
+        Args:
+            db_path (str): Path of the SQLite database file.
+            max_bytes (int): Size bound of the stored outputs; least-recently-used entries are evicted beyond it.
+            sample (int): Default sample index mixed into every key. Bump it to draw fresh samples.
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.sample = sample
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._writes_since_eviction = 0
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # WAL + busy timeout make concurrent access from several processes safe
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                 key TEXT PRIMARY KEY,
+                                 model TEXT,
+                                 outputs TEXT NOT NULL,
+                                 size INTEGER NOT NULL,
+                                 last_access REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)")
+        self.conn.commit()
+
+    def key(self, model: str, messages: List[Dict[str, str]], generation_config: Dict, sample: Optional[int] = None) -> str:
+        """
+        Compute the content address of a request.
+
+        Args:
+            model (str): The model name.
+            messages (List[Dict[str, str]]): The full chat messages.
+            generation_config (Dict): Generation parameters.
+            sample (Optional[int]): Sample index. Defaults to the cache's sample index.
+
+        Returns:
+            str: The hex digest identifying the request.
+        """
+        return request_key(model, messages, generation_config, self.sample if sample is None else sample)
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """
+        Look up a request and refresh its recency.
+
+        Args:
+            key (str): The request key.
+
+        Returns:
+            Optional[List[str]]: The cached outputs (one per choice), or None on a miss.
+        """
+        row = self.conn.execute("SELECT outputs FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        with self.conn:
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, outputs: Iterable[str]):
+        """
+        Store the outputs of a request.
+
+        Args:
+            key (str): The request key.
+            model (str): The model name, kept for inspection.
+            outputs (Iterable[str]): One output per returned choice.
+        """
+        payload = json.dumps(list(outputs))
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, model, payload, len(payload), time.time()))
+        self.stats["writes"] += 1
+        # Summing the table on every write would be O(n); check the bound periodically instead
+        self._writes_since_eviction += 1
+        if self._writes_since_eviction >= 64:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop least-recently-used entries until the cache fits in max_bytes.
+        """
+        self._writes_since_eviction = 0
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess, doomed = total - self.max_bytes, []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            doomed.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        with self.conn:
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        self.stats["evictions"] += len(doomed)
+
+    def snapshot(self) -> dict:
+        """
+        Copy the counters, so that a later summary can report only what happened after this point.
+
+        Returns:
+            dict: The counters so far.
+        """
+        return dict(self.stats)
+
+    def summary(self, since: Optional[dict] = None) -> str:
+        """
+        Format the hit/miss statistics of this process.
+
+        Args:
+            since (Optional[dict]): A snapshot() taken at the start of the run to report. Defaults to the whole process.
+
+        Returns:
+            str: A one-line summary.
+        """
+        stats = self.stats if since is None else {key: value - since.get(key, 0) for key, value in self.stats.items()}
+        lookups = stats["hits"] + stats["misses"]
+        return (f"Response cache: {stats['hits']}/{lookups} hits ({stats['hits'] / max(lookups, 1):.1%}), "
+                f"{stats['writes']} writes, {stats['evictions']} evictions")
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.conn.close()
@@ -0,0 +1,322 @@
+import os
+import json
+import sqlite3
+import hashlib
+import pandas as pd
+from typing import Dict, Iterable, List, Optional
+
+
+STORE_FILENAME = "results_store.db"
+
+
+class ResultsStore:
+    """
+    An append-only SQLite store of corrections keyed by (dataset, column, row), where the latest write of a key wins.
+    """
+
+    def __init__(self, db_path: str):
+        """
+        Open (or create) the store.
+
+        Args:
+            db_path (str): Path of the SQLite database file.
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # WAL lets other processes read while one appends
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                                 seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                 dataset TEXT NOT NULL,
+                                 column_name TEXT NOT NULL,
+                                 model TEXT,
+                                 strategy TEXT,
+                                 row INTEGER NOT NULL,
+                                 prediction TEXT)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS predictions_key ON predictions (dataset, column_name, row, seq)")
+        self.conn.commit()
+
+    @classmethod
+    def for_results_path(cls, file_path: str) -> 'ResultsStore':
+        """
+        Open the store shared by every results JSON file of a directory.
+
+        Args:
+            file_path (str): Path of a results JSON file.
+
+        Returns:
+            ResultsStore: The store next to that file.
+        """
+        return cls(os.path.join(os.path.dirname(os.path.expanduser(file_path)), STORE_FILENAME))
+
+    def append(self, dataset: str, column: str, rows: Iterable[int], predictions: Iterable[str], model: Optional[str] = None,
+               strategy: Optional[str] = None, overwrite: bool = True):
+        """
+        Append corrections for the given rows.
+
+        Args:
+            dataset (str): Dataset name, e.g. "test_cv".
+            column (str): Wide-layout column name, e.g. "corrected_by_{model}_{strategy}".
+            rows (Iterable[int]): Row indices of the corrections.
+            predictions (Iterable[str]): The corrections.
+            model (Optional[str]): Model name, stored for reference.
+            strategy (Optional[str]): Strategy name, stored for reference.
+            overwrite (bool): If False, rows that already hold a value are left untouched. Defaults to True.
+        """
+        entries = [(dataset, column, model, strategy, int(row), prediction) for row, prediction in zip(rows, predictions)]
+        with self.conn:
+            if overwrite:
+                self.conn.executemany("INSERT INTO predictions (dataset, column_name, model, strategy, row, prediction) VALUES (?, ?, ?, ?, ?, ?)", entries)
+            else:
+                self.conn.executemany("""INSERT INTO predictions (dataset, column_name, model, strategy, row, prediction)
+                                         SELECT ?, ?, ?, ?, ?, ?
+                                         WHERE NOT EXISTS (SELECT 1 FROM predictions
+                                                           WHERE dataset = ?1 AND column_name = ?2 AND row = ?5 AND prediction IS NOT NULL)""", entries)
+
+    def has_dataset(self, dataset: str) -> bool:
+        """
+        Check whether anything has been stored for a dataset.
+
+        Args:
+            dataset (str): Dataset name.
+
+        Returns:
+            bool: True if the dataset has at least one stored row.
+        """
+        return self.conn.execute("SELECT 1 FROM predictions WHERE dataset = ? LIMIT 1", (dataset,)).fetchone() is not None
+
+    def columns(self, dataset: str) -> List[str]:
+        """
+        List the stored columns of a dataset in the order they were first written.
+
+        Args:
+            dataset (str): Dataset name.
+
+        Returns:
+            List[str]: Column names.
+        """
+        return [name for (name,) in self.conn.execute("SELECT column_name FROM predictions WHERE dataset = ? GROUP BY column_name ORDER BY MIN(seq)", (dataset,))]
+
+    def latest(self, dataset: str, column: Optional[str] = None) -> pd.DataFrame:
+        """
+        Read the latest correction of every (column, row).
+
+        Args:
+            dataset (str): Dataset name.
+            column (Optional[str]): Restrict to one column. Defaults to all columns.
+
+        Returns:
+            pd.DataFrame: Long frame with the columns column_name, row and prediction.
+        """
+        query = """SELECT column_name, row, prediction FROM predictions
+                   WHERE seq IN (SELECT MAX(seq) FROM predictions WHERE dataset = ?{} GROUP BY column_name, row)
+                   ORDER BY seq"""
+        params = (dataset,)
+        if column is not None:
+            query = query.format(" AND column_name = ?")
+            params = (dataset, column)
+        else:
+            query = query.format("")
+        return pd.read_sql_query(query, self.conn, params=params)
+
+    def compact(self):
+        """
+        Drop superseded writes and reclaim the space.
+        """
+        with self.conn:
+            deleted = self.conn.execute("""DELETE FROM predictions WHERE seq NOT IN
+                                           (SELECT MAX(seq) FROM predictions GROUP BY dataset, column_name, row)""").rowcount
+        self.conn.execute("VACUUM")
+        print(f"Compacted {self.db_path}: removed {deleted} superseded rows")
+
+    def import_json(self, dataset: str, file_path: str):
+        """
+        Load the corrected_by_* columns of an existing wide results JSON into the store.
+
+        Args:
+            dataset (str): Dataset name.
+            file_path (str): Path of the results JSON file.
+        """
+        df = pd.read_json(os.path.expanduser(file_path))
+        for column in df.columns:
+            if column.startswith("corrected_by_"):
+                values = df[column]
+                rows = values.index[values.notna()]
+                self.append(dataset, column, rows, values[rows].tolist())
+
+    def to_wide(self, dataset: str, base: pd.DataFrame) -> pd.DataFrame:
+        """
+        Overlay the stored columns of a dataset onto its data columns, in the wide results layout.
+
+        Args:
+            dataset (str): Dataset name.
+            base (pd.DataFrame): The dataset's own columns, one row per utterance.
+
+        Returns:
+            pd.DataFrame: The wide results frame.
+        """
+        df = base.copy()
+        long = self.latest(dataset)
+        for column, group in long.groupby("column_name", sort=False):
+            if column not in df.columns:
+                df[column] = None
+            df.loc[group["row"].to_numpy(), column] = group["prediction"].to_numpy()
+        return df
+
+    def export_json(self, dataset: str, base: pd.DataFrame, file_path: str):
+        """
+        Export the wide results layout as a JSON records file.
+
+        Args:
+            dataset (str): Dataset name.
+            base (pd.DataFrame): The dataset's own columns.
+            file_path (str): Output JSON path.
+        """
+        self.to_wide(dataset, base).to_json(os.path.expanduser(file_path), orient="records", indent=4)
+        print(f"Results exported to {file_path}")
+
+    def export_csv(self, dataset: str, base: pd.DataFrame, file_path: str):
+        """
+        Export the wide results layout as a CSV file.
+
+        Args:
+            dataset (str): Dataset name.
+            base (pd.DataFrame): The dataset's own columns.
+            file_path (str): Output CSV path.
+        """
+        self.to_wide(dataset, base).to_csv(os.path.expanduser(file_path), index=False)
+        print(f"Results exported to {file_path}")
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+CHECKPOINT_FILENAME = "checkpoints.db"
+
+
+class RunCheckpoint:
+    """
+    Durable per-item checkpoints of one evaluation run, keyed by (dataset, model, strategy, generation config, row).
+    """
+
+    def __init__(self, db_path: str, dataset: str, model: str, strategy: str, generation_config: dict):
+        """
+        Open (or create) the checkpoint of a run.
+
+        Args:
+            db_path (str): Path of the SQLite checkpoint database.
+            dataset (str): Dataset name, e.g. "test_cv".
+            model (str): The name of the language model.
+            strategy (str): The name of the correction strategy.
+            generation_config (dict): Generation configuration of the run.
+        """
+        self.db_path = db_path
+        self.run_params = {"dataset": dataset, "model": model, "strategy": strategy, "generation_config": generation_config}
+        self.run_key = hashlib.sha256(json.dumps(self.run_params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS checkpoints (
+                                 run_key TEXT NOT NULL,
+                                 row INTEGER NOT NULL,
+                                 output TEXT,
+                                 PRIMARY KEY (run_key, row))""")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS runs (run_key TEXT PRIMARY KEY, params TEXT)")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS failures (
+                                 run_key TEXT NOT NULL,
+                                 row INTEGER NOT NULL,
+                                 error TEXT,
+                                 PRIMARY KEY (run_key, row))""")
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO runs VALUES (?, ?)", (self.run_key, json.dumps(self.run_params, sort_keys=True, default=str)))
+
+    @classmethod
+    def for_results_path(cls, file_path: str, model: str, strategy: str, generation_config: dict) -> 'RunCheckpoint':
+        """
+        Open the checkpoint of a run in the checkpoint database next to a results JSON.
+
+        Args:
+            file_path (str): Path of the results JSON file.
+            model (str): The name of the language model.
+            strategy (str): The name of the correction strategy.
+            generation_config (dict): Generation configuration of the run.
+
+        Returns:
+            RunCheckpoint: The run's checkpoint.
+        """
+        db_path = os.path.join(os.path.dirname(os.path.expanduser(file_path)), CHECKPOINT_FILENAME)
+        return cls(db_path, os.path.splitext(os.path.basename(file_path))[0], model, strategy, generation_config)
+
+    def completed(self) -> Dict[int, str]:
+        """
+        Read the outputs already checkpointed for this run.
+
+        Returns:
+            Dict[int, str]: Mapping from row index to output.
+        """
+        return dict(self.conn.execute("SELECT row, output FROM checkpoints WHERE run_key = ?", (self.run_key,)))
+
+    def save(self, row: int, output: str):
+        """
+        Durably record the output of one row.
+
+        Args:
+            row (int): Row index.
+            output (str): The strategy output for that row.
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)", (self.run_key, int(row), output))
+            self.conn.execute("DELETE FROM failures WHERE run_key = ? AND row = ?", (self.run_key, int(row)))
+
+    def save_failure(self, row: int, error: str):
+        """
+        Record a row whose request failed for good. The row stays pending, so a resumed run retries it.
+
+        Args:
+            row (int): Row index.
+            error (str): Description of the failure.
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO failures VALUES (?, ?, ?)", (self.run_key, int(row), error))
+
+    def failures(self) -> Dict[int, str]:
+        """
+        Read the rows of this run that failed and have not succeeded since.
+
+        Returns:
+            Dict[int, str]: Mapping from row index to error.
+        """
+        return dict(self.conn.execute("SELECT row, error FROM failures WHERE run_key = ?", (self.run_key,)))
+
+    def clear(self):
+        """
+        Drop the checkpoints of this run once its results are saved, so a deliberate rerun samples again.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM checkpoints WHERE run_key = ?", (self.run_key,))
+            self.conn.execute("DELETE FROM failures WHERE run_key = ?", (self.run_key,))
+            self.conn.execute("DELETE FROM runs WHERE run_key = ?", (self.run_key,))
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,176 @@
+import math
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from transformers import AutoTokenizer
+
+
+def is_reasoning_model(model: str) -> bool:
+    """
+    Tell whether a model thinks (a <think> trace) before answering.
+
+    Args:
+        model (str): The name of the language model.
+
+    Returns:
+        bool: True for DeepSeek models, like the pipeline's other DeepSeek special cases.
+    """
+    return 'DeepSeek' in model
+
+
+class TokenBudget:
+    """
+    Per-item max_tokens. The corrected transcript is about as long as the hypotheses, so each request gets slack x the
+    tokens of its longest hypothesis plus a margin, instead of one budget per dataset that truncates long utterances
+    and lets short ones run on. Completions cut off at the budget (finish_reason "length") are counted.
+    """
+
+    def __init__(self, tokenizer=None, slack: float = 1.5, margin: int = 8, reasoning_headroom: int = 0,
+                 min_tokens: int = 8, max_tokens: Optional[int] = None):
+        """
+        Initialize the budget.
+
+        Args:
+            tokenizer: A Hugging Face tokenizer (ideally the served model's) or model id. Without one, tokens are
+                estimated at ~4 characters each.
+            slack (float): Budget tokens per token of the longest hypothesis. Defaults to 1.5; see fit.
+            margin (int): Extra tokens per request. Defaults to 8.
+            reasoning_headroom (int): Extra tokens for the trace of reasoning models. Defaults to 0.
+            min_tokens (int): Smallest budget. Defaults to 8.
+            max_tokens (Optional[int]): Largest budget before the reasoning headroom. No cap if None.
+        """
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer) if isinstance(tokenizer, str) else tokenizer
+        self.slack = slack
+        self.margin = margin
+        self.reasoning_headroom = reasoning_headroom
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.stats = {"requests": 0, "completions": 0, "truncated": 0, "budget_tokens": 0, "completion_tokens": 0}
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Count the tokens of a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: Its token count (estimated without a tokenizer).
+        """
+        if self.tokenizer is None:
+            return len(text) // 4 + 1
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def budget(self, hypotheses: List[str], model: str = "") -> int:
+        """
+        Compute the max_tokens of one item.
+
+        Args:
+            hypotheses (List[str]): A list of ASR hypotheses.
+            model (str): The name of the language model; reasoning models get the reasoning headroom on top.
+
+        Returns:
+            int: The item's max_tokens.
+        """
+        longest = max((self.count_tokens(hypothesis) for hypothesis in hypotheses), default=0)
+        tokens = max(math.ceil(self.slack * longest) + self.margin, self.min_tokens)
+        if self.max_tokens is not None:
+            tokens = min(tokens, self.max_tokens)
+        if is_reasoning_model(model):
+            tokens += self.reasoning_headroom
+        return tokens
+
+    def apply(self, generation_config: Dict, hypotheses: List[str], model: str = "") -> Dict:
+        """
+        Get the generation configuration of one item.
+
+        Args:
+            generation_config (Dict): The run's generation configuration.
+            hypotheses (List[str]): A list of ASR hypotheses.
+            model (str): The name of the language model.
+
+        Returns:
+            Dict: A copy with the item's max_tokens.
+        """
+        return {**generation_config, "max_tokens": self.budget(hypotheses, model)}
+
+    def fit(self, hypotheses_lists: Sequence[List[str]], references: Sequence[str], quantile: float = 0.99) -> float:
+        """
+        Learn the slack from a development set, so that about 1 - quantile of its items would be truncated.
+
+        Args:
+            hypotheses_lists (Sequence[List[str]]): The N-best list of each item.
+            references (Sequence[str]): The reference transcript of each item.
+            quantile (float): Quantile of (reference tokens - margin) / (longest hypothesis tokens). Defaults to 0.99.
+
+        Returns:
+            float: The new slack (at least 1).
+        """
+        ratios = []
+        for hypotheses, reference in zip(hypotheses_lists, references):
+            longest = max((self.count_tokens(hypothesis) for hypothesis in hypotheses), default=0)
+            if longest:
+                ratios.append((self.count_tokens(reference) - self.margin) / longest)
+        if ratios:
+            self.slack = max(float(np.quantile(ratios, quantile)), 1.0)
+        return self.slack
+
+    def record(self, generation, generation_config: Dict):
+        """
+        Count one response's completions, and those cut off at the budget.
+
+        Args:
+            generation: The chat completion.
+            generation_config (Dict): The generation configuration of its request.
+        """
+        choices = getattr(generation, "choices", None) or []
+        self.stats["requests"] += 1
+        self.stats["completions"] += len(choices)
+        self.stats["truncated"] += sum(getattr(choice, "finish_reason", None) == "length" for choice in choices)
+        self.stats["budget_tokens"] += generation_config.get("max_tokens", 0) * max(len(choices), 1)
+        usage = getattr(generation, "usage", None)
+        self.stats["completion_tokens"] += getattr(usage, "completion_tokens", None) or 0
+
+    def signature(self) -> Dict:
+        """
+        Get the settings that change the requests, for the identity of a run checkpoint.
+
+        Returns:
+            Dict: The tokenizer name and the budget settings.
+        """
+        return {"tokenizer": getattr(self.tokenizer, "name_or_path", None), "slack": round(self.slack, 4), "margin": self.margin,
+                "reasoning_headroom": self.reasoning_headroom, "min_tokens": self.min_tokens, "max_tokens": self.max_tokens}
+
+    def truncation_rate(self) -> float:
+        """
+        Get the fraction of completions cut off at their budget.
+
+        Returns:
+            float: The truncation rate.
+        """
+        return self.stats["truncated"] / max(self.stats["completions"], 1)
+
+    def snapshot(self) -> dict:
+        """
+        Copy the counters, so that a later summary can report only what happened after this point.
+
+        Returns:
+            dict: The counters so far.
+        """
+        return dict(self.stats)
+
+    def summary(self, since: Optional[dict] = None) -> str:
+        """
+        Format the budgets and truncations so far.
+
+        Args:
+            since (Optional[dict]): A snapshot() taken at the start of the run to report. Defaults to the whole process.
+
+        Returns:
+            str: A one-line summary.
+        """
+        stats = self.stats if since is None else {key: value - since.get(key, 0) for key, value in self.stats.items()}
+        completions = max(stats["completions"], 1)
+        return (f"Token budget: slack {self.slack:.2f} + {self.margin}, mean max_tokens {stats['budget_tokens'] / completions:.1f}, "
+                f"{stats['completion_tokens'] / max(stats['budget_tokens'], 1):.0%} of the budget used, "
+                f"{stats['truncated']}/{stats['completions']} completions truncated ({stats['truncated'] / completions:.1%})")
@@ -0,0 +1,274 @@
+import re
+from itertools import chain
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Cells of the edit distance matrices held at once: batches small enough to stay in cache (int32, so 4 MB)
+MAX_CELLS = 1 << 20
+
+MULTIPLE_SPACES = re.compile(r"\s\s+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a transcript into words exactly as jiwer's default WER transform does.
+
+    Args:
+        text (str): The transcript.
+
+    Returns:
+        List[str]: Its words: runs of two or more whitespace characters become one space, the ends are stripped and
+            the text is split on spaces.
+    """
+    return [word for word in MULTIPLE_SPACES.sub(" ", text).strip().split(" ") if word]
+
+
+class WordInterner:
+    """
+    Maps every word to an integer ID once, and every text to its word IDs once, so edit distances compare integers
+    instead of strings. One interner can be shared by all the scoring calls over a corpus.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty vocabulary.
+        """
+        self.vocabulary: Dict[str, int] = {}
+        self.texts: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.vocabulary)
+
+    def encode(self, text: str) -> np.ndarray:
+        """
+        Get the word IDs of one text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            np.ndarray: Its word IDs.
+        """
+        self.encode_batch([text])
+        return self.texts[text]
+
+    def encode_batch(self, texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the word IDs of many texts, tokenizing only those not seen before.
+
+        Args:
+            texts (Sequence[str]): The texts.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The word IDs, one row per text padded with -1, and the length of each row.
+        """
+        new_texts = [text for text in dict.fromkeys(texts) if text not in self.texts]
+        if new_texts:
+            tokens = [tokenize(text) for text in new_texts]
+            # Hash all words in one pass; only the distinct ones go through the Python vocabulary
+            codes, words = pd.factorize(np.array(list(chain.from_iterable(tokens)), dtype=object))
+            vocabulary = self.vocabulary
+            ids = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in words], dtype=np.int32)[codes]
+            self.texts.update(zip(new_texts, np.split(ids, np.cumsum(list(map(len, tokens)))[:-1])))
+        encoded = [self.texts[text] for text in texts]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        width = max(int(lengths.max(initial=0)), 1)
+        padded = np.full((len(encoded), width), -1, dtype=np.int32)
+        if encoded:
+            padded[np.arange(width) < lengths[:, None]] = np.concatenate(encoded)
+        return padded, lengths
+
+
+class WordErrors:
+    """
+    Per-utterance hits, substitutions, deletions and insertions of a batch of (reference, hypothesis) pairs.
+    """
+
+    def __init__(self, hits: np.ndarray, substitutions: np.ndarray, deletions: np.ndarray, insertions: np.ndarray):
+        """
+        Initialize the counts.
+
+        Args:
+            hits (np.ndarray): Matched words per pair.
+            substitutions (np.ndarray): Substituted words per pair.
+            deletions (np.ndarray): Deleted reference words per pair.
+            insertions (np.ndarray): Inserted hypothesis words per pair.
+        """
+        self.hits = hits
+        self.substitutions = substitutions
+        self.deletions = deletions
+        self.insertions = insertions
+
+    def __len__(self) -> int:
+        return len(self.hits)
+
+    @property
+    def errors(self) -> np.ndarray:
+        return self.substitutions + self.deletions + self.insertions
+
+    @property
+    def reference_words(self) -> np.ndarray:
+        return self.hits + self.substitutions + self.deletions
+
+    def utterance_wer(self) -> np.ndarray:
+        """
+        Get the WER of every pair, as jiwer.wer(reference, hypothesis).
+
+        Returns:
+            np.ndarray: The WERs; the insertion count for an empty reference.
+        """
+        words = self.reference_words
+        return np.where(words > 0, self.errors / np.maximum(words, 1), self.insertions)
+
+    def corpus_wer(self) -> float:
+        """
+        Get the pooled WER of the batch, as jiwer.wer(references, hypotheses).
+
+        Returns:
+            float: Errors over reference words of all pairs.
+        """
+        words = int(self.reference_words.sum())
+        return float(self.errors.sum() / words) if words else int(self.insertions.sum())
+
+
+def _reversed(padded: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Reverse the words of every row.
+
+    Args:
+        padded (np.ndarray): Word IDs padded with -1.
+        lengths (np.ndarray): Length of each row.
+
+    Returns:
+        np.ndarray: The rows in reverse order, padded with -1.
+    """
+    positions = lengths[:, None] - 1 - np.arange(padded.shape[1])
+    return np.where(positions >= 0, padded[np.arange(len(padded))[:, None], np.maximum(positions, 0)], -1)
+
+
+def _common_prefix(a: np.ndarray, b: np.ndarray, limit: np.ndarray) -> np.ndarray:
+    """
+    Measure the common prefix of every pair of rows.
+
+    Args:
+        a (np.ndarray): First rows.
+        b (np.ndarray): Second rows.
+        limit (np.ndarray): Longest prefix of each pair (the shorter row).
+
+    Returns:
+        np.ndarray: The prefix lengths.
+    """
+    mismatch = a != b
+    return np.minimum(np.where(mismatch.any(axis=1), mismatch.argmax(axis=1), a.shape[1]), limit)
+
+
+def _align_batch(ref: np.ndarray, hyp: np.ndarray, ref_len: np.ndarray,
+                 hyp_len: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Align padded pairs whose common prefix and suffix were removed.
+
+    The edit distance matrices (reference words down, hypothesis words across) are filled one reference word at a
+    time for the whole batch; a row's insertion chain is a running minimum. The backtrace takes the steps of rapidfuzz's
+    Levenshtein.opcodes (deletion, else insertion, else diagonal), which jiwer counts, so equal-cost alignments split
+    into the same substitutions, deletions and insertions.
+
+    Args:
+        ref (np.ndarray): Reference word IDs, one row per pair.
+        hyp (np.ndarray): Hypothesis word IDs, one row per pair.
+        ref_len (np.ndarray): Reference length of each pair.
+        hyp_len (np.ndarray): Hypothesis length of each pair.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Substitutions, deletions and insertions per pair.
+    """
+    batch, rows, cols = len(ref), int(ref_len.max(initial=0)), int(hyp_len.max(initial=0))
+    columns = np.arange(cols + 1, dtype=np.int32)
+    dist = np.empty((batch, rows + 1, cols + 1), dtype=np.int32)
+    dist[:, 0] = columns
+    for c in range(1, rows + 1):
+        cost = (ref[:, c - 1, None] != hyp[:, :cols]).astype(np.int32)
+        step = np.empty((batch, cols + 1), dtype=np.int32)
+        step[:, 0] = c
+        step[:, 1:] = np.minimum(dist[:, c - 1, 1:] + 1, dist[:, c - 1, :-1] + cost)
+        dist[:, c] = np.minimum.accumulate(step - columns, axis=1) + columns
+
+    substitutions, deletions, insertions = (np.zeros(batch, dtype=np.int64) for _ in range(3))
+    b, c, r = np.arange(batch), ref_len.astype(np.int64), hyp_len.astype(np.int64)
+    active = (c > 0) & (r > 0)
+    while active.any():
+        deleted = active & (dist[b, c, r] - dist[b, c - 1, r] == 1)
+        deletions += deleted
+        c -= deleted
+        moved = active & ~deleted
+        r -= moved
+        inserted = moved & (r > 0) & (dist[b, c, r] - dist[b, c - 1, r] == -1)
+        insertions += inserted
+        diagonal = moved & ~inserted
+        c -= diagonal
+        # Finished pairs still index the arrays (masked out), so keep their positions in range
+        substitutions += diagonal & (ref[b, np.minimum(c, rows - 1)] != hyp[b, np.minimum(r, cols - 1)])
+        active = (c > 0) & (r > 0)
+    return substitutions, deletions + c, insertions + r
+
+
+def word_errors(references: Sequence[str], hypotheses: Sequence[str], interner: Optional[WordInterner] = None,
+                max_cells: int = MAX_CELLS) -> WordErrors:
+    """
+    Count the word errors of every (reference, hypothesis) pair, identical to jiwer.process_words on each pair.
+
+    Words are interned to integer IDs, pairs are sorted by length and aligned in NumPy batches, so a whole corpus is
+    scored in a few vectorized passes instead of one Python alignment per pair.
+
+    Args:
+        references (Sequence[str]): The reference transcripts.
+        hypotheses (Sequence[str]): The hypothesis transcripts.
+        interner (Optional[WordInterner]): Interner shared across calls, so texts seen before are not tokenized again.
+            A new one if None.
+        max_cells (int): Most edit distance matrix cells per batch. Defaults to MAX_CELLS.
+
+    Returns:
+        WordErrors: The counts per pair.
+
+    Raises:
+        ValueError: If there are not as many hypotheses as references.
+    """
+    if len(references) != len(hypotheses):
+        raise ValueError(f"Got {len(references)} references and {len(hypotheses)} hypotheses")
+    interner = interner if interner is not None else WordInterner()
+    # Each distinct text is tokenized once; the oracle's pairs of one row share their reference
+    unique: Dict[str, int] = {}
+    rows = np.fromiter((unique.setdefault(text, len(unique)) for text in chain(references, hypotheses)), dtype=np.int64, count=2 * len(references))
+    padded, lengths = interner.encode_batch(list(unique))
+    ref_rows, hyp_rows = rows[:len(references)], rows[len(references):]
+    ref_len, hyp_len = lengths[ref_rows], lengths[hyp_rows]
+    substitutions, deletions, insertions = (np.zeros(len(references), dtype=np.int64) for _ in range(3))
+
+    # Like rapidfuzz, align only what lies between the common prefix and suffix (matches either way)
+    shorter = np.minimum(ref_len, hyp_len)
+    prefix = _common_prefix(padded[ref_rows], padded[hyp_rows], shorter)
+    backwards = _reversed(padded, lengths)
+    suffix = _common_prefix(backwards[ref_rows], backwards[hyp_rows], shorter - prefix)
+    mid_ref_len, mid_hyp_len = ref_len - prefix - suffix, hyp_len - prefix - suffix
+
+    # Length-sorted batches waste few padded cells; each holds as many pairs as fit in max_cells
+    order = np.lexsort((mid_hyp_len, mid_ref_len))
+    order = order[(mid_ref_len[order] > 0) & (mid_hyp_len[order] > 0)]
+    start = 0
+    while start < len(order):
+        rest = order[start:]
+        cells = np.arange(1, len(rest) + 1) * (mid_ref_len[rest] + 1) * np.maximum.accumulate(mid_hyp_len[rest] + 1)
+        chunk = rest[:max(int(np.searchsorted(cells, max_cells, side="right")), 1)]
+        positions = np.minimum(prefix[chunk, None] + np.arange(max(int(mid_ref_len[chunk].max()), int(mid_hyp_len[chunk].max()))), padded.shape[1] - 1)
+        ref, hyp = padded[ref_rows[chunk, None], positions], padded[hyp_rows[chunk, None], positions]
+        substitutions[chunk], deletions[chunk], insertions[chunk] = _align_batch(ref, hyp, mid_ref_len[chunk], mid_hyp_len[chunk])
+        start += len(chunk)
+
+    # Pairs with nothing left on one side are pure deletions or insertions
+    empty = (mid_ref_len == 0) | (mid_hyp_len == 0)
+    deletions[empty] = mid_ref_len[empty]
+    insertions[empty] = mid_hyp_len[empty]
+    hits = ref_len - substitutions - deletions
+    return WordErrors(hits, substitutions, deletions, insertions)